@@ -7,7 +7,7 @@ from typing import Dict, Any, Optional, List
 import shutil
 from datetime import datetime
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
@@ -17,7 +17,20 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from app.config import WORKSPACE_ROOT
+from app.agent.mcp import MCPAgent
+from app.agent.plan import PlanExecuteAgent
+from app.agent.pool import AgentPool
+from app.config import WORKSPACE_ROOT, config
+from app.exceptions import DownloadError, JobQueueFull, UploadTooLarge
+from app.llm import LLM
+from app.tool.mcp_guard import MCPCallGuards
+from app.tool.mcp_lifecycle import MCPLifecycleManager
+from app.tool.mcp_pool import MCPSessionPool
+from app.utils.admission import AdmissionController, AdmissionMiddleware
+from app.utils.dataset_store import DatasetStore
+from app.utils.downloader import DatasetDownloader
+from app.utils.jobs import Job, JobQueue
+from app.utils.workspace import RunWorkspace, WorkspaceJanitor, new_run_id
 
 from app.task.demo import demo_task_configs
 # 导入任务提示
@@ -42,7 +55,6 @@ from app.task.service_packaging import (
 from app.task.mcp_service_recommendation import (
     get_mcp_service_recommendation_prompt
 )
-from app.utils.file_utils import extract_zip
 
 # 设置日志记录器
 logger = logging.getLogger(__name__)
@@ -55,6 +67,18 @@ app = FastAPI(
     docs_url="/",
 )
 
+# 准入控制：限制同时运行的智能体任务数，超出时排队，队列满时返回429
+# 先于CORS添加，使429响应也带有CORS头
+admission = AdmissionController(config.admission)
+if config.agent_pool.enabled:
+    # 每个运行占用一个池中的智能体，准入上限不能超过池容量
+    admission.limit_to(config.agent_pool.max_size)
+app.add_middleware(
+    AdmissionMiddleware,
+    controller=admission,
+    prefixes=("/api/agent/", "/stream/run/"),
+)
+
 # 配置CORS
 app.add_middleware(
     CORSMiddleware,
@@ -69,11 +93,97 @@ static_dir = Path("static")
 if static_dir.exists():
     app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# 辅助函数：创建流式响应生成器
-async def create_stream_generator(task_name: str, task_config: Dict[str, Any], agent_name: str, 
-                                  cleanup_files: List[str] = None, zip_extract_path: str = None):
+@app.on_event("startup")
+async def preconnect_llm_clients():
+    """启动时创建已配置的LLM实例并预先建立连接，避免首个请求承担TLS握手延迟"""
+    try:
+        for config_name in config.llm:
+            LLM(config_name=config_name)
+        await LLM.preconnect_all()
+    except Exception as e:
+        logger.warning(f"预先连接LLM端点失败: {str(e)}")
+
+# 按agent_mode划分的预热智能体池，在启动时创建
+agent_pools: Dict[str, AgentPool] = {}
+
+@app.on_event("startup")
+async def start_agent_pools():
+    """预热智能体池，使请求无需等待内置MCP服务器进程启动"""
+    if not config.agent_pool.enabled:
+        return
+    agent_pools["default"] = AgentPool(MCPAgent, config.agent_pool)
+    # 计划模式的任务较少，按需创建
+    agent_pools["plan"] = AgentPool(
+        PlanExecuteAgent, config.agent_pool.model_copy(update={"min_size": 0})
+    )
+    for pool in agent_pools.values():
+        try:
+            await pool.start()
+        except Exception as e:
+            logger.warning(f"预热智能体池失败: {str(e)}")
+
+# 后台任务队列，任务在固定数量的工作协程中运行，不依赖请求连接
+job_queue = JobQueue(config.jobs)
+
+@app.on_event("startup")
+async def start_job_queue():
+    """启动后台任务的工作协程"""
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    """取消未完成的后台任务，需在关闭智能体池之前执行"""
+    await job_queue.stop()
+
+# 按内容寻址的数据集存储，相同的上传文件只保存和解压一次
+dataset_store = DatasetStore(config.datasets)
+
+# file_url参数共用的下载器，共享连接池并在磁盘上缓存下载的数据集
+dataset_downloader = DatasetDownloader(config.downloads)
+
+@app.on_event("shutdown")
+async def close_dataset_downloader():
+    """关闭下载器的HTTP连接池"""
+    await dataset_downloader.close()
+
+# 定期删除过期的运行目录、数据集和下载缓存，回收客户端断开等情况下遗留的目录
+workspace_janitor = WorkspaceJanitor(
+    config.workspace, dataset_store=dataset_store, downloader=dataset_downloader
+)
+
+@app.on_event("startup")
+async def start_workspace_janitor():
+    """启动运行目录清理程序"""
+    workspace_janitor.start()
+
+@app.on_event("shutdown")
+async def stop_workspace_janitor():
+    """停止运行目录清理程序"""
+    await workspace_janitor.stop()
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    """关闭共享的LLM HTTP连接池"""
+    await LLM.close_shared_clients()
+
+@app.on_event("shutdown")
+async def close_agent_pools():
+    """断开池中空闲智能体的MCP连接"""
+    for pool in agent_pools.values():
+        await pool.close()
+    agent_pools.clear()
+    # 智能体归还引用后再关闭共享的MCP会话
+    await MCPSessionPool.shared().close()
+    report = await MCPLifecycleManager.shared().shutdown()
+    if report["sessions"]["live"] or report["processes"]["live"]:
+        logger.warning(f"关闭后仍有未释放的MCP资源: {report}")
+
+# 辅助函数：运行任务并产生步骤事件
+async def run_task_events(task_name: str, task_config: Dict[str, Any], agent_name: str, 
+                          cleanup_files: List[str] = None, zip_extract_path: str = None,
+                          run: Optional[RunWorkspace] = None):
     """
-    创建通用的流式响应生成器
+    按任务配置运行智能体，产生步骤事件，供流式响应和后台任务共用
     
     参数:
         task_name: 任务名称
@@ -81,69 +191,71 @@ async def create_stream_generator(task_name: str, task_config: Dict[str, Any], a
         agent_name: Agent名称
         cleanup_files: 任务完成后需要清理的文件列表
         zip_extract_path: 如果指定，将此目录压缩成zip文件并返回（用于service_packaging等任务）
+        run: 本次运行的工作目录，运行结束后删除（或按配置保留到TTL过期）
         
     返回:
-        异步生成器，产生SSE格式的事件流
+        异步生成器，产生步骤事件字典，最后一个事件的is_last为True
     """
     from run_mcp import MCPRunner
     
     runner = None
+    pool = None
+    leased_agent = None
     full_result = []
     try:
-        runner = MCPRunner(agent_name)
-        
-        # 从任务配置中获取服务器配置列表
-        server_configs = task_config.get("server_config", [])
-        
-        # 先添加内置的MCP服务器（这是默认的，始终存在）
-        logger.info("添加默认内置MCP服务器")
-        await runner.add_server(
-            connection_type="stdio",
-            server_url=None,
-            command=None,  
-            args=None,    
-            server_id="stdio_built_in"  
-        )
-        
-        # 遍历并添加配置中的其他服务器
+        agent_mode = task_config.get("agent_mode") or "default"
+        pool = agent_pools.get(agent_mode)
+        # 任务配置中的服务器，只添加有足够配置信息的服务器
+        server_configs = []
+        for idx, server_config in enumerate(task_config.get("server_config", [])):
+            if server_config.get("server_url") or server_config.get("command"):
+                server_configs.append({
+                    **server_config,
+                    "connection_type": server_config.get("connection_type", "stdio"),
+                    "server_id": server_config.get("server_id") or f"server_{idx}",
+                })
+
+        if pool:
+            # 租用已连接内置MCP服务器的智能体
+            leased_agent = await pool.lease(agent_name)
+            runner = MCPRunner(
+                agent_name, agent=leased_agent, server_configs=pool.server_configs
+            )
+        else:
+            runner = MCPRunner(agent_name, plan_mode=agent_mode == "plan")
+            # 先添加内置的MCP服务器（这是默认的，始终存在）
+            server_configs.insert(0, {
+                "connection_type": "stdio",
+                "server_url": None,
+                "command": None,
+                "args": None,
+                "server_id": "stdio_built_in"
+            })
+
+        # 并发连接所有服务器，单个服务器失败不影响其他服务器
         if server_configs:
-            for idx, server_config in enumerate(server_configs):
-                connection_type = server_config.get("connection_type", "stdio")
-                server_url = server_config.get("server_url")
-                command = server_config.get("command")
-                args = server_config.get("args")
-                server_id = server_config.get("server_id") or f"server_{idx}"
-                
-                # 检查是否有足够的配置信息来添加服务器
-                if server_url or command:
-                    logger.info(f"添加配置的MCP服务器 #{idx+1}")
-                    await runner.add_server(
-                        connection_type=connection_type,
-                        server_url=server_url,
-                        command=command,
-                        args=args,
-                        server_id=server_id
-                    )
+            await runner.add_servers(server_configs)
         
         # 获取prompt
         prompt = task_config["prompt"]
         
-        # 运行流式Agent
-        async for step_result in runner.run_stream(prompt):
-            # 将结果转为SSE格式
-            json_result = json.dumps(step_result, ensure_ascii=False)
-
-            if not step_result.get("is_last", False):
+        # 运行流式Agent，同时转发LLM生成过程中的增量，缩短首字节时间
+        async for step_result in runner.run_stream(prompt, stream_deltas=True):
+            # 增量事件只转发给客户端，不计入完整记录
+            if step_result.get("is_delta"):
+                yield step_result
+            elif not step_result.get("is_last", False):
                 full_result.append(step_result)
-                yield f"data: {json_result}\n\n"
+                yield step_result
             
             # 如果是最后一个结果，保存完整记录并返回特定输出
             else:        
-                # 保存完整记录到文件
+                # 保存完整记录到文件，文件名使用运行ID，并发运行的同一任务不会互相覆盖
                 from app.utils.visualize_record import save_record_to_json, generate_visualization_html
+                record_name = run.run_id if run else new_run_id(task_name)
                 full_json = json.dumps(full_result, ensure_ascii=False)
-                save_record_to_json(task_name, full_json)
-                generate_visualization_html(task_name)
+                save_record_to_json(record_name, full_json)
+                generate_visualization_html(record_name, title=task_name)
                 
                 # 读取任务特定的最终输出文件
                 final_results = {}
@@ -153,7 +265,7 @@ async def create_stream_generator(task_name: str, task_config: Dict[str, Any], a
                     try:
                         # 生成唯一的zip文件名
                         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        zip_filename = f"{WORKSPACE_ROOT}/{timestamp}_service_package.zip"
+                        zip_filename = run.path(f"{timestamp}_service_package.zip") if run else f"{WORKSPACE_ROOT}/{timestamp}_service_package.zip"
                         
                         # 压缩目录
                         import zipfile
@@ -216,7 +328,7 @@ async def create_stream_generator(task_name: str, task_config: Dict[str, Any], a
                         "is_final_result": True,
                         "final_results": final_results
                     }
-                    yield f"data: {json.dumps(last_message, ensure_ascii=False)}\n\n"
+                    yield last_message
                 else:
                     # 如果没有找到最终结果，也发送消息通知前端
                     logger.warning(f"没有找到任务 {task_name} 的最终输出文件")
@@ -224,42 +336,91 @@ async def create_stream_generator(task_name: str, task_config: Dict[str, Any], a
                         "is_last": True,
                         "warning": f"没有找到任务 {task_name} 的最终输出文件"
                     }
-                    yield f"data: {json.dumps(last_message, ensure_ascii=False)}\n\n"
+                    yield last_message
             
     except Exception as e:
         error_msg = f"执行出错: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        yield f"data: {json.dumps({'error': error_msg, 'is_last': True})}\n\n"
+        yield {'error': error_msg, 'is_last': True}
     finally:
-        if runner:
-            try:
-                # 使用非阻塞方式清理资源
-                logger.info("在后台启动清理过程...")
-                # 创建任务但不等待其完成
-                # asyncio.create_task(runner.cleanup())
-                runner.cleanup()
-                # 给清理任务一点时间启动
-                # await asyncio.sleep(0.1)
-                logger.info("清理任务已在后台启动")
-            except Exception as e:
-                logger.error(f"启动清理过程时出错: {str(e)}")
+        if leased_agent is not None:
+            # 归还池中的智能体，由池负责断开额外的服务器并重置状态
+            await pool.release(leased_agent)
+        # 池中的智能体已归还；运行期间重建的智能体仍由runner清理
+        if runner and runner.agent is not leased_agent:
+            # 等待连接在时限内关闭，避免服务器子进程和会话在高负载下累积
+            await runner.cleanup()
             
-            # 清理临时文件
-            try:
-                # 清理通用临时目录
-                if os.path.exists(f"{WORKSPACE_ROOT}/temp"):
-                    shutil.rmtree(f"{WORKSPACE_ROOT}/temp")
-                
-                # 清理任务特定的文件
-                if cleanup_files:
-                    for file_path in cleanup_files:
-                        if os.path.exists(file_path):
-                            if os.path.isdir(file_path):
-                                shutil.rmtree(file_path)
-                            else:
-                                os.remove(file_path)
-            except Exception as e:
-                logger.warning(f"清理临时文件失败: {str(e)}")
+        # 清理临时文件
+        try:
+            # 只删除本次运行的工作目录，不影响并发的其他运行；删除大目录时不阻塞事件循环
+            if run:
+                await asyncio.to_thread(run.release, config.workspace.keep_runs)
+            
+            # 清理任务特定的文件
+            if cleanup_files:
+                for file_path in cleanup_files:
+                    if os.path.exists(file_path):
+                        if os.path.isdir(file_path):
+                            shutil.rmtree(file_path)
+                        else:
+                            os.remove(file_path)
+        except Exception as e:
+            logger.warning(f"清理临时文件失败: {str(e)}")
+
+# 辅助函数：创建流式响应生成器
+async def create_stream_generator(task_name: str, task_config: Dict[str, Any], agent_name: str, 
+                                  cleanup_files: List[str] = None, zip_extract_path: str = None,
+                                  run: Optional[RunWorkspace] = None):
+    """
+    创建通用的流式响应生成器，参数与run_task_events相同
+        
+    返回:
+        异步生成器，产生SSE格式的事件流
+    """
+    async for event in run_task_events(task_name, task_config, agent_name, cleanup_files,
+                                       zip_extract_path, run):
+        yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# 辅助函数：保存上传的数据集文件
+async def save_upload(run: RunWorkspace, file: UploadFile) -> str:
+    """
+    分块存入数据集存储（不阻塞事件循环），并复制到运行目录
+    
+    返回:
+        运行目录中的文件路径
+    
+    异常:
+        UploadTooLarge: 文件超过大小上限
+    """
+    stored = await dataset_store.ingest(file, size_hint=file.size)
+    path = run.path(os.path.basename(file.filename))
+    await asyncio.to_thread(dataset_store.copy_to, stored.sha256, path)
+    if stored.deduplicated:
+        logger.info(f"上传的文件与已有数据集相同（{stored.sha256[:12]}），复用已保存的文件")
+    return path
+
+# 辅助函数：下载file_url指定的数据集文件
+async def download_dataset(run: RunWorkspace, file_url: str, timestamp: str) -> str:
+    """
+    异步下载数据集到运行目录，服务器上的文件未变化时使用缓存
+    
+    返回:
+        运行目录中的文件路径
+    """
+    from urllib.parse import urlparse
+    
+    # 从URL中提取文件名
+    file_name = os.path.basename(urlparse(file_url).path) or f"dataset_{timestamp}.zip"
+    zip_filename = run.path(file_name)
+    
+    logger.info(f"从URL下载文件: {file_url}")
+    try:
+        result = await dataset_downloader.download(file_url, zip_filename)
+    except DownloadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"已{'使用缓存' if result.from_cache else '下载'}文件: {zip_filename}（{result.size}字节）")
+    return zip_filename
 
 # 创建通用流式响应
 def create_streaming_response(generator):
@@ -304,6 +465,89 @@ async def stream_run(task_name: str):
     stream_generator = create_stream_generator(task_name, task_config, agent_name)
     return create_streaming_response(stream_generator)
 
+class JobRequest(BaseModel):
+    task_name: str
+
+@app.post("/jobs", tags=["jobs"], status_code=202)
+async def submit_job(request: JobRequest):
+    """
+    提交后台任务，立即返回任务ID
+    
+    任务在后台任务队列中执行，客户端断开不影响任务运行。
+    
+    参数:
+        task_name: 任务名称，与/stream/run/{task_name}相同
+    
+    返回:
+        任务状态以及事件流和状态查询的URL
+    """
+    task_name = request.task_name
+    if task_name not in demo_task_configs:
+        raise HTTPException(status_code=400, detail=f"未知的任务名称: {task_name}")
+    
+    task_config = demo_task_configs[task_name]
+    agent_name = f'{task_name.replace("_", " ").capitalize()} Agent'
+    
+    async def events():
+        # 后台任务同样占用准入额度，在工作协程中排队等待而不是被拒绝
+        async with admission.slot(task_name, reject=False):
+            async for event in run_task_events(task_name, task_config, agent_name):
+                yield event
+    
+    try:
+        job = job_queue.submit(task_name, events)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    
+    return {
+        **job.to_dict(),
+        "events_url": f"/jobs/{job.id}/events",
+        "status_url": f"/jobs/{job.id}",
+    }
+
+def get_job_or_404(job_id: str) -> Job:
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务不存在或已过期: {job_id}")
+    return job
+
+@app.get("/jobs/{job_id}", tags=["jobs"])
+async def get_job(job_id: str):
+    """
+    返回后台任务的状态，任务结束后包含最终结果或错误信息
+    """
+    return get_job_or_404(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/events", tags=["jobs"])
+async def job_events(
+    job_id: str,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    以SSE订阅后台任务的步骤事件
+    
+    先重放Last-Event-ID（请求头，或last_event_id查询参数）之后的已缓存事件，
+    再持续推送新事件直到任务结束。步骤事件带有id，断线重连时浏览器会自动携带Last-Event-ID。
+    """
+    job = get_job_or_404(job_id)
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header or 0)
+        except ValueError:
+            last_event_id = 0
+    
+    async def event_stream():
+        async for event_id, event in job.events(last_event_id):
+            data = json.dumps(event, ensure_ascii=False)
+            if event_id is None:
+                # LLM增量事件不带id，重连后不会重放
+                yield f"data: {data}\n\n"
+            else:
+                yield f"id: {event_id}\ndata: {data}\n\n"
+    
+    return create_streaming_response(event_stream())
+
 # 添加演示页面路由
 @app.get("/stream_demo", tags=["demo"])
 async def stream_demo():
@@ -335,6 +579,10 @@ async def mcp_test_upload(message: str = Form(...), server_url: str = Form(...))
         最后一个事件包含任务特定的最终结果
     """
     
+    # 每次运行使用独立的工作目录，并发请求互不影响
+    run = RunWorkspace.create("mcp_test")
+    output_file = run.path("temp", "mcp_server_list.md")
+
     try:
         
         # 使用与code_analysis任务相同的配置
@@ -345,9 +593,9 @@ async def mcp_test_upload(message: str = Form(...), server_url: str = Form(...))
             + f"{message}\n\n"
             + "注意，用户提到的MCP Server指的是你接入内置Server之外的MCP Server，请不要向用户提及内置Server。"
             + "除了用户指令外，你还需要向用户介绍你接入的MCP Server，包括Server的名称、功能、以及每个Server下的各tool的详细信息。"
-            + f"请将这些内容写入{WORKSPACE_ROOT}/temp/mcp_server_list.md文件中",
+            + f"请将这些内容写入{output_file}文件中",
             "outputs": [
-                {"name": "mcp_server_list", "file": f"{WORKSPACE_ROOT}/temp/mcp_server_list.md"}
+                {"name": "mcp_server_list", "file": output_file}
             ],
             "server_config": [
                 {
@@ -362,18 +610,14 @@ async def mcp_test_upload(message: str = Form(...), server_url: str = Form(...))
         
         agent_name = "MCP Test Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [f"{WORKSPACE_ROOT}/temp/mcp_server_list.md"]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
     except Exception as e:
         logger.error(f"处理上传文件时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if os.path.exists(f"{WORKSPACE_ROOT}/temp/mcp_server_list.md"):
-            os.remove(f"{WORKSPACE_ROOT}/temp/mcp_server_list.md")
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
     
     
@@ -390,47 +634,42 @@ async def code_analysis_upload(file: UploadFile = File(...)):
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含任务特定的最终结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名和解压目录
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    original_filename = f"{workspace}/{timestamp}_{file.filename}"
-    extract_path = f"{workspace}/{timestamp}_extracted"
+    # 每次运行使用独立的工作目录，上传文件、解压目录和输出都在其中
+    run = RunWorkspace.create("code_analysis")
+    extract_path = run.path("extracted")
     
     try:
-        # 保存上传的文件
-        with open(original_filename, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
         # 获取文件扩展名
         file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext not in ('.zip', '.py'):
+            raise HTTPException(
+                status_code=400, 
+                detail=f"不支持的文件类型: {file_ext}。只支持 .zip 和 .py 文件"
+            )
+        
+        # 分块保存上传的文件，相同内容只保存一份
+        stored = await dataset_store.ingest(file, size_hint=file.size)
         
         if file_ext == '.zip':
-            # ZIP文件：解压处理
+            # ZIP文件：同一内容只解压一次，运行使用解压结果的副本
             logger.info(f"检测到ZIP文件，解压到: {extract_path}")
-            extract_zip(original_filename, extract_path)
-        elif file_ext == '.py':
+            await dataset_store.extract_to(stored.sha256, extract_path)
+        else:
             # PY文件：创建目录并拷贝文件
             logger.info(f"检测到Python文件，创建目录并拷贝到: {extract_path}")
             os.makedirs(extract_path, exist_ok=True)
-            destination_file = os.path.join(extract_path, file.filename)
-            shutil.copy2(original_filename, destination_file)
-        else:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"不支持的文件类型: {file_ext}。只支持 .zip 和 .py 文件"
-            )
+            destination_file = os.path.join(extract_path, os.path.basename(file.filename))
+            await asyncio.to_thread(shutil.copy2, stored.path, destination_file)
         
         # 使用与code_analysis任务相同的配置
         task_name = "code_analysis"
         task_config = {
-            "prompt": get_code_analysis_prompt(workspace=workspace, 
+            "prompt": get_code_analysis_prompt(workspace=run.root, 
                                                main_code=file.filename,
-                                               input_dir=extract_path),
+                                               input_dir=extract_path,
+                                               temp_dir=str(run.temp_dir)),
             "outputs": [
-                {"name": "function", "file": f"{WORKSPACE_ROOT}/temp/function.json"}
+                {"name": "function", "file": run.path("temp", "function.json")}
             ],
             "server_config": [
                 {
@@ -445,20 +684,21 @@ async def code_analysis_upload(file: UploadFile = File(...)):
         
         agent_name = "Code Analysis Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [original_filename, extract_path]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理上传文件时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if os.path.exists(original_filename):
-            os.remove(original_filename)
-        if os.path.exists(extract_path):
-            shutil.rmtree(extract_path)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
     
 # 添加服务封装任务的POST API端点
@@ -474,46 +714,42 @@ async def service_packaging_upload(file: UploadFile = File(...)):
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含任务特定的最终结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名和解压目录
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    original_filename = f"{workspace}/{timestamp}_{file.filename}"
-    extract_path = f"{workspace}/{timestamp}_extracted"
+    # 每次运行使用独立的工作目录，上传文件、解压目录和输出都在其中
+    run = RunWorkspace.create("service_packaging")
+    extract_path = run.path("extracted")
     
     try:
-        # 保存上传的文件
-        with open(original_filename, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
         # 获取文件扩展名
         file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext not in ('.zip', '.py'):
+            raise HTTPException(
+                status_code=400, 
+                detail=f"不支持的文件类型: {file_ext}。只支持 .zip 和 .py 文件"
+            )
+        
+        # 分块保存上传的文件，相同内容只保存一份
+        stored = await dataset_store.ingest(file, size_hint=file.size)
         
         if file_ext == '.zip':
-            # ZIP文件：解压处理
+            # ZIP文件：同一内容只解压一次，运行使用解压结果的副本
             logger.info(f"检测到ZIP文件，解压到: {extract_path}")
-            extract_zip(original_filename, extract_path)
-        elif file_ext == '.py':
+            await dataset_store.extract_to(stored.sha256, extract_path)
+        else:
             # PY文件：创建目录并拷贝文件
             logger.info(f"检测到Python文件，创建目录并拷贝到: {extract_path}")
             os.makedirs(extract_path, exist_ok=True)
-            destination_file = os.path.join(extract_path, file.filename)
-            shutil.copy2(original_filename, destination_file)
-        else:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"不支持的文件类型: {file_ext}。只支持 .zip 和 .py 文件"
-            )
+            destination_file = os.path.join(extract_path, os.path.basename(file.filename))
+            await asyncio.to_thread(shutil.copy2, stored.path, destination_file)
         
         # Agent配置
         task_name = "service_packaging"
         task_config = {
-            "prompt": get_service_packaging_prompt(workspace=workspace, 
+            "prompt": get_service_packaging_prompt(workspace=run.root, 
                                                main_code=file.filename,
                                                input_dir=extract_path),
             "outputs": [],  # 清空outputs，因为我们将直接返回压缩的zip文件
+            # 流程固定的多步任务使用计划-执行模式
+            "agent_mode": "plan",
             "server_config": [
                 {
                     "connection_type": "stdio",
@@ -527,20 +763,21 @@ async def service_packaging_upload(file: UploadFile = File(...)):
         
         agent_name = "Service Packaging Agent"
         
-        # 设置需要清理的文件列表（不包括extract_path，因为它会在压缩后被清理）
-        cleanup_files = [original_filename, extract_path]
-        
         # 使用通用生成器创建流式响应，传入zip_extract_path启用zip压缩功能
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files, zip_extract_path=extract_path)
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, zip_extract_path=extract_path, run=run)
         return create_streaming_response(stream_generator)
     
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理上传文件时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if os.path.exists(original_filename):
-            os.remove(original_filename)
-        if os.path.exists(extract_path):
-            shutil.rmtree(extract_path)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
 
 # 添加反洗钱报告生成任务的POST API端点
@@ -563,11 +800,8 @@ async def aml_report_upload(
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含任务特定的最终结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名
+    # 每次运行使用独立的工作目录，数据集和输出都在其中
+    run = RunWorkspace.create("aml_report")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # 检查参数
@@ -575,48 +809,31 @@ async def aml_report_upload(
     has_url = file_url is not None and file_url.strip() != ""
     
     if not has_file and not has_url:
+        run.cleanup()
         raise HTTPException(status_code=400, detail="必须提供文件上传或文件URL")
     
     try:
         # 根据提供的参数类型处理文件
         if has_file:
             # 直接上传文件的情况
-            zip_filename = f"{workspace}/{timestamp}_{file.filename}"
-            with open(zip_filename, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            zip_filename = await save_upload(run, file)
             logger.info(f"已保存上传的文件: {zip_filename}")
         elif has_url:
-            # 从URL下载文件的情况
-            import requests
-            from urllib.parse import urlparse
-            
-            # 从URL中提取文件名
-            parsed_url = urlparse(file_url)
-            url_path = parsed_url.path
-            file_name = os.path.basename(url_path) or f"dataset_{timestamp}.zip"
-            
-            zip_filename = f"{workspace}/{timestamp}_{file_name}"
-            
-            # 下载文件
-            logger.info(f"从URL下载文件: {file_url}")
-            response = requests.get(file_url, stream=True)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"无法从URL下载文件，状态码: {response.status_code}")
-            
-            with open(zip_filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            logger.info(f"已下载文件: {zip_filename}")
+            # 从URL下载文件的情况，未变化的文件直接使用缓存
+            zip_filename = await download_dataset(run, file_url, timestamp)
         else:
             raise HTTPException(status_code=400, detail="无效的参数组合")
         
         task_name = "aml_report"
         task_config = {
-            "prompt": get_aml_report_prompt(workspace=workspace, 
-                                           input_dir=zip_filename),
+            "prompt": get_aml_report_prompt(workspace=run.root, 
+                                           input_dir=zip_filename,
+                                           output_dir=str(run.temp_dir)),
             "outputs": [
-                {"name": "report", "file": f"{WORKSPACE_ROOT}/temp/aml_report.md"}
+                {"name": "report", "file": run.path("temp", "aml_report.md")}
             ],
+            # 流程固定的多步任务使用计划-执行模式
+            "agent_mode": "plan",
             "server_config": [
                 {
                     "connection_type": "stdio",
@@ -637,18 +854,21 @@ async def aml_report_upload(
         
         agent_name = "AML Report Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [zip_filename]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理上传文件时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if 'zip_filename' in locals() and os.path.exists(zip_filename):
-            os.remove(zip_filename)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
 
 class ServerConfig(BaseModel):
@@ -695,11 +915,8 @@ async def service_evaluation(
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含评测结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名
+    # 每次运行使用独立的工作目录，数据集和输出都在其中
+    run = RunWorkspace.create("service_evaluation")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # 检查参数
@@ -707,6 +924,7 @@ async def service_evaluation(
     has_url = file_url is not None and file_url.strip() != ""
     
     if not has_file and not has_url:
+        run.cleanup()
         raise HTTPException(status_code=400, detail="必须提供文件上传或文件URL")
     
     try:
@@ -730,41 +948,21 @@ async def service_evaluation(
         # 根据提供的参数类型处理文件
         if has_file:
             # 直接上传文件的情况
-            zip_filename = f"{workspace}/{timestamp}_{data_file.filename}"
-            with open(zip_filename, "wb") as buffer:
-                shutil.copyfileobj(data_file.file, buffer)
+            zip_filename = await save_upload(run, data_file)
             logger.info(f"已保存上传的文件: {zip_filename}")
         elif has_url:
-            # 从URL下载文件的情况
-            import requests
-            from urllib.parse import urlparse
-            
-            # 从URL中提取文件名
-            parsed_url = urlparse(file_url)
-            url_path = parsed_url.path
-            file_name = os.path.basename(url_path) or f"dataset_{timestamp}.zip"
-            
-            zip_filename = f"{workspace}/{timestamp}_{file_name}"
-            
-            # 下载文件
-            logger.info(f"从URL下载文件: {file_url}")
-            response = requests.get(file_url, stream=True)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"无法从URL下载文件，状态码: {response.status_code}")
-            
-            with open(zip_filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            logger.info(f"已下载文件: {zip_filename}")
+            # 从URL下载文件的情况，未变化的文件直接使用缓存
+            zip_filename = await download_dataset(run, file_url, timestamp)
         else:
             raise HTTPException(status_code=400, detail="无效的参数组合")
 
         # 创建评测任务的prompt
-        prompt = get_service_evaluation_prompt(service_name, metrics_list, zip_filename)
+        prompt = get_service_evaluation_prompt(service_name, metrics_list, zip_filename,
+                                               output_dir=str(run.temp_dir))
         logger.info(f"评测任务的prompt: {prompt}")
         # 评测任务配置
         task_name = "service_evaluation"
-        output_file = f"{WORKSPACE_ROOT}/temp/evaluation_result.json"
+        output_file = run.path("temp", "evaluation_result.json")
         task_config = {
             "prompt": prompt,
             "outputs": [
@@ -781,21 +979,24 @@ async def service_evaluation(
         
         agent_name = "服务评测Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [zip_filename, output_file]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
     except json.JSONDecodeError:
         logger.error(f"无效的JSON格式指标: {metrics}")
         raise HTTPException(status_code=400, detail="指标必须是有效的JSON格式数组")
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理服务评测请求时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if 'zip_filename' in locals() and os.path.exists(zip_filename):
-            os.remove(zip_filename)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理评测请求时出错: {str(e)}")
 
 class MetaAppValidationRequest(BaseModel):
@@ -827,11 +1028,8 @@ async def meta_app_validation(
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含评测结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名
+    # 每次运行使用独立的工作目录，数据集和输出都在其中
+    run = RunWorkspace.create("meta_app_validation")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # 检查参数
@@ -839,6 +1037,7 @@ async def meta_app_validation(
     has_url = file_url is not None and file_url.strip() != ""
     
     if not has_file and not has_url:
+        run.cleanup()
         raise HTTPException(status_code=400, detail="必须提供文件上传或文件URL")
     
     try:
@@ -862,42 +1061,22 @@ async def meta_app_validation(
         # 根据提供的参数类型处理文件
         if has_file:
             # 直接上传文件的情况
-            zip_filename = f"{workspace}/{timestamp}_{data_file.filename}"
-            with open(zip_filename, "wb") as buffer:
-                shutil.copyfileobj(data_file.file, buffer)
+            zip_filename = await save_upload(run, data_file)
             logger.info(f"已保存上传的文件: {zip_filename}")
         elif has_url:
-            # 从URL下载文件的情况
-            import requests
-            from urllib.parse import urlparse
-            
-            # 从URL中提取文件名
-            parsed_url = urlparse(file_url)
-            url_path = parsed_url.path
-            file_name = os.path.basename(url_path) or f"dataset_{timestamp}.zip"
-            
-            zip_filename = f"{workspace}/{timestamp}_{file_name}"
-            
-            # 下载文件
-            logger.info(f"从URL下载文件: {file_url}")
-            response = requests.get(file_url, stream=True)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"无法从URL下载文件，状态码: {response.status_code}")
-            
-            with open(zip_filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            logger.info(f"已下载文件: {zip_filename}")
+            # 从URL下载文件的情况，未变化的文件直接使用缓存
+            zip_filename = await download_dataset(run, file_url, timestamp)
         else:
             raise HTTPException(status_code=400, detail="无效的参数组合")
 
         # 创建评测任务的prompt
-        prompt = get_meta_app_validation_prompt(meta_app_api, metrics_list, zip_filename)
+        prompt = get_meta_app_validation_prompt(meta_app_api, metrics_list, zip_filename,
+                                                output_dir=str(run.temp_dir))
         logger.info(f"元应用数据验证任务的prompt: {prompt}")
         
         # 评测任务配置
         task_name = "meta_app_validation"
-        output_file = f"{WORKSPACE_ROOT}/temp/validation_result.json"
+        output_file = run.path("temp", "validation_result.json")
         task_config = {
             "prompt": prompt,
             "outputs": [
@@ -910,21 +1089,24 @@ async def meta_app_validation(
         
         agent_name = "元应用数据验证Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [zip_filename, output_file]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
     except json.JSONDecodeError:
         logger.error(f"无效的JSON格式指标: {metrics}")
         raise HTTPException(status_code=400, detail="指标必须是有效的JSON格式数组")
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理元应用数据验证请求时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if 'zip_filename' in locals() and os.path.exists(zip_filename):
-            os.remove(zip_filename)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理元应用数据验证请求时出错: {str(e)}")
 
 # 反洗钱模型评估
@@ -951,11 +1133,8 @@ async def aml_model_evaluation(
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含评测结果
     """
-    # 确保temp目录存在
-    workspace = Path(f"{WORKSPACE_ROOT}")
-    workspace.mkdir(parents=True, exist_ok=True)
-    
-    # 生成唯一的文件名
+    # 每次运行使用独立的工作目录，数据集和输出都在其中
+    run = RunWorkspace.create("aml_model_evaluation")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # 检查参数
@@ -963,6 +1142,7 @@ async def aml_model_evaluation(
     has_url = file_url is not None and file_url.strip() != ""
     
     if not has_file and not has_url:
+        run.cleanup()
         raise HTTPException(status_code=400, detail="必须提供文件上传或文件URL")
     
     try:
@@ -986,42 +1166,22 @@ async def aml_model_evaluation(
         # 根据提供的参数类型处理文件
         if has_file:
             # 直接上传文件的情况
-            zip_filename = f"{workspace}/{timestamp}_{data_file.filename}"
-            with open(zip_filename, "wb") as buffer:
-                shutil.copyfileobj(data_file.file, buffer)
+            zip_filename = await save_upload(run, data_file)
             logger.info(f"已保存上传的文件: {zip_filename}")
         elif has_url:
-            # 从URL下载文件的情况
-            import requests
-            from urllib.parse import urlparse
-            
-            # 从URL中提取文件名
-            parsed_url = urlparse(file_url)
-            url_path = parsed_url.path
-            file_name = os.path.basename(url_path) or f"dataset_{timestamp}.zip"
-            
-            zip_filename = f"{workspace}/{timestamp}_{file_name}"
-            
-            # 下载文件
-            logger.info(f"从URL下载文件: {file_url}")
-            response = requests.get(file_url, stream=True)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"无法从URL下载文件，状态码: {response.status_code}")
-            
-            with open(zip_filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            logger.info(f"已下载文件: {zip_filename}")
+            # 从URL下载文件的情况，未变化的文件直接使用缓存
+            zip_filename = await download_dataset(run, file_url, timestamp)
         else:
             raise HTTPException(status_code=400, detail="无效的参数组合")
 
         # 创建评测任务的prompt
-        prompt = get_aml_model_evaluation_prompt(model_name, zip_filename, metrics_list)
+        prompt = get_aml_model_evaluation_prompt(model_name, zip_filename, metrics_list,
+                                                 output_dir=str(run.temp_dir))
         logger.info(f"AML模型技术评测任务的prompt: {prompt}")
         
         # 评测任务配置
         task_name = "aml_model_evaluation"
-        output_file = f"{WORKSPACE_ROOT}/temp/model_evaluation_result.json"
+        output_file = run.path("temp", "model_evaluation_result.json")
         task_config = {
             "prompt": prompt,
             "outputs": [
@@ -1039,21 +1199,24 @@ async def aml_model_evaluation(
         
         agent_name = "AML模型技术评测Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [zip_filename, output_file]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
     except json.JSONDecodeError:
         logger.error(f"无效的JSON格式指标: {metrics}")
         raise HTTPException(status_code=400, detail="指标必须是有效的JSON格式数组")
+    except UploadTooLarge as e:
+        run.cleanup()
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        # 下载失败等已确定状态码的错误原样返回，不改写为500
+        run.cleanup()
+        raise
     except Exception as e:
         logger.error(f"处理AML模型技术评测请求时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if 'zip_filename' in locals() and os.path.exists(zip_filename):
-            os.remove(zip_filename)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理AML模型技术评测请求时出错: {str(e)}")
 
 # MCP服务推荐
@@ -1073,14 +1236,18 @@ async def mcp_service_recommendation(
         流式SSE响应，每个step完成后返回一个事件
         最后一个事件包含推荐结果
     """
+    # 每次运行使用独立的工作目录，并发请求互不影响
+    run = RunWorkspace.create("mcp_service_recommendation")
+
     try:
         # 创建推荐任务的prompt
-        prompt = get_mcp_service_recommendation_prompt(message, service_type)
+        prompt = get_mcp_service_recommendation_prompt(message, service_type,
+                                                       output_dir=str(run.temp_dir))
         logger.info(f"MCP服务推荐任务的prompt: {prompt}")
         
         # 任务配置
         task_name = "mcp_service_recommendation"
-        output_file = f"{WORKSPACE_ROOT}/temp/mcp_recommendation_result.json"
+        output_file = run.path("temp", "mcp_recommendation_result.json")
         task_config = {
             "prompt": prompt,
             "outputs": [
@@ -1099,20 +1266,87 @@ async def mcp_service_recommendation(
         
         agent_name = "MCP服务推荐Agent"
         
-        # 设置需要清理的文件列表
-        cleanup_files = [output_file]
-        
-        # 使用通用生成器创建流式响应
-        stream_generator = create_stream_generator(task_name, task_config, agent_name, cleanup_files)
+        # 使用通用生成器创建流式响应，运行结束后删除运行目录
+        stream_generator = create_stream_generator(task_name, task_config, agent_name, run=run)
         return create_streaming_response(stream_generator)
     
     except Exception as e:
         logger.error(f"处理MCP服务推荐请求时出错: {str(e)}", exc_info=True)
         # 确保清理临时文件
-        if 'output_file' in locals() and os.path.exists(output_file):
-            os.remove(output_file)
+        run.cleanup()
         raise HTTPException(status_code=500, detail=f"处理推荐请求时出错: {str(e)}")
 
+# LLM运行指标
+@app.get("/api/metrics/llm", tags=["metrics"])
+async def llm_metrics():
+    """
+    返回各LLM配置的限速器使用率、排队情况和响应缓存命中率
+    """
+    return LLM.metrics()
+
+@app.get("/api/metrics/agent_pool", tags=["metrics"])
+async def agent_pool_metrics():
+    """
+    返回各智能体池的大小、空闲数和租用等待时间
+    """
+    return {mode: pool.stats() for mode, pool in agent_pools.items()}
+
+@app.get("/api/metrics/mcp", tags=["metrics"])
+async def mcp_metrics():
+    """
+    返回共享MCP会话池的命中率、连接数和重连次数
+    """
+    return MCPSessionPool.shared().stats()
+
+@app.get("/api/metrics/mcp/leaks", tags=["metrics"])
+async def mcp_leak_report():
+    """
+    返回存活的MCP会话和服务器子进程、累计的打开/关闭/回收次数以及进程打开的文件描述符数
+    """
+    return MCPLifecycleManager.shared().leak_report()
+
+@app.get("/api/metrics/mcp/calls", tags=["metrics"])
+async def mcp_call_metrics():
+    """
+    返回各MCP服务器工具调用的延迟分位数、超时和失败次数以及熔断器状态
+    """
+    return MCPCallGuards.shared().stats()
+
+@app.get("/api/metrics/admission", tags=["metrics"])
+async def admission_metrics():
+    """
+    返回运行中和排队的任务数、排队等待时间分位数、拒绝次数和平均运行耗时
+    """
+    return admission.stats()
+
+@app.get("/api/metrics/jobs", tags=["metrics"])
+async def job_metrics():
+    """
+    返回后台任务队列的工作协程数、排队和运行中的任务数以及拒绝次数
+    """
+    return job_queue.stats()
+
+@app.get("/api/metrics/workspace", tags=["metrics"])
+async def workspace_metrics():
+    """
+    返回正在使用的运行目录数以及过期运行目录的清理次数
+    """
+    return workspace_janitor.stats()
+
+@app.get("/api/metrics/datasets", tags=["metrics"])
+async def dataset_metrics():
+    """
+    返回数据集存储的去重次数和字节数以及解压缓存的命中率
+    """
+    return dataset_store.stats()
+
+@app.get("/api/metrics/downloads", tags=["metrics"])
+async def download_metrics():
+    """
+    返回数据集下载次数、缓存命中次数、分段下载和断点续传次数以及下载字节数
+    """
+    return dataset_downloader.stats()
+
 # 启动应用
 if __name__ == "__main__":
     import uvicorn
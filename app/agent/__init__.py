@@ -1,5 +1,6 @@
 from app.agent.base import BaseAgent
 from app.agent.mcp import MCPAgent
+from app.agent.plan import PlanExecuteAgent
 from app.agent.react import ReActAgent
 from app.agent.toolcall import ToolCallAgent
 
@@ -9,4 +10,5 @@ __all__ = [
     "ReActAgent",
     "ToolCallAgent",
     "MCPAgent",
+    "PlanExecuteAgent",
 ]
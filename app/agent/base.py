@@ -169,6 +169,18 @@ class BaseAgent(BaseModel, ABC):
         self._results = results
         return results if results else []
 
+    def reset(self) -> None:
+        """Clear per-run state so the agent can serve a new request.
+
+        Memory, state, step counter and the next step prompt (which may have
+        been extended by handle_stuck_state) return to their initial values.
+        """
+        self.memory = Memory()
+        self.state = AgentState.IDLE
+        self.current_step = 0
+        self.next_step_prompt = type(self).model_fields["next_step_prompt"].default
+        self._results = []
+
     @abstractmethod
     async def step(self) -> Dict[str, str]:
         """Execute a single step in the agent's workflow.
@@ -1,7 +1,9 @@
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 import asyncio
+import hashlib
+import json
 
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 
 from app.agent.toolcall import ToolCallAgent
 from app.logger import logger
@@ -36,7 +38,11 @@ class MCPAgent(ToolCallAgent):
 
     # 跟踪工具模式以检测变化
     tool_schemas: Dict[str, Dict[str, Any]] = Field(default_factory=dict)
-    _refresh_tools_interval: int = 5  # 每N步刷新工具列表
+    _refresh_tools_interval: int = 5  # 不支持变更通知的服务器每N步轮询一次
+    _server_tools: Dict[str, List[str]] = PrivateAttr(default_factory=dict)
+    _schema_hashes: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _dirty_servers: Set[str] = PrivateAttr(default_factory=set)
+    _tool_listeners: Dict[str, Callable[[], None]] = PrivateAttr(default_factory=dict)
 
     # 应触发终止的特殊工具名称
     special_tool_names: List[str] = Field(default_factory=lambda: ["terminate"])
@@ -58,6 +64,40 @@ class MCPAgent(ToolCallAgent):
             args: 命令的参数(用于stdio连接)
             server_id: 服务器的唯一标识符
 
+        返回:
+            str: 服务器ID
+        """
+        server_id = await self._open_connection(
+            connection_type=connection_type,
+            server_url=server_url,
+            command=command,
+            args=args,
+            server_id=server_id,
+        )
+
+        # 将available_tools设置为我们的MCP实例
+        self.available_tools = self.mcp_clients
+        
+        # 添加到已连接服务器列表
+        if server_id not in self.connected_servers:
+            self.connected_servers.append(server_id)
+
+        # 存储初始工具模式
+        await self._refresh_tools()
+
+        logger.info(f"已成功连接到MCP服务器: {server_id}")
+        return server_id
+        
+    async def _open_connection(
+        self,
+        connection_type: Optional[str] = None,
+        server_url: Optional[str] = None,
+        command: Optional[str] = None,
+        args: Optional[List[str]] = None,
+        server_id: Optional[str] = None,
+    ) -> str:
+        """校验参数并建立到MCP服务器的连接，不刷新工具模式
+
         返回:
             str: 服务器ID
         """
@@ -99,37 +139,84 @@ class MCPAgent(ToolCallAgent):
         else:
             raise ValueError(f"不支持的连接类型: {connection_type}")
 
-        # 将available_tools设置为我们的MCP实例
-        self.available_tools = self.mcp_clients
-        
-        # 添加到已连接服务器列表
-        if server_id not in self.connected_servers:
-            self.connected_servers.append(server_id)
+        return server_id
 
-        # 存储初始工具模式
-        await self._refresh_tools()
+    async def add_servers(
+        self, server_configs: List[Dict[str, Any]], timeout: Optional[float] = None
+    ) -> List[Tuple[str, Optional[Exception]]]:
+        """并发连接多个MCP服务器
 
-        # 添加关于可用工具的系统消息
-        self._update_available_tools_message()
-        
-        logger.info(f"已成功连接到MCP服务器: {server_id}")
-        return server_id
-        
-    def _update_available_tools_message(self) -> None:
-        """更新系统消息中的可用工具列表"""
-        tool_names = list(self.mcp_clients.tool_map.keys())
-        tools_info = ", ".join(tool_names)
-        
-        # 添加或更新系统提示和可用工具信息
-        tools_message = f"{self.system_prompt}\n\n可用的MCP工具: {tools_info}"
-        
-        # 检查是否已有系统消息
-        if self.memory.messages and self.memory.messages[0].role == "system":
-            # 更新现有的系统消息
-            self.memory.messages[0].content = tools_message
-        else:
-            # 添加新的系统消息
-            self.memory.add_message(Message.system_message(tools_message))
+        每个服务器的握手、initialize和list_tools并发进行，单个服务器失败或超时
+        不影响其他服务器。无论完成顺序如何，工具都按server_configs的顺序注册。
+
+        参数:
+            server_configs: 服务器配置列表，字段与initialize的参数相同
+            timeout: 每个服务器的连接超时（秒），None表示使用config.mcp.connect_timeout
+
+        返回:
+            按配置顺序排列的(服务器ID, 异常)列表，连接成功的服务器异常为None
+        """
+        if timeout is None:
+            from app.config import config
+
+            timeout = config.mcp.connect_timeout
+
+        # 预先分配服务器ID，避免并发连接时自动生成的ID冲突
+        configs = []
+        for index, server in enumerate(server_configs):
+            server = dict(server)
+            connection_type = server.get("connection_type") or self.default_connection_type
+            server["connection_type"] = connection_type
+            server["server_id"] = server.get("server_id") or (
+                f"{connection_type}_{len(self.mcp_clients.sessions) + index}"
+            )
+            configs.append(server)
+
+        async def connect(server: Dict[str, Any]) -> str:
+            return await asyncio.wait_for(
+                self._open_connection(
+                    connection_type=server["connection_type"],
+                    server_url=server.get("server_url"),
+                    command=server.get("command"),
+                    args=server.get("args"),
+                    server_id=server["server_id"],
+                ),
+                timeout,
+            )
+
+        outcomes = await asyncio.gather(
+            *(connect(server) for server in configs), return_exceptions=True
+        )
+
+        results: List[Tuple[str, Optional[Exception]]] = []
+        for server, outcome in zip(configs, outcomes):
+            server_id = server["server_id"]
+            if isinstance(outcome, BaseException):
+                if isinstance(outcome, asyncio.TimeoutError):
+                    outcome = TimeoutError(f"连接超时（{timeout}秒）")
+                logger.error(f"连接MCP服务器 {server_id} 失败: {str(outcome)}")
+                results.append((server_id, outcome))
+                continue
+            results.append((server_id, None))
+            if server_id not in self.connected_servers:
+                self.connected_servers.append(server_id)
+
+        if any(error is None for _, error in results):
+            self.mcp_clients.reorder_tools(self.connected_servers)
+            self.available_tools = self.mcp_clients
+            await self._refresh_tools()
+        return results
+
+    def system_messages(self) -> List[Message]:
+        """系统提示和可用工具列表，作为每次请求的固定前缀
+
+        工具名排序后拼接，工具集不变时前缀逐字节不变，不写入记忆，
+        以便服务端的提示词缓存在各步之间复用。
+        """
+        tools_info = ", ".join(sorted(self.mcp_clients.tool_map.keys()))
+        return [
+            Message.system_message(f"{self.system_prompt}\n\n可用的MCP工具: {tools_info}")
+        ]
 
     async def connect_additional_server(
         self,
@@ -173,21 +260,71 @@ class MCPAgent(ToolCallAgent):
             bool: 断开连接是否成功
         """
         if server_id in self.connected_servers:
+            self._unwatch_server(server_id)
             await self.mcp_clients.disconnect(server_id)
             self.connected_servers.remove(server_id)
             
-            # 更新工具信息
-            self._update_available_tools_message()
-            
             logger.info(f"已断开与MCP服务器的连接: {server_id}")
             return True
         
         logger.warning(f"尝试断开未连接的服务器: {server_id}")
         return False
 
-    async def _refresh_tools(self) -> Tuple[List[str], List[str]]:
+    def _watch_server(self, server_id: str) -> None:
+        """订阅服务器的tools/list_changed通知，收到后在下一步只刷新该服务器"""
+        session = self.mcp_clients.sessions.get(server_id)
+        if session is None or server_id in self._tool_listeners:
+            return
+        if hasattr(session, "add_tools_changed_listener"):
+            listener = lambda: self._dirty_servers.add(server_id)
+            session.add_tools_changed_listener(listener)
+            self._tool_listeners[server_id] = listener
+
+    def _unwatch_server(self, server_id: str) -> None:
+        """取消订阅并清除该服务器的工具模式记录"""
+        listener = self._tool_listeners.pop(server_id, None)
+        session = self.mcp_clients.sessions.get(server_id)
+        if listener and session is not None and hasattr(session, "remove_tools_changed_listener"):
+            session.remove_tools_changed_listener(listener)
+        self._dirty_servers.discard(server_id)
+        self._schema_hashes.pop(server_id, None)
+        for name in self._server_tools.pop(server_id, []):
+            self.tool_schemas.pop(name, None)
+
+    def _servers_to_refresh(self) -> List[str]:
+        """本步需要刷新的服务器：收到变更通知的服务器，以及按间隔轮询不支持通知的服务器"""
+        servers = set(self._dirty_servers)
+        if self.current_step % self._refresh_tools_interval == 0:
+            servers.update(
+                server_id
+                for server_id in self.connected_servers
+                if not getattr(
+                    self.mcp_clients.sessions.get(server_id), "supports_tool_notifications", False
+                )
+            )
+        return [s for s in self.connected_servers if s in servers]
+
+    @staticmethod
+    def _hash_tools(tools) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                [[t.name, t.description, t.inputSchema] for t in tools],
+                sort_keys=True,
+                ensure_ascii=False,
+            ).encode()
+        ).hexdigest()
+
+    async def _refresh_tools(
+        self, server_ids: Optional[List[str]] = None
+    ) -> Tuple[List[str], List[str]]:
         """从MCP服务器刷新可用工具列表。
 
+        并发请求各服务器的list_tools，工具模式哈希未变化的服务器直接跳过，
+        变化的服务器同步更新MCPClients中的工具。
+
+        参数:
+            server_ids: 要刷新的服务器，None表示所有已连接的服务器
+
         返回:
             (added_tools, removed_tools)元组
         """
@@ -195,52 +332,55 @@ class MCPAgent(ToolCallAgent):
         if not self.mcp_clients.sessions:
             return [], []
 
-        # 获取当前所有工具
-        current_tools = {}
-        for server_id in self.connected_servers:
-            session = self.mcp_clients.sessions.get(server_id)
-            if not session:
+        server_ids = [
+            s for s in (server_ids or self.connected_servers) if s in self.mcp_clients.sessions
+        ]
+        for server_id in server_ids:
+            self._dirty_servers.discard(server_id)
+        responses = await asyncio.gather(
+            *(self.mcp_clients.sessions[s].list_tools() for s in server_ids),
+            return_exceptions=True,
+        )
+
+        added_tools, removed_tools, changed_tools = [], [], []
+        for server_id, response in zip(server_ids, responses):
+            if isinstance(response, BaseException):
+                logger.warning(f"从服务器 {server_id} 获取工具时出错: {str(response)}")
                 continue
-                
-            # 从服务器获取工具
-            try:
-                response = await session.list_tools()
-                # 使用服务器ID前缀工具名，用下划线替代点号
-                for tool in response.tools:
-                    prefixed_name = f"{server_id}_{tool.name}"
-                    current_tools[prefixed_name] = tool.inputSchema
-            except Exception as e:
-                logger.warning(f"从服务器 {server_id} 获取工具时出错: {str(e)}")
-
-        # 确定添加、移除和更改的工具
-        current_names = set(current_tools.keys())
-        previous_names = set(self.tool_schemas.keys())
-
-        added_tools = list(current_names - previous_names)
-        removed_tools = list(previous_names - current_names)
-
-        # 检查现有工具的模式变化
-        changed_tools = []
-        for name in current_names.intersection(previous_names):
-            if current_tools[name] != self.tool_schemas.get(name):
-                changed_tools.append(name)
-
-        # 更新存储的模式
-        self.tool_schemas = current_tools
-
-        # 记录并通知变化
+            self._watch_server(server_id)
+
+            schema_hash = self._hash_tools(response.tools)
+            if self._schema_hashes.get(server_id) == schema_hash:
+                continue
+            self._schema_hashes[server_id] = schema_hash
+
+            # 使用服务器ID前缀工具名，用下划线替代点号
+            current = {f"{server_id}_{t.name}": t.inputSchema for t in response.tools}
+            previous = {
+                name: self.tool_schemas[name]
+                for name in self._server_tools.get(server_id, [])
+                if name in self.tool_schemas
+            }
+            added_tools += [n for n in current if n not in previous]
+            removed_tools += [n for n in previous if n not in current]
+            changed_tools += [
+                n for n in current if n in previous and current[n] != previous[n]
+            ]
+
+            # 更新存储的模式
+            for name in previous:
+                self.tool_schemas.pop(name, None)
+            self.tool_schemas.update(current)
+            self._server_tools[server_id] = list(current)
+            self.mcp_clients.sync_server_tools(server_id, response.tools)
+
+        # 记录并通知变化，通知只附加到下一次请求中，不插入历史消息
         if added_tools:
             logger.info(f"添加了MCP工具: {added_tools}")
-            self.memory.add_message(
-                Message.system_message(f"新可用工具: {', '.join(added_tools)}")
-            )
+            self.add_notice(f"新可用工具: {', '.join(added_tools)}")
         if removed_tools:
             logger.info(f"移除了MCP工具: {removed_tools}")
-            self.memory.add_message(
-                Message.system_message(
-                    f"不再可用的工具: {', '.join(removed_tools)}"
-                )
-            )
+            self.add_notice(f"不再可用的工具: {', '.join(removed_tools)}")
         if changed_tools:
             logger.info(f"更改了MCP工具: {changed_tools}")
 
@@ -254,9 +394,10 @@ class MCPAgent(ToolCallAgent):
             self.state = AgentState.FINISHED
             return False
 
-        # 定期刷新工具
-        if self.current_step % self._refresh_tools_interval == 0:
-            await self._refresh_tools()
+        # 只刷新收到变更通知的服务器，不支持通知的服务器按间隔并发轮询
+        servers = self._servers_to_refresh()
+        if servers:
+            await self._refresh_tools(servers)
             # 所有工具被移除表示关闭
             if not self.mcp_clients.tool_map:
                 logger.info("所有MCP服务已关闭，结束交互")
@@ -273,11 +414,7 @@ class MCPAgent(ToolCallAgent):
 
         # 处理多媒体响应
         if isinstance(result, ToolResult) and result.base64_image:
-            self.memory.add_message(
-                Message.system_message(
-                    MULTIMEDIA_RESPONSE_PROMPT.format(tool_name=name)
-                )
-            )
+            self.add_notice(MULTIMEDIA_RESPONSE_PROMPT.format(tool_name=name))
             
         # 特别处理terminate工具
         if name.lower() == "terminate" or name.endswith("_terminate"):
@@ -289,6 +426,14 @@ class MCPAgent(ToolCallAgent):
             # 立即标记为已完成，确保清理过程能够正确执行
             self.state = AgentState.FINISHED
 
+    def _is_special_tool(self, name: str) -> bool:
+        """特殊工具的名称可能带有服务器ID前缀，例如stdio_built_in_terminate"""
+        lowered = name.lower()
+        return any(
+            lowered == n.lower() or lowered.endswith(f"_{n.lower()}")
+            for n in self.special_tool_names
+        )
+
     def _should_finish_execution(self, name: str, **kwargs) -> bool:
         """确定工具执行是否应该结束智能体"""
         # 如果工具名称是'terminate'则终止（无论是原始名称还是带服务器ID前缀的名称）
@@ -299,63 +444,36 @@ class MCPAgent(ToolCallAgent):
         return False
 
     async def cleanup(self) -> None:
-        """完成后清理所有MCP连接。"""
+        """完成后清理所有MCP连接。
+
+        各服务器并发断开，独占连接在各自的时限内关闭并回收子进程，
+        返回时所有连接都已关闭。
+        """
         # 如果没有连接服务器，则无需清理
-        if not hasattr(self, 'connected_servers') or not self.connected_servers:
+        if not self.connected_servers:
             return
-            
-        try:
-            # 先保存引用，这样即使在断开连接过程中出错，也能清空connected_servers
-            servers_to_disconnect = list(self.connected_servers)
-            server_count = len(servers_to_disconnect)
-            
-            # 防止重复清理 - 先清空连接列表
-            self.connected_servers = []
-            
-            if not servers_to_disconnect or not hasattr(self, 'mcp_clients') or not self.mcp_clients:
-                return
-                
-            logger.info(f"开始安全清理与 {server_count} 个服务器的连接")
-            
-            # 创建一个新的任务来断开连接，不等待其完成
-            async def detached_cleanup():
-                try:
-                    for server_id in servers_to_disconnect:
-                        try:
-                            logger.info(f"正在断开服务器 {server_id} 的连接")
-                            
-                            # 直接调用MCPClients的disconnect方法
-                            if hasattr(self.mcp_clients, 'disconnect'):
-                                await self.mcp_clients.disconnect(server_id)
-                                
-                            logger.info(f"已安全断开服务器 {server_id} 的连接")
-                        except Exception as e:
-                            logger.error(f"断开服务器 {server_id} 连接时出错，但继续处理其他服务器: {str(e)}")
-                            # 继续处理其他服务器
-                            continue
-                except Exception as e:
-                    logger.error(f"清理过程中发生全局错误: {str(e)}")
-            
-            # 创建清理任务但不等待其完成，让主程序可以继续执行
-            asyncio.create_task(detached_cleanup())
-            
-            # 给清理任务一点时间开始处理
-            await asyncio.sleep(0.1)
-            
-            logger.info("清理过程已开始，程序可以安全退出")
-        except Exception as e:
-            logger.error(f"初始化清理过程时出错: {str(e)}")
-            # 确保列表被清空
-            self.connected_servers = []
+
+        # 防止重复清理 - 先清空连接列表
+        servers_to_disconnect = list(self.connected_servers)
+        self.connected_servers = []
+        logger.info(f"开始清理与 {len(servers_to_disconnect)} 个服务器的连接")
+
+        for server_id in servers_to_disconnect:
+            self._unwatch_server(server_id)
+        results = await asyncio.gather(
+            *(self.mcp_clients.disconnect(s) for s in servers_to_disconnect),
+            return_exceptions=True,
+        )
+        for server_id, result in zip(servers_to_disconnect, results):
+            if isinstance(result, Exception):
+                logger.error(f"断开服务器 {server_id} 连接时出错: {str(result)}")
+        logger.info("MCP连接已全部关闭")
 
     async def run(self, request: Optional[str] = None) -> List[str]:
         """运行智能体并在完成后进行清理。"""
-        cleanup_attempted = False
         try:
             # 强制刷新工具列表，确保所有工具都是最新的
             await self._refresh_tools()
-            # 更新工具消息
-            self._update_available_tools_message()
             
             # 运行智能体
             result = await super().run(request)
@@ -371,26 +489,8 @@ class MCPAgent(ToolCallAgent):
             self.state = AgentState.FINISHED
             raise
         finally:
-            # 确保即使出现错误也只尝试清理一次
-            if not cleanup_attempted:
-                cleanup_attempted = True
-                try:
-                    # 直接调用cleanup方法但不等待其完成
-                    # 这里不使用wait_for和shield，因为它们会导致cancel scope问题
-                    logger.info("开始后台清理资源...")
-                    
-                    # 使用一个分离的、完全独立的函数来启动清理
-                    async def run_detached_cleanup():
-                        try:
-                            await self.cleanup()
-                        except Exception as e:
-                            logger.error(f"分离的清理过程中出错: {str(e)}")
-                    
-                    # 创建任务但不等待其完成
-                    asyncio.create_task(run_detached_cleanup())
-                    
-                    # 确保不会有任何等待操作，直接返回
-                    logger.info("清理任务已在后台启动，主程序可以继续执行")
-                except Exception as cleanup_error:
-                    logger.error(f"启动清理任务时发生错误: {str(cleanup_error)}")
-                    # 错误已记录，但不重新抛出，让程序能继续执行
+            # 连接由各自的后台任务持有，在这里等待关闭不会跨任务退出取消作用域
+            try:
+                await self.cleanup()
+            except Exception as cleanup_error:
+                logger.error(f"清理资源时发生错误: {str(cleanup_error)}")
@@ -0,0 +1,193 @@
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+from pydantic import PrivateAttr
+
+from app.agent.mcp import MCPAgent
+from app.logger import logger
+from app.prompt.plan import NEXT_STEP_PROMPT, SYSTEM_PROMPT
+from app.schema import AgentState, Message, ToolCall
+from app.tool.submit_plan import SubmitPlan
+
+
+# {{step_id}} 或 {{step_id.field.0}} 形式的步骤输出引用
+_REFERENCE = re.compile(r"\{\{\s*([\w-]+)((?:\.[\w-]+)*)\s*\}\}")
+
+# 智能体在同一轮中已经结束时，剩余工具调用的结果
+SKIPPED_AFTER_FINISH = "已跳过：智能体已经结束"
+
+
+class PlanExecuteAgent(MCPAgent):
+    """计划-执行模式的MCP智能体。
+
+    LLM通过submit_plan一次提交多步工具调用计划，运行时在本地按顺序执行，
+    步骤之间可以通过{{step_id}}传递输出。只有在某一步失败或到达分支点
+    (replan_after)时才重新询问LLM，从而大幅减少每个任务的LLM往返次数。
+    LLM直接调用普通工具时按MCPAgent的方式逐步执行。
+    """
+
+    name: str = "plan_execute_agent"
+    description: str = "先规划多步工具调用、再在本地批量执行的MCP智能体。"
+
+    system_prompt: str = SYSTEM_PROMPT
+    next_step_prompt: str = NEXT_STEP_PROMPT
+
+    # 运行指标
+    llm_round_trips: int = 0
+    executed_tool_calls: int = 0
+
+    _plan_tool: SubmitPlan = PrivateAttr(default_factory=SubmitPlan)
+    _plan_tool_tokens: int = PrivateAttr(default=0)
+
+    def reset(self) -> None:
+        super().reset()
+        self.llm_round_trips = 0
+        self.executed_tool_calls = 0
+
+    def tool_params(self) -> List[dict]:
+        """在服务器工具之外附加submit_plan"""
+        return [*super().tool_params(), self._plan_tool.to_param()]
+
+    def tool_params_tokens(self) -> int:
+        if not self._plan_tool_tokens:
+            self._plan_tool_tokens = self.llm.count_tokens(str(self._plan_tool.to_param()))
+        return super().tool_params_tokens() + self._plan_tool_tokens
+
+    async def think(self):
+        self.llm_round_trips += 1
+        return await super().think()
+
+    async def act(self) -> str:
+        """按LLM给出的顺序执行工具调用，submit_plan调用执行整个计划
+
+        每个调用都会得到一条工具消息，否则请求中会留下没有结果的tool_call_id；
+        智能体结束后剩余的调用不再执行，只记录跳过。
+        """
+        if not any(c.function.name == self._plan_tool.name for c in self.tool_calls):
+            return await super().act()
+
+        self._cancel_dispatched()
+        results = []
+        for command in self.tool_calls:
+            if self.state == AgentState.FINISHED:
+                results.append(self._commit_tool_result(command, SKIPPED_AFTER_FINISH))
+            elif command.function.name == self._plan_tool.name:
+                # 计划的执行记录中每一步已按max_observe截断，不再整体截断
+                result = await self._run_plan_call(command)
+                self.memory.add_message(
+                    Message.tool_message(
+                        content=result,
+                        tool_call_id=command.id,
+                        name=command.function.name,
+                    )
+                )
+                results.append(result)
+            else:
+                observation, base64_image = await self._run_tool(command)
+                results.append(self._commit_tool_result(command, observation, base64_image))
+
+        return "\n\n".join(results)
+
+    async def _run_plan_call(self, plan_call: ToolCall) -> str:
+        """解析并执行一次submit_plan调用，返回执行记录"""
+        try:
+            steps = json.loads(plan_call.function.arguments or "{}").get("steps")
+        except (json.JSONDecodeError, AttributeError):
+            return "Error: 计划参数不是有效的JSON对象"
+        if not isinstance(steps, list) or not steps:
+            return "Error: 计划中没有任何步骤"
+
+        logger.info(f"📋 {self.name} 提交了包含 {len(steps)} 个步骤的计划")
+        log, completed = await self.execute_plan(steps)
+        status = "计划执行结束" if completed else "计划执行失败，请根据以上结果重新规划"
+        return "\n".join([*log, status])
+
+    async def execute_plan(self, steps: List[dict]) -> Tuple[List[str], bool]:
+        """按顺序在本地执行计划步骤
+
+        返回:
+            (执行记录, 是否未出错)。遇到失败、分支点或智能体结束时提前停止。
+        """
+        outputs: Dict[str, Any] = {}
+        log: List[str] = []
+        for index, step in enumerate(steps):
+            if not isinstance(step, dict):
+                log.append(f"[step_{index + 1}] 失败: 步骤格式无效")
+                return log, False
+
+            step_id = str(step.get("id") or f"step_{index + 1}")
+            name = step.get("tool")
+            if name not in self.available_tools.tool_map:
+                log.append(f"[{step_id}] 失败: 未知工具 '{name}'")
+                return log, False
+
+            try:
+                args = self._resolve_references(step.get("args") or {}, outputs)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                log.append(f"[{step_id}] 失败: 无法解析对前面步骤输出的引用 {e}")
+                return log, False
+
+            logger.info(f"🔧 执行计划步骤 {step_id}: {name}")
+            try:
+                result = await self.available_tools.execute(name=name, tool_input=args)
+                await self._handle_special_tool(name=name, result=result)
+            except Exception as e:
+                logger.exception(f"计划步骤 {step_id} 执行出错")
+                log.append(f"[{step_id}] {name} 失败: {e}")
+                return log, False
+            self.executed_tool_calls += 1
+
+            error = getattr(result, "error", None)
+            output = getattr(result, "output", result)
+            if error:
+                log.append(f"[{step_id}] {name} 失败: {error}")
+                return log, False
+
+            outputs[step_id] = output
+            observation = str(output)
+            if self.max_observe:
+                observation = observation[: self.max_observe]
+            log.append(
+                f"[{step_id}] {name}({json.dumps(args, ensure_ascii=False)}) -> {observation}"
+            )
+
+            if self.state == AgentState.FINISHED:
+                break
+            if step.get("replan_after"):
+                log.append(f"[{step_id}] 是分支点，剩余步骤等待重新规划")
+                break
+        return log, True
+
+    @classmethod
+    def _resolve_references(cls, value: Any, outputs: Dict[str, Any]) -> Any:
+        """将参数中的{{step_id}}引用替换为对应步骤的输出"""
+        if isinstance(value, dict):
+            return {k: cls._resolve_references(v, outputs) for k, v in value.items()}
+        if isinstance(value, list):
+            return [cls._resolve_references(v, outputs) for v in value]
+        if not isinstance(value, str):
+            return value
+
+        # 整个参数就是一个引用时保留输出的原始结构
+        match = _REFERENCE.fullmatch(value.strip())
+        if match:
+            return cls._lookup(match, outputs)
+
+        def substitute(m: re.Match) -> str:
+            resolved = cls._lookup(m, outputs)
+            return resolved if isinstance(resolved, str) else json.dumps(
+                resolved, ensure_ascii=False
+            )
+
+        return _REFERENCE.sub(substitute, value)
+
+    @staticmethod
+    def _lookup(match: re.Match, outputs: Dict[str, Any]) -> Any:
+        step_id, path = match.group(1), match.group(2)
+        value = outputs[step_id]
+        for field in filter(None, path.split(".")):
+            if isinstance(value, str):
+                value = json.loads(value)
+            value = value[int(field)] if isinstance(value, list) else value[field]
+        return value
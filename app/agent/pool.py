@@ -0,0 +1,313 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set, Type
+
+from app.agent.mcp import MCPAgent
+from app.config import AgentPoolSettings
+from app.exceptions import AgentPoolExhausted
+from app.logger import logger
+
+
+# 池中每个智能体都会预先连接的内置MCP服务器
+BUILT_IN_SERVER = {
+    "connection_type": "stdio",
+    "server_url": None,
+    "command": None,
+    "args": None,
+    "server_id": "stdio_built_in",
+}
+
+
+class AgentPool:
+    """预先初始化的MCP智能体池
+
+    池中的智能体已连接基础服务器（默认是内置MCP服务器）并完成工具列表刷新，
+    请求处理时租用一个智能体，结束后归还。归还时断开请求期间额外连接的服务器，
+    并重置记忆、状态和步数，避免每个请求都重新创建智能体和刷新工具。
+    stdio基础服务器在进程中保存bash工作目录、环境变量、后台任务等状态，
+    归还时默认重新连接，下一个请求使用新的服务器进程。
+
+    用法:
+        agent = await pool.lease("Code Analysis Agent")
+        try:
+            ...
+        finally:
+            await pool.release(agent)
+    """
+
+    def __init__(
+        self,
+        agent_class: Type[MCPAgent] = MCPAgent,
+        settings: Optional[AgentPoolSettings] = None,
+        server_configs: Optional[List[Dict[str, Any]]] = None,
+        agent_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        参数:
+            agent_class: 池中智能体的类型
+            settings: 池的大小和健康检查配置
+            server_configs: 每个智能体预先连接的服务器，默认只有内置MCP服务器
+            agent_kwargs: 创建智能体时的额外参数
+        """
+        self.agent_class = agent_class
+        self.agent_kwargs = agent_kwargs or {}
+        self.settings = settings or AgentPoolSettings()
+        self.server_configs = [dict(c) for c in (server_configs or [BUILT_IN_SERVER])]
+
+        self._idle: List[MCPAgent] = []
+        self._leased: Set[int] = set()
+        self._size = 0  # 已创建或正在创建的智能体数
+        self._condition = asyncio.Condition()
+        self._health_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        self._created = 0
+        self._discarded = 0
+        self._leases = 0
+        self._wait_seconds = 0.0
+
+    @property
+    def base_server_ids(self) -> List[str]:
+        return [c["server_id"] for c in self.server_configs]
+
+    async def start(self) -> None:
+        """预热min_size个智能体并启动定期健康检查"""
+        await self._fill()
+        if self.settings.health_check_interval > 0 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(
+            f"智能体池({self.agent_class.__name__})已就绪: {len(self._idle)} 个空闲智能体"
+        )
+
+    async def lease(self, name: Optional[str] = None) -> MCPAgent:
+        """租用一个健康的智能体，池满时最多等待lease_timeout秒
+
+        异常:
+            AgentPoolExhausted: 超时仍没有可用的智能体
+        """
+        if self._closed:
+            raise AgentPoolExhausted("智能体池已关闭")
+
+        start = time.monotonic()
+        deadline = start + self.settings.lease_timeout
+        while True:
+            agent = None
+            create = False
+            async with self._condition:
+                while not self._idle and self._size >= self.settings.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AgentPoolExhausted(
+                            f"{self.settings.lease_timeout}秒内没有可用的智能体"
+                            f"（上限 {self.settings.max_size}）"
+                        )
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        continue
+                if self._idle:
+                    agent = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            if create:
+                agent = await self._create_or_release_slot()
+            elif not await self.check(agent):
+                logger.warning("空闲智能体健康检查失败，已丢弃")
+                await self._discard(agent)
+                continue
+
+            self._leased.add(id(agent))
+            self._leases += 1
+            self._wait_seconds += time.monotonic() - start
+            if name:
+                agent.name = name
+            return agent
+
+    async def release(self, agent: MCPAgent) -> None:
+        """归还智能体：断开额外的服务器、重置运行状态，健康时放回池中"""
+        if id(agent) not in self._leased:
+            logger.warning("归还的智能体不属于该池，忽略")
+            return
+        self._leased.discard(id(agent))
+
+        try:
+            extra_servers = [
+                s for s in agent.connected_servers if s not in self.base_server_ids
+            ]
+            for server_id in extra_servers:
+                await agent.disconnect_server(server_id)
+            if extra_servers:
+                await agent._refresh_tools()
+            if self.settings.restart_stdio_servers:
+                await self._restart_stdio_servers(agent)
+            agent.reset()
+        except Exception as e:
+            logger.warning(f"重置智能体时出错，已丢弃: {str(e)}")
+            await self._discard(agent)
+            return
+
+        if self._closed or not self.is_connected(agent):
+            await self._discard(agent)
+            return
+
+        async with self._condition:
+            self._idle.append(agent)
+            self._condition.notify()
+
+    def is_connected(self, agent: MCPAgent) -> bool:
+        """基础服务器的会话是否都还存在"""
+        return all(s in agent.mcp_clients.sessions for s in self.base_server_ids)
+
+    async def check(self, agent: MCPAgent) -> bool:
+        """ping所有基础服务器，全部响应才视为健康"""
+        if not self.is_connected(agent):
+            return False
+        try:
+            for server_id in self.base_server_ids:
+                await asyncio.wait_for(
+                    agent.mcp_clients.sessions[server_id].send_ping(),
+                    self.settings.ping_timeout,
+                )
+            return True
+        except Exception as e:
+            logger.warning(f"智能体健康检查失败: {str(e)}")
+            return False
+
+    async def close(self) -> None:
+        """停止健康检查并断开所有空闲智能体的连接"""
+        self._closed = True
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        async with self._condition:
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for agent in idle:
+            await self._discard(agent)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "agent_class": self.agent_class.__name__,
+            "size": self._size,
+            "idle": len(self._idle),
+            "leased": len(self._leased),
+            "max_size": self.settings.max_size,
+            "created": self._created,
+            "discarded": self._discarded,
+            "leases": self._leases,
+            "avg_wait_seconds": self._wait_seconds / self._leases if self._leases else 0.0,
+        }
+
+    @staticmethod
+    async def _connect(agent: MCPAgent, server: Dict[str, Any], first: bool = False) -> None:
+        connect = agent.initialize if first else agent.connect_additional_server
+        await connect(
+            connection_type=server["connection_type"],
+            server_url=server.get("server_url"),
+            command=server.get("command"),
+            args=server.get("args"),
+            server_id=server.get("server_id"),
+        )
+
+    async def _restart_stdio_servers(self, agent: MCPAgent) -> None:
+        """断开并重新连接stdio基础服务器，丢弃上一个请求留下的服务器端状态
+
+        使用独占连接时断开会结束服务器进程；启用延迟连接时重新连接只注册缓存的工具，
+        新进程在首次调用工具时才启动。
+        """
+        restarted = False
+        for server in self.server_configs:
+            if server["connection_type"] != "stdio":
+                continue
+            await agent.disconnect_server(server["server_id"])
+            await self._connect(agent, server)
+            restarted = True
+        if restarted:
+            # 保持基础服务器的工具顺序不变，提示前缀可以继续命中缓存
+            order = self.base_server_ids
+            agent.connected_servers.sort(key=order.index)
+            agent.mcp_clients.reorder_tools(order)
+
+    async def _create(self) -> MCPAgent:
+        """创建智能体并连接所有基础服务器"""
+        agent = self.agent_class(name=self.agent_class.__name__, **self.agent_kwargs)
+        try:
+            for index, server in enumerate(self.server_configs):
+                await self._connect(agent, server, first=index == 0)
+            # 预热期间产生的工具变化通知不属于任何请求
+            agent.reset()
+        except Exception:
+            await self._disconnect(agent)
+            raise
+        self._created += 1
+        return agent
+
+    async def _create_or_release_slot(self) -> MCPAgent:
+        """创建智能体，失败时归还占用的名额"""
+        try:
+            return await self._create()
+        except Exception:
+            async with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    async def _fill(self) -> None:
+        """并发创建智能体，直到空闲数达到min_size"""
+        async with self._condition:
+            missing = min(
+                self.settings.min_size - len(self._idle),
+                self.settings.max_size - self._size,
+            )
+            if missing <= 0:
+                return
+            self._size += missing
+
+        results = await asyncio.gather(
+            *(self._create_or_release_slot() for _ in range(missing)),
+            return_exceptions=True,
+        )
+        async with self._condition:
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"预热智能体失败: {str(result)}")
+                else:
+                    self._idle.append(result)
+            self._condition.notify_all()
+
+    async def _discard(self, agent: MCPAgent) -> None:
+        await self._disconnect(agent)
+        async with self._condition:
+            self._size -= 1
+            self._discarded += 1
+            self._condition.notify()
+
+    @staticmethod
+    async def _disconnect(agent: MCPAgent) -> None:
+        try:
+            await agent.mcp_clients.disconnect()
+        except Exception as e:
+            logger.warning(f"断开智能体的MCP连接时出错: {str(e)}")
+        agent.connected_servers = []
+
+    async def _health_loop(self) -> None:
+        """定期检查空闲智能体，丢弃失效的并补足min_size"""
+        while not self._closed:
+            await asyncio.sleep(self.settings.health_check_interval)
+            async with self._condition:
+                idle, self._idle = self._idle, []
+            healthy = []
+            for agent in idle:
+                if await self.check(agent):
+                    healthy.append(agent)
+                else:
+                    await self._discard(agent)
+            async with self._condition:
+                self._idle.extend(healthy)
+                self._condition.notify_all()
+            try:
+                await self._fill()
+            except Exception as e:
+                logger.error(f"补充智能体池失败: {str(e)}")
@@ -1,13 +1,15 @@
+import asyncio
 import json
-from typing import Any, List, Optional, Union, Tuple
+from contextlib import AsyncExitStack
+from typing import Any, Dict, List, Optional, Union, Tuple
 
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 
 from app.agent.react import ReActAgent
 from app.exceptions import TokenLimitExceeded
 from app.logger import logger
 from app.prompt.toolcall import NEXT_STEP_PROMPT, SYSTEM_PROMPT
-from app.schema import TOOL_CHOICE_TYPE, AgentState, Message, ToolCall, ToolChoice, TokenUsage
+from app.schema import TOOL_CHOICE_TYPE, AgentState, Function, Message, ToolCall, ToolChoice, TokenUsage
 from app.tool import CreateChatCompletion, Terminate, ToolCollection
 
 
@@ -31,40 +33,73 @@ class ToolCallAgent(ReActAgent):
 
     tool_calls: List[ToolCall] = Field(default_factory=list)
     _current_base64_image: Optional[str] = None
+    # One-off instructions for the next request only, never stored in memory
+    _pending_notices: List[str] = PrivateAttr(default_factory=list)
+
+    # 设置后以流式方式请求LLM，并将内容和工具参数的增量事件放入该队列
+    delta_queue: Optional[asyncio.Queue] = Field(default=None, exclude=True)
 
     max_steps: int = 30
     max_observe: Optional[Union[int, bool]] = None
 
+    # Number of most recent messages that context compaction keeps verbatim
+    compaction_keep_recent: int = 6
+
+    # Opt-in concurrent execution of the tool calls of one step. Results are
+    # still committed to memory in the original call order.
+    parallel_tool_calls: bool = False
+    max_parallel_tool_calls: int = 4
+    # Concurrent calls per MCP server, overridable per server id
+    max_parallel_calls_per_server: Optional[int] = 2
+    server_concurrency: Dict[str, int] = Field(default_factory=dict)
+    _tool_semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+    _server_semaphores: Dict[str, asyncio.Semaphore] = PrivateAttr(default_factory=dict)
+
+    # Opt-in pipelining: stream the completion and start each tool call as soon
+    # as its arguments JSON is complete, while the rest is still being generated
+    pipeline_tool_calls: bool = False
+    # tool_call_id -> (arguments, task) of calls started during streaming
+    _dispatched: Dict[str, Tuple[str, asyncio.Task]] = PrivateAttr(default_factory=dict)
+
     async def think(self) -> Tuple[bool, str, str, TokenUsage]:
         """Process current state and decide next actions using tools"""
         thought = ""
         action = ""
 
-        if self.next_step_prompt:
-            user_msg = Message.user_message(self.next_step_prompt)
-            self.messages += [user_msg]
-
+        # The system prompt and tool list form a byte-stable prefix and the history
+        # is append-only, so the provider can reuse its prompt cache across steps.
+        # Per-step instructions are only added to the outgoing request.
+        system_msgs = self.system_messages()
+        step_msgs = self.step_messages()
+        tools_tokens = self.tool_params_tokens()
+        saved_tokens = self.compact_memory(system_msgs + step_msgs, tools_tokens)
+
+        request = dict(
+            messages=self.messages + step_msgs,
+            system_msgs=system_msgs or None,
+            tools=self.tool_params(),
+            tool_choice=self.tool_choices,
+            tools_tokens=tools_tokens,
+        )
         try:
             # Get response with tool options
-            response, token_usage = await self.llm.ask_tool(
-                messages=self.messages,
-                system_msgs=(
-                    [Message.system_message(self.system_prompt)]
-                    if self.system_prompt
-                    else None
-                ),
-                tools=self.available_tools.to_params(),
-                tool_choice=self.tool_choices,
-            )
+            if self.pipeline_tool_calls and self.tool_choices != ToolChoice.NONE:
+                response, token_usage = await self._ask_tool_pipelined(request)
+            else:
+                response, token_usage = await self.llm.ask_tool(
+                    **request,
+                    stream=self.delta_queue is not None,
+                    delta_queue=self.delta_queue,
+                )
         except ValueError:
             raise
         except Exception as e:
-            # Check if this is a RetryError containing TokenLimitExceeded
-            if hasattr(e, "__cause__") and isinstance(e.__cause__, TokenLimitExceeded):
-                token_limit_error = e.__cause__
-                logger.error(
-                    f"🚨 Token limit error (from RetryError): {token_limit_error}"
-                )
+            # TokenLimitExceeded is fatal and raised directly, or wrapped in a RetryError
+            token_limit_error = (
+                e if isinstance(e, TokenLimitExceeded) else getattr(e, "__cause__", None)
+            )
+            if isinstance(token_limit_error, TokenLimitExceeded):
+                logger.error(f"🚨 Token limit error: {token_limit_error}")
                 self.memory.add_message(
                     Message.assistant_message(
                         f"Maximum token limit reached, cannot continue execution: {str(token_limit_error)}"
@@ -72,9 +107,11 @@ class ToolCallAgent(ReActAgent):
                 )
                 thought = f"最大token限制，无法继续执行：{str(token_limit_error)}"
                 self.state = AgentState.FINISHED
-                return False, thought, action, token_usage
+                return False, thought, action, TokenUsage()
             raise
 
+        token_usage.saved_tokens = saved_tokens
+
         self.tool_calls = tool_calls = (
             response.tool_calls if response and response.tool_calls else []
         )
@@ -141,6 +178,130 @@ class ToolCallAgent(ReActAgent):
             )
             return False, thought, action, token_usage
 
+    async def _ask_tool_pipelined(self, request: dict):
+        """Stream the completion and dispatch tool calls while it is generated.
+
+        Every call whose arguments parse as a complete JSON object is started
+        right away; act() later awaits the results and commits them in order.
+        Special tools are never started early, since they change agent state.
+        Once a call has been started the stream is no longer retried, so a
+        failure cannot make the same tool run twice.
+        """
+        self._cancel_dispatched()
+        stream = self.llm.ask_tool_stream(**request)
+        calls: Dict[int, Dict[str, str]] = {}
+        try:
+            async for event in stream:
+                if self.delta_queue is not None:
+                    self.delta_queue.put_nowait(event)
+                if event["type"] == "reset":
+                    # The attempt failed and will be retried from the start
+                    calls.clear()
+                    self._cancel_dispatched()
+                    continue
+                if event["type"] != "tool_call":
+                    continue
+
+                call = calls.setdefault(
+                    event["index"], {"id": "", "name": "", "arguments": ""}
+                )
+                call["id"] = event["id"] or call["id"]
+                call["name"] = event["name"] or call["name"]
+                call["arguments"] += event["arguments"]
+                if self._dispatch_if_complete(call):
+                    stream.disable_retry()
+            return await stream.result()
+        except BaseException:
+            stream.cancel()
+            self._cancel_dispatched()
+            raise
+
+    def _dispatch_if_complete(self, call: Dict[str, str]) -> bool:
+        """Start a streamed tool call once its arguments are a complete JSON object.
+
+        Returns whether the call was started.
+        """
+        if not call["id"] or not call["name"] or call["id"] in self._dispatched:
+            return False
+        if self._is_special_tool(call["name"]):
+            return False
+        try:
+            arguments = json.loads(call["arguments"])
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(arguments, dict):
+            return False
+
+        command = ToolCall(
+            id=call["id"],
+            function=Function(name=call["name"], arguments=call["arguments"]),
+        )
+        logger.info(f"🚀 Dispatching tool '{call['name']}' while the LLM is still generating")
+        task = asyncio.create_task(self._run_tool_limited(command))
+        self._dispatched[call["id"]] = (call["arguments"], task)
+        return True
+
+    def _cancel_dispatched(self) -> None:
+        """Cancel tool calls that were started during streaming but not used"""
+        for _, task in self._dispatched.values():
+            task.cancel()
+        self._dispatched.clear()
+
+    def reset(self) -> None:
+        super().reset()
+        self._cancel_dispatched()
+        self.tool_calls = []
+        self._pending_notices.clear()
+        self._current_base64_image = None
+        self.delta_queue = None
+
+    def tool_params(self) -> List[dict]:
+        """Tool definitions sent with each request"""
+        return self.available_tools.to_params()
+
+    def tool_params_tokens(self) -> int:
+        """Token cost of tool_params()"""
+        return self.available_tools.count_params_tokens(self.llm.count_tokens)
+
+    def system_messages(self) -> List[Message]:
+        """Stable prompt prefix sent before the history on every request"""
+        if not self.system_prompt:
+            return []
+        return [Message.system_message(self.system_prompt)]
+
+    def add_notice(self, notice: str) -> None:
+        """Queue a one-off instruction for the next request"""
+        self._pending_notices.append(notice)
+
+    def step_messages(self) -> List[Message]:
+        """Ephemeral instructions appended to the outgoing request of this step"""
+        parts = [*self._pending_notices, self.next_step_prompt]
+        self._pending_notices.clear()
+        content = "\n\n".join(part for part in parts if part)
+        return [Message.user_message(content)] if content else []
+
+    def compact_memory(
+        self, extra_msgs: Optional[List[Message]] = None, tools_tokens: int = 0
+    ) -> int:
+        """Compact the history when the estimated prompt nears the context window.
+
+        ``extra_msgs`` are the messages sent alongside the history (system prompt,
+        per-step instructions). Returns the number of prompt tokens saved.
+        """
+        budget = int(self.llm.context_window * self.llm.compaction_threshold)
+        fixed_tokens = tools_tokens
+        if extra_msgs:
+            fixed_tokens += self.llm.count_message_tokens(extra_msgs)
+
+        saved = self.memory.compact(
+            self.llm.count_message_tokens,
+            max_tokens=budget - fixed_tokens,
+            keep_recent=self.compaction_keep_recent,
+        )
+        if saved:
+            logger.info(f"🗜️ Compacted {self.name}'s history, saved {saved} tokens")
+        return saved
+
     async def act(self) -> str:
         """Execute tool calls and handle their results"""
         if not self.tool_calls:
@@ -151,39 +312,132 @@ class ToolCallAgent(ReActAgent):
             return self.messages[-1].content or "No content or commands to execute"
 
         results = []
-        for command in self.tool_calls:
-            # Reset base64_image for each tool call
-            self._current_base64_image = None
+        if self._dispatched:
+            # Calls started during streaming are reused if their arguments match
+            # the final message, the others are started now
+            tasks = []
+            for command in self.tool_calls:
+                arguments, task = self._dispatched.pop(command.id, (None, None))
+                if task is None or arguments != command.function.arguments:
+                    if task is not None:
+                        task.cancel()
+                    task = asyncio.create_task(self._run_tool_limited(command))
+                tasks.append(task)
+            self._cancel_dispatched()
+
+            try:
+                for command, task in zip(self.tool_calls, tasks):
+                    results.append(await self._settle_tool_call(command, await task))
+            finally:
+                for task in tasks:
+                    task.cancel()
+        elif self.parallel_tool_calls and len(self.tool_calls) > 1:
+            outcomes = await asyncio.gather(
+                *(self._run_tool_limited(command) for command in self.tool_calls)
+            )
+            # Special tools change agent state and memory, so they are handled
+            # here one by one in call order instead of inside the concurrent calls
+            for command, outcome in zip(self.tool_calls, outcomes):
+                results.append(await self._settle_tool_call(command, outcome))
+        else:
+            for command in self.tool_calls:
+                result, base64_image = await self._run_tool(command)
+                results.append(self._commit_tool_result(command, result, base64_image))
 
-            result = await self.execute_tool(command)
+        return "\n\n".join(results)
 
-            if self.max_observe:
-                result = result[: self.max_observe]
+    async def _settle_tool_call(
+        self, command: ToolCall, outcome: Tuple[str, Optional[str], Any]
+    ) -> str:
+        """Handle special tools for a call run by _run_tool_limited, then commit its result"""
+        observation, base64_image = await self._apply_special_tool(command, outcome)
+        return self._commit_tool_result(command, observation, base64_image)
 
-            logger.info(
-                f"🎯 Tool '{command.function.name}' completed its mission! Result: {result}"
-            )
+    def _commit_tool_result(
+        self, command: ToolCall, result: str, base64_image: Optional[str] = None
+    ) -> str:
+        """Add a tool result to memory and return the (possibly truncated) result"""
+        if self.max_observe:
+            result = result[: self.max_observe]
 
-            # Add tool response to memory
-            tool_msg = Message.tool_message(
-                content=result,
-                tool_call_id=command.id,
-                name=command.function.name,
-                base64_image=self._current_base64_image,
-            )
-            self.memory.add_message(tool_msg)
-            results.append(result)
+        logger.info(
+            f"🎯 Tool '{command.function.name}' completed its mission! Result: {result}"
+        )
 
-        return "\n\n".join(results)
+        # Add tool response to memory
+        tool_msg = Message.tool_message(
+            content=result,
+            tool_call_id=command.id,
+            name=command.function.name,
+            base64_image=base64_image,
+        )
+        self.memory.add_message(tool_msg)
+        return result
+
+    def _tool_semaphores(self, name: str) -> List[asyncio.Semaphore]:
+        """Semaphores a call to the given tool has to hold, per-server limit first"""
+        semaphores = []
+        server_id = getattr(self.available_tools.get_tool(name), "server_id", None)
+        limit = self.server_concurrency.get(server_id, self.max_parallel_calls_per_server)
+        if server_id and limit:
+            if server_id not in self._server_semaphores:
+                self._server_semaphores[server_id] = asyncio.Semaphore(limit)
+            semaphores.append(self._server_semaphores[server_id])
+
+        if self._tool_semaphore is None:
+            self._tool_semaphore = asyncio.Semaphore(self.max_parallel_tool_calls)
+        semaphores.append(self._tool_semaphore)
+        return semaphores
+
+    async def _run_tool_limited(self, command: ToolCall) -> Tuple[str, Optional[str], Any]:
+        """Run a tool call within the global and per-server concurrency limits.
+
+        Special tools are not handled here; see _settle_tool_call.
+        """
+        name = command.function.name if command and command.function else ""
+        async with AsyncExitStack() as stack:
+            for semaphore in self._tool_semaphores(name):
+                await stack.enter_async_context(semaphore)
+            return await self._invoke_tool(command)
 
     async def execute_tool(self, command: ToolCall) -> str:
         """Execute a single tool call with robust error handling"""
+        result, self._current_base64_image = await self._run_tool(command)
+        return result
+
+    async def _run_tool(self, command: ToolCall) -> Tuple[str, Optional[str]]:
+        """Execute a single tool call and handle special tools, returning the
+        observation and its base64 image"""
+        return await self._apply_special_tool(command, await self._invoke_tool(command))
+
+    async def _apply_special_tool(
+        self, command: ToolCall, outcome: Tuple[str, Optional[str], Any]
+    ) -> Tuple[str, Optional[str]]:
+        """Run special tool handling for a finished call, which may change agent state"""
+        observation, base64_image, result = outcome
+        if result is None:
+            return observation, base64_image
+        name = command.function.name
+        try:
+            await self._handle_special_tool(name=name, result=result)
+        except Exception as e:
+            error_msg = f"⚠️ Tool '{name}' encountered a problem: {str(e)}"
+            logger.exception(error_msg)
+            return f"Error: {error_msg}", None
+        return observation, base64_image
+
+    async def _invoke_tool(self, command: ToolCall) -> Tuple[str, Optional[str], Any]:
+        """Execute a single tool call, returning the observation, its base64 image
+        and the raw result (None if the call failed).
+
+        Does not touch shared agent state, so several calls can run concurrently.
+        """
         if not command or not command.function or not command.function.name:
-            return "Error: Invalid command format"
+            return "Error: Invalid command format", None, None
 
         name = command.function.name
         if name not in self.available_tools.tool_map:
-            return f"Error: Unknown tool '{name}'"
+            return f"Error: Unknown tool '{name}'", None, None
 
         try:
             # Parse arguments
@@ -193,40 +447,23 @@ class ToolCallAgent(ReActAgent):
             logger.info(f"🔧 Activating tool: '{name}'...")
             result = await self.available_tools.execute(name=name, tool_input=args)
 
-            # Handle special tools
-            await self._handle_special_tool(name=name, result=result)
-
-            # Check if result is a ToolResult with base64_image
-            if hasattr(result, "base64_image") and result.base64_image:
-                # Store the base64_image for later use in tool_message
-                self._current_base64_image = result.base64_image
-
-                # Format result for display
-                observation = (
-                    f"Observed output of cmd `{name}` executed:\n{str(result)}"
-                    if result
-                    else f"Cmd `{name}` completed with no output"
-                )
-                return observation
-
-            # Format result for display (standard case)
+            # Format result for display
             observation = (
                 f"Observed output of cmd `{name}` executed:\n{str(result)}"
                 if result
                 else f"Cmd `{name}` completed with no output"
             )
-
-            return observation
+            return observation, getattr(result, "base64_image", None) or None, result
         except json.JSONDecodeError:
             error_msg = f"Error parsing arguments for {name}: Invalid JSON format"
             logger.error(
                 f"📝 Oops! The arguments for '{name}' don't make sense - invalid JSON, arguments:{command.function.arguments}"
             )
-            return f"Error: {error_msg}"
+            return f"Error: {error_msg}", None, None
         except Exception as e:
             error_msg = f"⚠️ Tool '{name}' encountered a problem: {str(e)}"
             logger.exception(error_msg)
-            return f"Error: {error_msg}"
+            return f"Error: {error_msg}", None, None
 
     async def _handle_special_tool(self, name: str, result: Any, **kwargs):
         """Handle special tool execution and state changes"""
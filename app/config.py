@@ -1,7 +1,7 @@
 import threading
 import tomllib
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -13,10 +13,17 @@ def get_project_root() -> Path:
 
 PROJECT_ROOT = get_project_root()
 WORKSPACE_ROOT = PROJECT_ROOT / "workspace"
+CACHE_ROOT = PROJECT_ROOT / "cache"
 TEMPLATE_ROOT = PROJECT_ROOT / "template"
 VISUALIZATION_ROOT = PROJECT_ROOT / "visualization"
 
 
+class LLMEndpoint(BaseModel):
+    base_url: str = Field(..., description="API基础URL")
+    api_key: str = Field(..., description="API密钥")
+    weight: float = Field(1.0, description="路由权重，权重越大分配的请求越多")
+
+
 class LLMSettings(BaseModel):
     model: str = Field(..., description="模型名称")
     base_url: str = Field(..., description="API基础URL")
@@ -27,10 +34,193 @@ class LLMSettings(BaseModel):
         description="所有请求累计使用的最大输入令牌数（None表示无限制）",
     )
     temperature: float = Field(1.0, description="采样温度")
+    context_window: int = Field(128000, description="模型的上下文窗口大小（token数）")
+    compaction_threshold: float = Field(
+        0.75, description="提示词估计大小超过上下文窗口的该比例时压缩历史消息"
+    )
+    cache_enabled: bool = Field(False, description="是否启用磁盘LLM响应缓存")
+    cache_dir: Optional[str] = Field(
+        None, description="响应缓存目录（None表示使用PROJECT_ROOT/cache/llm）"
+    )
+    cache_max_bytes: int = Field(
+        256 * 1024 * 1024, description="响应缓存的最大磁盘占用（字节），超出后按LRU淘汰"
+    )
+    http_max_connections: int = Field(100, description="HTTP连接池的最大连接数")
+    http_max_keepalive_connections: int = Field(
+        20, description="连接池中保持的最大空闲keep-alive连接数"
+    )
+    http_keepalive_expiry: float = Field(30.0, description="空闲连接的保持时间（秒）")
+    http2: bool = Field(False, description="是否启用HTTP/2（需要安装h2）")
+    connect_timeout: float = Field(10.0, description="建立连接的超时时间（秒）")
+    read_timeout: float = Field(600.0, description="读取响应的超时时间（秒）")
+    stream_usage: bool = Field(
+        True,
+        description="流式请求是否发送stream_options.include_usage以获取用量（部分兼容网关不支持，"
+        "关闭后使用本地估计；端点返回400时也会自动关闭）",
+    )
+    rpm_limit: Optional[int] = Field(
+        None, description="每分钟最大请求数（None表示不限制），进程内所有调用共享"
+    )
+    tpm_limit: Optional[int] = Field(
+        None, description="每分钟最大token数（None表示不限制），进程内所有调用共享"
+    )
+    retry_max_attempts: int = Field(6, description="每次调用的最大尝试次数")
+    retry_deadline: float = Field(600.0, description="每次调用（含重试）的总时限（秒）")
+    retry_min_wait: float = Field(1.0, description="重试退避的最小等待时间（秒）")
+    retry_max_wait: float = Field(60.0, description="重试退避的最大等待时间（秒）")
+    hedge_enabled: bool = Field(
+        False, description="请求耗时超过滚动p95延迟时是否发出对冲请求"
+    )
+    hedge_min_samples: int = Field(20, description="启用对冲前需要的最少延迟样本数")
+    endpoints: List[LLMEndpoint] = Field(
+        default_factory=list,
+        description="多个OpenAI兼容端点，设置后按延迟和错误率在其间路由（为空时只使用base_url）",
+    )
+    endpoint_eject_failures: int = Field(
+        3, description="端点连续失败多少次后被暂时移出路由"
+    )
+    endpoint_eject_seconds: float = Field(30.0, description="端点被移出路由的时长（秒）")
+
+
+class AgentPoolSettings(BaseModel):
+    enabled: bool = Field(True, description="是否使用预热的智能体池处理API请求")
+    min_size: int = Field(1, description="启动时预热并保持的空闲智能体数")
+    max_size: int = Field(4, description="智能体总数上限（含正在使用的）")
+    lease_timeout: float = Field(30.0, description="池满时等待空闲智能体的最长时间（秒）")
+    health_check_interval: float = Field(
+        60.0, description="空闲智能体健康检查的间隔（秒），0表示只在租用时检查"
+    )
+    ping_timeout: float = Field(5.0, description="健康检查时ping MCP服务器的超时时间（秒）")
+    restart_stdio_servers: bool = Field(
+        True,
+        description="归还智能体时是否重新连接stdio基础服务器，避免bash工作目录、环境变量和后台任务"
+        "等服务器端状态带到下一个请求（启用延迟连接时新进程在首次调用工具时才启动）",
+    )
+
+
+class MCPSettings(BaseModel):
+    session_pool: bool = Field(
+        True, description="是否在进程内按服务器配置共享MCP会话（关闭时每次运行单独连接）"
+    )
+    pool_stdio: bool = Field(
+        False,
+        description="是否也共享stdio服务器的会话。stdio服务器（如内置服务器的bash）在进程中保存"
+        "工作目录、环境变量等状态，默认每个智能体单独启动进程；开启后同一进程上的工具调用串行执行",
+    )
+    session_idle_ttl: float = Field(
+        600.0, description="没有智能体使用的共享会话保持的时间（秒），0表示一直保持"
+    )
+    connect_timeout: float = Field(30.0, description="建立MCP连接的超时时间（秒）")
+    lazy_connect: bool = Field(
+        True, description="工具模式已缓存时先用缓存注册工具，首次调用该服务器的工具时才连接"
+    )
+    schema_cache_dir: Optional[str] = Field(
+        None, description="工具模式缓存目录（None表示使用PROJECT_ROOT/cache/mcp_tools）"
+    )
+    schema_version_ttl: float = Field(
+        10.0, description="stdio服务器代码版本哈希的复用时间（秒），期间不重新扫描代码目录"
+    )
+    schema_cache_max_age: float = Field(
+        3600.0,
+        description="无法从本地判断版本的服务器（如sse）缓存的工具模式的有效期（秒），"
+        "过期后重新握手获取，0表示不过期",
+    )
+    reconnect_max_attempts: int = Field(5, description="连接断开后的最大连续重连次数")
+    reconnect_min_wait: float = Field(0.5, description="重连退避的最小等待时间（秒）")
+    reconnect_max_wait: float = Field(30.0, description="重连退避的最大等待时间（秒）")
+    shutdown_timeout: float = Field(
+        5.0, description="关闭一个MCP连接（含回收stdio子进程）的最长时间（秒），超时后强制结束"
+    )
+    call_timeout: float = Field(120.0, description="工具调用的默认超时时间（秒），0表示不限制")
+    server_timeouts: Dict[str, float] = Field(
+        default_factory=dict, description="按服务器ID或SSE URL覆盖的工具调用超时（秒）"
+    )
+    tool_timeouts: Dict[str, float] = Field(
+        default_factory=dict, description="按工具名（带或不带服务器前缀）覆盖的调用超时（秒）"
+    )
+    max_concurrent_calls: int = Field(8, description="每个MCP服务器同时进行的最大工具调用数")
+    breaker_failure_threshold: int = Field(
+        5, description="连续失败（含超时）多少次后熔断该服务器"
+    )
+    breaker_reset_timeout: float = Field(30.0, description="熔断后多久放行一次探测调用（秒）")
+
+
+class WorkspaceSettings(BaseModel):
+    run_ttl: float = Field(
+        3600.0, description="运行目录在最后修改后保留的时间（秒），超过后由清理程序删除"
+    )
+    janitor_interval: float = Field(300.0, description="清理过期运行目录的间隔（秒），0表示不清理")
+    keep_runs: bool = Field(
+        False, description="运行结束后是否保留运行目录（便于排查），保留的目录仍按run_ttl删除"
+    )
+
+
+class DatasetSettings(BaseModel):
+    max_upload_size: int = Field(
+        512 * 1024 * 1024, description="单个上传文件的最大字节数，超过时返回413，0表示不限制"
+    )
+    chunk_size: int = Field(1024 * 1024, description="流式写入上传文件的块大小（字节）")
+    ttl: float = Field(
+        7 * 24 * 3600.0, description="数据集及其解压缓存在最后一次使用后保留的时间（秒），0表示一直保留"
+    )
+
+
+class DownloadSettings(BaseModel):
+    max_connections: int = Field(16, description="下载连接池的最大连接数")
+    connect_timeout: float = Field(10.0, description="建立下载连接的超时时间（秒）")
+    read_timeout: float = Field(60.0, description="下载时两次读取之间的最长等待时间（秒）")
+    chunk_size: int = Field(1024 * 1024, description="下载写入磁盘的块大小（字节）")
+    parallel_threshold: int = Field(
+        16 * 1024 * 1024, description="文件不小于该字节数且服务器支持范围请求时分段并行下载"
+    )
+    max_parts: int = Field(4, description="并行下载的最大分段数")
+    max_retries: int = Field(3, description="每个分段下载失败后的最大重试次数，重试从已下载的位置继续")
+    retry_wait: float = Field(1.0, description="下载重试的初始等待时间（秒），每次翻倍")
+    max_size: int = Field(
+        2 * 1024 * 1024 * 1024, description="下载文件的最大字节数，0表示不限制"
+    )
+    cache_dir: Optional[str] = Field(
+        None, description="下载缓存目录（None表示使用PROJECT_ROOT/cache/downloads）"
+    )
+    cache_ttl: float = Field(
+        7 * 24 * 3600.0, description="下载缓存在最后一次使用后保留的时间（秒），0表示一直保留"
+    )
+
+
+class JobSettings(BaseModel):
+    max_workers: int = Field(4, description="同时执行的后台任务数")
+    max_queued: int = Field(100, description="排队等待执行的最大后台任务数，超过时拒绝提交")
+    max_events: int = Field(1000, description="每个任务缓存供重放的最大步骤事件数")
+    subscriber_queue_size: int = Field(
+        256, description="每个事件订阅者的缓冲大小，已满时丢弃LLM增量事件，步骤事件改为从缓存重放"
+    )
+    result_ttl: float = Field(3600.0, description="任务结束后保留状态、结果和事件的时间（秒）")
+
+
+class AdmissionSettings(BaseModel):
+    enabled: bool = Field(True, description="是否对/api/agent/*和/stream/run/*请求做准入控制")
+    max_concurrent_runs: int = Field(
+        4, description="全局同时运行的智能体任务数，0表示不限制；启用智能体池时不超过池的max_size"
+    )
+    task_limits: Dict[str, int] = Field(
+        default_factory=dict, description="按任务名限制同时运行的数量，例如aml_report = 2"
+    )
+    max_waiting: int = Field(16, description="等待运行的最大请求数，超过时返回429")
+    queue_timeout: float = Field(60.0, description="请求排队等待的最长时间（秒），超时后返回429")
+    default_retry_after: float = Field(
+        30.0, description="还没有运行耗时统计时Retry-After使用的单次运行耗时（秒）"
+    )
 
 
 class AppConfig(BaseModel):
     llm: Dict[str, LLMSettings]
+    agent_pool: AgentPoolSettings = Field(default_factory=AgentPoolSettings)
+    mcp: MCPSettings = Field(default_factory=MCPSettings)
+    workspace: WorkspaceSettings = Field(default_factory=WorkspaceSettings)
+    datasets: DatasetSettings = Field(default_factory=DatasetSettings)
+    downloads: DownloadSettings = Field(default_factory=DownloadSettings)
+    jobs: JobSettings = Field(default_factory=JobSettings)
+    admission: AdmissionSettings = Field(default_factory=AdmissionSettings)
 
     class Config:
         arbitrary_types_allowed = True
@@ -86,6 +276,31 @@ class Config:
             "max_tokens": base_llm.get("max_tokens", 4096),
             "max_input_tokens": base_llm.get("max_input_tokens"),
             "temperature": base_llm.get("temperature", 1.0),
+            "context_window": base_llm.get("context_window", 128000),
+            "compaction_threshold": base_llm.get("compaction_threshold", 0.75),
+            "cache_enabled": base_llm.get("cache_enabled", False),
+            "cache_dir": base_llm.get("cache_dir"),
+            "cache_max_bytes": base_llm.get("cache_max_bytes", 256 * 1024 * 1024),
+            "http_max_connections": base_llm.get("http_max_connections", 100),
+            "http_max_keepalive_connections": base_llm.get(
+                "http_max_keepalive_connections", 20
+            ),
+            "http_keepalive_expiry": base_llm.get("http_keepalive_expiry", 30.0),
+            "http2": base_llm.get("http2", False),
+            "connect_timeout": base_llm.get("connect_timeout", 10.0),
+            "read_timeout": base_llm.get("read_timeout", 600.0),
+            "stream_usage": base_llm.get("stream_usage", True),
+            "rpm_limit": base_llm.get("rpm_limit"),
+            "tpm_limit": base_llm.get("tpm_limit"),
+            "retry_max_attempts": base_llm.get("retry_max_attempts", 6),
+            "retry_deadline": base_llm.get("retry_deadline", 600.0),
+            "retry_min_wait": base_llm.get("retry_min_wait", 1.0),
+            "retry_max_wait": base_llm.get("retry_max_wait", 60.0),
+            "hedge_enabled": base_llm.get("hedge_enabled", False),
+            "hedge_min_samples": base_llm.get("hedge_min_samples", 20),
+            "endpoints": base_llm.get("endpoints", []),
+            "endpoint_eject_failures": base_llm.get("endpoint_eject_failures", 3),
+            "endpoint_eject_seconds": base_llm.get("endpoint_eject_seconds", 30.0),
         }
 
         config_dict = {
@@ -96,6 +311,13 @@ class Config:
                     for name, override_config in llm_overrides.items()
                 },
             },
+            "agent_pool": raw_config.get("agent_pool", {}),
+            "mcp": raw_config.get("mcp", {}),
+            "workspace": raw_config.get("workspace", {}),
+            "datasets": raw_config.get("datasets", {}),
+            "downloads": raw_config.get("downloads", {}),
+            "jobs": raw_config.get("jobs", {}),
+            "admission": raw_config.get("admission", {}),
         }
 
         self._config = AppConfig(**config_dict)
@@ -104,6 +326,34 @@ class Config:
     def llm(self) -> Dict[str, LLMSettings]:
         return self._config.llm
 
+    @property
+    def agent_pool(self) -> AgentPoolSettings:
+        return self._config.agent_pool
+
+    @property
+    def mcp(self) -> MCPSettings:
+        return self._config.mcp
+
+    @property
+    def workspace(self) -> WorkspaceSettings:
+        return self._config.workspace
+
+    @property
+    def datasets(self) -> DatasetSettings:
+        return self._config.datasets
+
+    @property
+    def downloads(self) -> DownloadSettings:
+        return self._config.downloads
+
+    @property
+    def jobs(self) -> JobSettings:
+        return self._config.jobs
+
+    @property
+    def admission(self) -> AdmissionSettings:
+        return self._config.admission
+
     @property
     def workspace_root(self) -> Path:
         """获取工作区根目录"""
@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class ToolError(Exception):
     """Raised when a tool encounters an error."""
 
@@ -11,3 +14,39 @@ class MicroAgentError(Exception):
 
 class TokenLimitExceeded(MicroAgentError):
     """Exception raised when the token limit is exceeded"""
+
+
+class LLMResponseError(MicroAgentError, ValueError):
+    """Exception raised when the LLM returns an empty or invalid response"""
+
+
+class AgentPoolExhausted(MicroAgentError):
+    """Exception raised when no pooled agent becomes available in time"""
+
+
+class MCPServerUnavailable(MicroAgentError):
+    """Exception raised when an MCP server's circuit breaker or bulkhead rejects a call"""
+
+
+class JobQueueFull(MicroAgentError):
+    """Exception raised when the background job queue cannot accept more jobs"""
+
+
+class AdmissionRejected(MicroAgentError):
+    """Exception raised when a run is not admitted because the wait queue is full or timed out"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UploadTooLarge(MicroAgentError):
+    """Exception raised when an uploaded file exceeds the configured size limit"""
+
+
+class DownloadError(MicroAgentError):
+    """Exception raised when a dataset cannot be downloaded"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
@@ -1,24 +1,46 @@
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import json
 import math
-from typing import Dict, List, Optional, Union, Tuple
-
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union, Tuple
+
+import httpx
 import tiktoken
 from openai import (
+    APIConnectionError,
     APIError,
+    APIStatusError,
     AsyncOpenAI,
     AuthenticationError,
+    BadRequestError,
     OpenAIError,
+    PermissionDeniedError,
     RateLimitError,
 )
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
 from tenacity import (
-    retry,
-    retry_if_exception_type,
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception,
     stop_after_attempt,
     wait_random_exponential,
 )
 
-from app.config import LLMSettings, config
-from app.exceptions import TokenLimitExceeded
+from app.config import CACHE_ROOT, LLMEndpoint, LLMSettings, config
+from app.exceptions import LLMResponseError, TokenLimitExceeded
 from app.logger import logger  # 假设你的应用中已设置了logger
 from app.schema import (
     ROLE_VALUES,
@@ -55,6 +77,8 @@ class TokenCounter:
 
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def count_text(self, text: str) -> int:
         """计算文本字符串的token数量"""
@@ -150,31 +174,734 @@ class TokenCounter:
                 token_count += self.count_text(function.get("arguments", ""))
         return token_count
 
-    def count_message_tokens(self, messages: List[dict]) -> int:
-        """计算消息列表中的总token数量"""
+    def _encode_message_tokens(self, message: dict) -> int:
+        """对单条消息进行实际的token编码计算"""
+        tokens = self.BASE_MESSAGE_TOKENS  # 每条消息的基础tokens
+
+        # 添加角色tokens
+        tokens += self.count_text(message.get("role", ""))
+
+        # 添加内容tokens
+        if "content" in message:
+            tokens += self.count_content(message["content"])
+
+        # 添加工具调用tokens
+        if "tool_calls" in message:
+            tokens += self.count_tool_calls(message["tool_calls"])
+
+        # 添加name和tool_call_id的tokens
+        tokens += self.count_text(message.get("name", ""))
+        tokens += self.count_text(message.get("tool_call_id", ""))
+
+        return tokens
+
+    def count_single_message(
+        self, message: Union[dict, Message], supports_images: bool = True
+    ) -> int:
+        """
+        计算单条消息格式化后的token数量
+
+        对话历史每一步都会整体重新计数，而其中绝大多数消息并未变化。
+        Message对象的计数缓存在对象上（字段被赋值时失效），命中时无需编码也无需哈希；
+        dict消息每次都重新编码。supports_images与format_messages的同名参数含义相同。
+        """
+        if isinstance(message, Message):
+            tokens = message._token_count
+            if tokens is None:
+                self.cache_misses += 1
+                tokens = message._token_count = self._encode_message_tokens(message.to_dict())
+            else:
+                self.cache_hits += 1
+            has_body = message.content is not None or message.tool_calls is not None
+            base64_image = message.base64_image
+        else:
+            tokens = self._encode_message_tokens(message)
+            has_body = "content" in message or "tool_calls" in message
+            base64_image = message.get("base64_image")
+
+        # format_messages把base64_image转换为图像内容，或在不支持图像时删除
+        if supports_images and base64_image:
+            tokens += self.count_image({"image_url": {"url": base64_image}})
+            has_body = True
+        # 没有内容和工具调用的消息不会发送
+        return tokens if has_body else 0
+
+    def count_message_tokens(
+        self, messages: List[Union[dict, Message]], supports_images: bool = True
+    ) -> int:
+        """计算消息列表格式化后的总token数量"""
         total_tokens = self.FORMAT_TOKENS  # 基础格式tokens
 
         for message in messages:
-            tokens = self.BASE_MESSAGE_TOKENS  # 每条消息的基础tokens
+            total_tokens += self.count_single_message(message, supports_images)
 
-            # 添加角色tokens
-            tokens += self.count_text(message.get("role", ""))
+        return total_tokens
 
-            # 添加内容tokens
-            if "content" in message:
-                tokens += self.count_content(message["content"])
 
-            # 添加工具调用tokens
-            if "tool_calls" in message:
-                tokens += self.count_tool_calls(message["tool_calls"])
+class LLMResponseCache:
+    """
+    基于磁盘的LLM响应缓存
+
+    每个条目是缓存目录下以请求哈希命名的JSON文件。索引按最近使用顺序保存在内存中，
+    磁盘总占用超过上限时淘汰最久未使用的条目；文件的mtime用于在进程重启后恢复LRU顺序。
+    """
+
+    _instances: Dict[str, "LLMResponseCache"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 缓存键 -> 文件大小，按LRU顺序排列（最近使用的在末尾）
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._load_index()
+
+    @classmethod
+    def shared(cls, cache_dir: Union[str, Path], max_bytes: int) -> "LLMResponseCache":
+        """获取指定目录的共享缓存实例，同一目录的多个LLM配置共用一个索引"""
+        key = str(Path(cache_dir).resolve())
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(cache_dir, max_bytes)
+            return cls._instances[key]
+
+    def _load_index(self) -> None:
+        """扫描缓存目录，按修改时间重建LRU索引"""
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
 
-            # 添加name和tool_call_id的tokens
-            tokens += self.count_text(message.get("name", ""))
-            tokens += self.count_text(message.get("tool_call_id", ""))
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """根据请求的各组成部分计算稳定的缓存键"""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        """读取缓存条目，未命中时返回None"""
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with path.open("r", encoding="utf-8") as f:
+                    value = json.load(f)
+                os.utime(path)
+            except (OSError, ValueError):
+                # 条目损坏或已被外部删除
+                self._total_bytes -= self._index.pop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: dict) -> None:
+        """写入缓存条目，必要时淘汰最久未使用的条目"""
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with self._lock:
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"写入LLM响应缓存失败: {e}")
+                return
+            self._total_bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._index and self._total_bytes > self.max_bytes:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        """返回缓存命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._index),
+            "bytes": self._total_bytes,
+        }
+
+
+class ToolCallStream:
+    """
+    流式ask_tool调用的句柄
+
+    可以异步迭代得到增量事件（内容片段和工具参数片段），
+    并通过result()等待最终组装好的(ChatCompletionMessage, TokenUsage)。
+
+    增量事件格式:
+        {"type": "content", "text": "..."}
+        {"type": "tool_call", "index": 0, "id": "...", "name": "...", "arguments": "..."}
+        {"type": "reset"}  本次尝试在发送部分增量后失败，之前收到的增量全部作废，
+                           重试时会从头重新发送
+    """
 
-            total_tokens += tokens
+    def __init__(
+        self,
+        run: Callable[
+            [asyncio.Queue], Awaitable[Tuple[Optional[ChatCompletionMessage], TokenUsage]]
+        ],
+    ):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # 消费方已根据增量产生副作用（例如启动了工具）时关闭重试，失败直接抛出
+        self.retryable = True
+        self._task = asyncio.create_task(run(self._queue))
+        # 请求结束（无论成功与否）后放入结束标记
+        self._task.add_done_callback(lambda _: self._queue.put_nowait(None))
+
+    def __aiter__(self) -> AsyncIterator[dict]:
+        return self
+
+    async def __anext__(self) -> dict:
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def result(self) -> Tuple[Optional[ChatCompletionMessage], TokenUsage]:
+        """等待流结束并返回最终消息和token使用情况"""
+        return await self._task
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+    def disable_retry(self) -> None:
+        """之后的失败不再重试"""
+        self.retryable = False
+
+
+class RateLimiter:
+    """
+    基于令牌桶的每分钟请求数(RPM)和token数(TPM)限速器
+
+    发送请求前按估计的输入token数预留预算，预算不足时按FIFO顺序等待，
+    而不是让所有调用同时撞上RateLimitError后再同步重试。
+    请求完成后再按实际用量修正预留的token预算。
+    """
+
+    def __init__(self, rpm_limit: Optional[int] = None, tpm_limit: Optional[int] = None):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._available_requests = float(rpm_limit or 0)
+        self._available_tokens = float(tpm_limit or 0)
+        self._updated_at = time.monotonic()
+        # 排队等待预算的调用按获取锁的顺序依次放行
+        self._lock = asyncio.Lock()
+
+        # 监控指标
+        self.waiting = 0
+        self.total_requests = 0
+        self.total_wait_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rpm_limit or self.tpm_limit)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.rpm_limit:
+            self._available_requests = min(
+                self.rpm_limit, self._available_requests + elapsed * self.rpm_limit / 60
+            )
+        if self.tpm_limit:
+            self._available_tokens = min(
+                self.tpm_limit, self._available_tokens + elapsed * self.tpm_limit / 60
+            )
 
-        return total_tokens
+    def _wait_time(self, tokens: int) -> float:
+        """计算预算足够前还需等待的秒数"""
+        wait = 0.0
+        if self.rpm_limit and self._available_requests < 1:
+            wait = max(wait, (1 - self._available_requests) * 60 / self.rpm_limit)
+        if self.tpm_limit and self._available_tokens < tokens:
+            wait = max(wait, (tokens - self._available_tokens) * 60 / self.tpm_limit)
+        return wait
+
+    async def acquire(self, tokens: int) -> int:
+        """
+        预留一次请求和指定token数的预算，必要时等待
+
+        参数:
+            tokens: 估计的token数量
+
+        返回:
+            int: 实际预留的token数（超过TPM上限的请求按上限预留）
+        """
+        if not self.enabled:
+            return 0
+
+        tokens = min(tokens, self.tpm_limit) if self.tpm_limit else 0
+
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                self._refill()
+                wait = self._wait_time(tokens)
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    self._refill()
+                    wait = self._wait_time(tokens)
+                if self.rpm_limit:
+                    self._available_requests -= 1
+                self._available_tokens -= tokens
+        finally:
+            self.waiting -= 1
+            self.total_wait_seconds += time.monotonic() - start
+        self.total_requests += 1
+        return tokens
+
+    def settle(self, reserved: int, actual: int) -> None:
+        """按实际token用量修正之前预留的预算"""
+        if not self.tpm_limit:
+            return
+        self._refill()
+        self._available_tokens = min(
+            self.tpm_limit, self._available_tokens + reserved - actual
+        )
+
+    def utilization(self) -> dict:
+        """返回当前预算使用情况"""
+        self._refill()
+        return {
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+            "rpm_utilization": (
+                1 - self._available_requests / self.rpm_limit if self.rpm_limit else 0.0
+            ),
+            "tpm_utilization": (
+                1 - self._available_tokens / self.tpm_limit if self.tpm_limit else 0.0
+            ),
+            "waiting": self.waiting,
+            "total_requests": self.total_requests,
+            "avg_wait_seconds": (
+                self.total_wait_seconds / self.total_requests
+                if self.total_requests
+                else 0.0
+            ),
+        }
+
+
+class RetryPolicy:
+    """
+    LLM调用的重试与对冲策略
+
+    - 区分可重试错误（连接错误、429、5xx、空响应）和致命错误（认证失败、请求无效、
+      超出token限制等），致命错误立即抛出
+    - 服务端返回Retry-After时按其等待，否则使用带抖动的指数退避
+    - 每次调用（含所有重试）受总时限约束
+    - 启用对冲时，请求耗时超过滚动p95延迟后发出一个重复请求，采用先返回的结果
+    """
+
+    # 可重试的HTTP状态码，此外所有5xx均可重试
+    RETRYABLE_STATUS_CODES = {408, 409, 429}
+    LATENCY_WINDOW = 200
+
+    def __init__(
+        self,
+        max_attempts: int = 6,
+        deadline: float = 600.0,
+        min_wait: float = 1.0,
+        max_wait: float = 60.0,
+        hedge_enabled: bool = False,
+        hedge_min_samples: int = 20,
+    ):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.max_wait = max_wait
+        self.hedge_enabled = hedge_enabled
+        self.hedge_min_samples = hedge_min_samples
+        self._backoff = wait_random_exponential(min=min_wait, max=max_wait)
+        self._latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+
+        # 监控指标
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.retries_by_reason: Dict[str, int] = {}
+        self.fatal_errors = 0
+        self.exhausted = 0
+        self.deadline_exceeded = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_settings(cls, llm_config: LLMSettings) -> "RetryPolicy":
+        return cls(
+            max_attempts=llm_config.retry_max_attempts,
+            deadline=llm_config.retry_deadline,
+            min_wait=llm_config.retry_min_wait,
+            max_wait=llm_config.retry_max_wait,
+            hedge_enabled=llm_config.hedge_enabled,
+            hedge_min_samples=llm_config.hedge_min_samples,
+        )
+
+    @classmethod
+    def is_retryable(cls, exc: BaseException) -> bool:
+        """判断异常是否值得重试"""
+        if isinstance(exc, APIStatusError):
+            return (
+                exc.status_code in cls.RETRYABLE_STATUS_CODES or exc.status_code >= 500
+            )
+        # 连接错误和超时（APITimeoutError是APIConnectionError的子类）
+        if isinstance(exc, (APIConnectionError, httpx.TransportError)):
+            return True
+        # 流式传输中途的错误等没有状态码的API错误
+        if isinstance(exc, APIError):
+            return True
+        return isinstance(exc, LLMResponseError)
+
+    @staticmethod
+    def retry_after(exc: BaseException) -> Optional[float]:
+        """从错误响应的Retry-After头中解析需要等待的秒数"""
+        response = getattr(exc, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                return max(float(retry_after_ms) / 1000, 0.0)
+            except ValueError:
+                pass
+
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(retry_at.timestamp() - time.time(), 0.0)
+
+    def _wait(self, retry_state: RetryCallState) -> float:
+        retry_after = self.retry_after(retry_state.outcome.exception())
+        if retry_after is not None:
+            return min(retry_after, self.max_wait)
+        return self._backoff(retry_state)
+
+    def _deadline_reached(self, retry_state: RetryCallState) -> bool:
+        # 等待后已没有剩余时间时不再重试
+        upcoming_sleep = retry_state.upcoming_sleep or 0
+        return retry_state.seconds_since_start + upcoming_sleep >= self.deadline
+
+    def _before_sleep(self, retry_state: RetryCallState) -> None:
+        exc = retry_state.outcome.exception()
+        reason = type(exc).__name__
+        self.retries += 1
+        self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+        logger.warning(
+            f"LLM调用失败({reason}: {exc})，{retry_state.upcoming_sleep:.1f}秒后进行"
+            f"第{retry_state.attempt_number + 1}次尝试"
+        )
+
+    async def call(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        retry_allowed: Optional[Callable[[], bool]] = None,
+        **kwargs,
+    ) -> Any:
+        """按重试策略执行一次LLM调用
+
+        retry_allowed在每次失败后调用，返回False时不再重试（例如流式增量已被使用）
+        """
+        self.calls += 1
+        start = time.monotonic()
+        retry = retry_if_exception(self.is_retryable)
+        if retry_allowed is not None:
+            retry = retry & retry_if_exception(lambda _: retry_allowed())
+        retrying = AsyncRetrying(
+            wait=self._wait,
+            stop=stop_after_attempt(self.max_attempts) | self._deadline_reached,
+            retry=retry,
+            before_sleep=self._before_sleep,
+            reraise=True,
+        )
+        try:
+            async for attempt in retrying:
+                with attempt:
+                    self.attempts += 1
+                    remaining = self.deadline - (time.monotonic() - start)
+                    try:
+                        return await asyncio.wait_for(func(*args, **kwargs), remaining)
+                    except asyncio.TimeoutError:
+                        self.deadline_exceeded += 1
+                        raise
+        except Exception as e:
+            if self.is_retryable(e):
+                self.exhausted += 1
+            else:
+                self.fatal_errors += 1
+            raise
+
+    def record_latency(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * quantile), len(ordered) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """返回发出对冲请求前的等待时间，样本不足或未启用时返回None"""
+        if not self.hedge_enabled or len(self._latencies) < self.hedge_min_samples:
+            return None
+        return self.latency_quantile(0.95)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "retries_by_reason": dict(self.retries_by_reason),
+            "fatal_errors": self.fatal_errors,
+            "exhausted": self.exhausted,
+            "deadline_exceeded": self.deadline_exceeded,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "p95_latency": self.latency_quantile(0.95),
+        }
+
+
+def llm_retry(func):
+    """按实例的RetryPolicy重试LLM方法"""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await self.retry_policy.call(func, self, *args, **kwargs)
+
+    return wrapper
+
+
+# 按base_url和连接池配置共享的HTTP客户端
+_HTTP_CLIENTS: Dict[Tuple, httpx.AsyncClient] = {}
+
+
+def get_shared_http_client(
+    llm_config: LLMSettings, base_url: Optional[str] = None
+) -> httpx.AsyncClient:
+    """
+    获取指定base_url共享的HTTP客户端
+
+    使用相同base_url和连接池配置的LLM实例共用一个连接池，
+    避免每个实例各自进行TLS握手并分别耗尽连接。
+    base_url为空时使用llm_config.base_url。
+    """
+    http2 = llm_config.http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("未安装h2，无法启用HTTP/2，回退到HTTP/1.1")
+        http2 = False
+
+    key = (
+        base_url or llm_config.base_url,
+        llm_config.http_max_connections,
+        llm_config.http_max_keepalive_connections,
+        llm_config.http_keepalive_expiry,
+        http2,
+        llm_config.connect_timeout,
+        llm_config.read_timeout,
+    )
+    client = _HTTP_CLIENTS.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=llm_config.http_max_connections,
+                max_keepalive_connections=llm_config.http_max_keepalive_connections,
+                keepalive_expiry=llm_config.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                llm_config.read_timeout, connect=llm_config.connect_timeout
+            ),
+            follow_redirects=True,
+        )
+        _HTTP_CLIENTS[key] = client
+    return client
+
+
+class Endpoint:
+    """一个OpenAI兼容端点及其健康状态"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        http_client: httpx.AsyncClient,
+        weight: float = 1.0,
+    ):
+        self.base_url = base_url
+        self.weight = weight
+        self.http_client = http_client
+        # 重试由RetryPolicy和端点故障转移负责，关闭SDK内置的重试
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            timeout=http_client.timeout,
+            max_retries=0,
+        )
+
+        self.latency: Optional[float] = None  # 延迟的EWMA（秒）
+        self.error_rate = 0.0  # 错误率的EWMA
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "healthy": self.healthy,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class EndpointRouter:
+    """
+    按权重、延迟和错误率在多个端点间分配请求
+
+    每个端点维护延迟和错误率的EWMA，得分为 权重 / 延迟 * (1 - 错误率)，
+    按得分加权随机选择首选端点，其余端点按得分排序作为故障转移的备选。
+    连续失败达到阈值的端点会被暂时移出路由，到期后重新参与。
+    """
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        eject_failures: int = 3,
+        eject_seconds: float = 30.0,
+    ):
+        self.endpoints = endpoints
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+
+    @classmethod
+    def from_settings(cls, llm_config: LLMSettings) -> "EndpointRouter":
+        endpoint_configs = llm_config.endpoints or [
+            LLMEndpoint(base_url=llm_config.base_url, api_key=llm_config.api_key)
+        ]
+        endpoints = [
+            Endpoint(
+                base_url=endpoint.base_url,
+                api_key=endpoint.api_key,
+                http_client=get_shared_http_client(llm_config, endpoint.base_url),
+                weight=endpoint.weight,
+            )
+            for endpoint in endpoint_configs
+        ]
+        return cls(
+            endpoints,
+            eject_failures=llm_config.endpoint_eject_failures,
+            eject_seconds=llm_config.endpoint_eject_seconds,
+        )
+
+    @staticmethod
+    def is_endpoint_failure(exc: BaseException) -> bool:
+        """判断错误是否由端点本身引起，换一个端点可能成功"""
+        if isinstance(exc, (AuthenticationError, PermissionDeniedError)):
+            return True
+        return RetryPolicy.is_retryable(exc) and not isinstance(exc, LLMResponseError)
+
+    def _score(self, endpoint: Endpoint, default_latency: float) -> float:
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return endpoint.weight / max(latency, 1e-3) * max(1 - endpoint.error_rate, 0.01)
+
+    def candidates(self) -> List[Endpoint]:
+        """返回本次调用依次尝试的端点列表"""
+        healthy = [e for e in self.endpoints if e.healthy]
+        # 被移出的端点排在最后，只在所有健康端点都失败时尝试
+        ejected = sorted(
+            (e for e in self.endpoints if not e.healthy), key=lambda e: e.ejected_until
+        )
+        if len(healthy) <= 1:
+            return healthy + ejected
+
+        # 尚无延迟样本的端点按已知延迟的均值估计，保证其能被选中
+        known = [e.latency for e in healthy if e.latency is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        scores = {id(e): self._score(e, default_latency) for e in healthy}
+
+        first = random.choices(healthy, weights=[scores[id(e)] for e in healthy])[0]
+        rest = sorted(
+            (e for e in healthy if e is not first),
+            key=lambda e: scores[id(e)],
+            reverse=True,
+        )
+        return [first, *rest, *ejected]
+
+    def record_success(self, endpoint: Endpoint, latency: float) -> None:
+        endpoint.requests += 1
+        endpoint.consecutive_failures = 0
+        endpoint.latency = (
+            latency
+            if endpoint.latency is None
+            else self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * endpoint.latency
+        )
+        endpoint.error_rate *= 1 - self.EWMA_ALPHA
+
+    def record_failure(self, endpoint: Endpoint) -> None:
+        endpoint.requests += 1
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        endpoint.error_rate = self.EWMA_ALPHA + (1 - self.EWMA_ALPHA) * endpoint.error_rate
+        if endpoint.consecutive_failures >= self.eject_failures:
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+            endpoint.consecutive_failures = 0
+            logger.warning(
+                f"LLM端点 {endpoint.base_url} 连续失败{self.eject_failures}次，"
+                f"暂时移出路由{self.eject_seconds}秒"
+            )
+
+    def stats(self) -> List[dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
 
 
 class LLM:
@@ -192,12 +919,14 @@ class LLM:
     def __init__(
         self, config_name: str = "default", llm_config: Optional[LLMSettings] = None
     ):
-        if not hasattr(self, "client"):  # 仅在尚未初始化时进行初始化
+        if not hasattr(self, "router"):  # 仅在尚未初始化时进行初始化
             llm_config = llm_config or config.llm
             llm_config = llm_config.get(config_name, llm_config["default"])
             self.model = llm_config.model
             self.max_tokens = llm_config.max_tokens
             self.temperature = llm_config.temperature
+            self.context_window = llm_config.context_window
+            self.compaction_threshold = llm_config.compaction_threshold
             self.api_key = llm_config.api_key
             self.base_url = llm_config.base_url
 
@@ -217,19 +946,80 @@ class LLM:
                 # 如果模型不在tiktoken的预设中，使用cl100k_base作为默认
                 self.tokenizer = tiktoken.get_encoding("cl100k_base")
 
-            # 初始化OpenAI客户端
-            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+            # 初始化各端点的OpenAI客户端，底层连接池按base_url共享
+            self.router = EndpointRouter.from_settings(llm_config)
+            self.http_client = self.router.endpoints[0].http_client
+            self.connect_timeout = llm_config.connect_timeout
+            self.stream_usage = llm_config.stream_usage
 
             self.token_counter = TokenCounter(self.tokenizer)
 
+            # 该配置下所有调用共享的RPM/TPM限速器
+            self.rate_limiter = RateLimiter(llm_config.rpm_limit, llm_config.tpm_limit)
+
+            # 重试、对冲策略及其指标
+            self.retry_policy = RetryPolicy.from_settings(llm_config)
+
+            # 可选的磁盘响应缓存
+            self.response_cache: Optional[LLMResponseCache] = None
+            if llm_config.cache_enabled:
+                self.response_cache = LLMResponseCache.shared(
+                    llm_config.cache_dir or CACHE_ROOT / "llm",
+                    llm_config.cache_max_bytes,
+                )
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """首个端点的OpenAI客户端"""
+        return self.router.endpoints[0].client
+
+    @client.setter
+    def client(self, client: AsyncOpenAI) -> None:
+        self.router.endpoints[0].client = client
+
+    async def preconnect(self) -> None:
+        """
+        预先建立到所有API端点的连接
+
+        发送一个轻量的HEAD请求，使TCP/TLS握手在第一次LLM调用之前完成，
+        建立的连接会保留在共享连接池中。响应状态码被忽略。
+        """
+
+        async def head(endpoint: Endpoint) -> None:
+            try:
+                await endpoint.http_client.head(
+                    endpoint.base_url, timeout=self.connect_timeout
+                )
+                logger.info(f"已预先连接到LLM端点: {endpoint.base_url}")
+            except httpx.HTTPError as e:
+                logger.warning(f"预先连接LLM端点 {endpoint.base_url} 失败: {e}")
+
+        await asyncio.gather(*(head(endpoint) for endpoint in self.router.endpoints))
+
+    @classmethod
+    async def preconnect_all(cls) -> None:
+        """为所有已创建的LLM实例并发预先建立连接"""
+        await asyncio.gather(*(llm.preconnect() for llm in cls._instances.values()))
+
+    @staticmethod
+    async def close_shared_clients() -> None:
+        """关闭所有共享的HTTP客户端"""
+        clients = list(_HTTP_CLIENTS.values())
+        _HTTP_CLIENTS.clear()
+        await asyncio.gather(
+            *(client.aclose() for client in clients), return_exceptions=True
+        )
+
     def count_tokens(self, text: str) -> int:
         """计算文本中的token数量"""
         if not text:
             return 0
         return len(self.tokenizer.encode(text))
 
-    def count_message_tokens(self, messages: List[dict]) -> int:
-        return self.token_counter.count_message_tokens(messages)
+    def count_message_tokens(
+        self, messages: List[Union[dict, Message]], supports_images: bool = True
+    ) -> int:
+        return self.token_counter.count_message_tokens(messages, supports_images)
 
     def update_token_count(self, input_tokens: int, completion_tokens: int = 0) -> None:
         """更新token计数"""
@@ -259,6 +1049,144 @@ class LLM:
 
         return "超出Token限制"
 
+    def _cache_key(self, method: str, params: dict) -> Optional[str]:
+        """计算请求的缓存键，未启用缓存时返回None"""
+        if self.response_cache is None:
+            return None
+        request = {k: v for k, v in params.items() if k not in ("stream", "timeout")}
+        return LLMResponseCache.make_key(method=method, **request)
+
+    async def _cache_get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        value = await asyncio.to_thread(self.response_cache.get, key)
+        if value is not None:
+            logger.info("命中LLM响应缓存，跳过API调用")
+        return value
+
+    async def _cache_put(self, key: Optional[str], value: dict) -> None:
+        if key is not None:
+            await asyncio.to_thread(self.response_cache.put, key, value)
+
+    def cache_stats(self) -> Optional[dict]:
+        """返回响应缓存的命中统计，未启用缓存时返回None"""
+        return self.response_cache.stats() if self.response_cache else None
+
+    @classmethod
+    def metrics(cls) -> Dict[str, dict]:
+        """返回各LLM配置的运行指标，用于监控"""
+        return {
+            config_name: {
+                "model": llm.model,
+                "cache": llm.cache_stats(),
+                "rate_limit": llm.rate_limiter.utilization(),
+                "retry": llm.retry_policy.stats(),
+                "endpoints": llm.router.stats(),
+            }
+            for config_name, llm in cls._instances.items()
+        }
+
+    async def _create_chat_completion(self, input_tokens: int, **params):
+        """
+        所有补全请求的统一出口
+
+        先从限速器预留预算再调用API，完成后按实际用量修正预算，
+        流式响应在消费结束时修正。非流式请求在启用对冲时可能发出重复请求。
+        """
+        if not params.get("stream"):
+            hedge_delay = self.retry_policy.hedge_delay()
+            if hedge_delay is None:
+                return await self._timed_completion(input_tokens, params)
+            return await self._hedged_completion(input_tokens, params, hedge_delay)
+
+        reserved = await self.rate_limiter.acquire(input_tokens)
+        try:
+            response = await self._route_completion(params)
+        except BaseException:
+            # 请求失败时归还预留的token预算
+            self.rate_limiter.settle(reserved, 0)
+            raise
+        return self._settle_stream(response, reserved)
+
+    async def _route_completion(self, params: dict):
+        """
+        按路由顺序向端点发送请求
+
+        端点本身的故障（连接错误、5xx、429、认证失败）会立即转移到下一个端点，
+        所有端点都失败时抛出最后一个错误，交给RetryPolicy决定是否重试。
+        流式请求的延迟按收到响应头的时间计算。
+        """
+        last_error: Optional[Exception] = None
+        for endpoint in self.router.candidates():
+            start = time.monotonic()
+            try:
+                response = await endpoint.client.chat.completions.create(**params)
+            except Exception as e:
+                if not self.router.is_endpoint_failure(e):
+                    raise
+                self.router.record_failure(endpoint)
+                last_error = e
+                logger.warning(f"LLM端点 {endpoint.base_url} 请求失败: {e}")
+                continue
+            self.router.record_success(endpoint, time.monotonic() - start)
+            return response
+        raise last_error
+
+    async def _timed_completion(self, input_tokens: int, params: dict):
+        """发送一次非流式请求，并记录延迟样本"""
+        reserved = await self.rate_limiter.acquire(input_tokens)
+        start = time.monotonic()
+        try:
+            response = await self._route_completion(params)
+        except BaseException:
+            self.rate_limiter.settle(reserved, 0)
+            raise
+        self.retry_policy.record_latency(time.monotonic() - start)
+
+        usage = getattr(response, "usage", None)
+        total = getattr(usage, "total_tokens", None)
+        self.rate_limiter.settle(reserved, total if total is not None else reserved)
+        return response
+
+    async def _hedged_completion(self, input_tokens: int, params: dict, delay: float):
+        """首个请求超过delay仍未返回时发出对冲请求，采用先成功返回的结果"""
+        primary = asyncio.create_task(self._timed_completion(input_tokens, params))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+
+            self.retry_policy.hedges += 1
+            hedge = asyncio.create_task(self._timed_completion(input_tokens, params))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.retry_policy.hedge_wins += 1
+                        return task.result()
+            # 两个请求都失败时抛出首个请求的错误
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def _settle_stream(self, response, reserved: int):
+        """包装流式响应，在流结束后按usage修正限速预算"""
+        total = None
+        try:
+            async for chunk in response:
+                if getattr(chunk, "usage", None):
+                    total = chunk.usage.total_tokens
+                yield chunk
+        finally:
+            self.rate_limiter.settle(reserved, total if total is not None else reserved)
+
     @staticmethod
     def format_messages(
         messages: List[Union[dict, Message]], supports_images: bool = False
@@ -347,13 +1275,7 @@ class LLM:
 
         return formatted_messages
 
-    @retry(
-        wait=wait_random_exponential(min=1, max=60),
-        stop=stop_after_attempt(6),
-        retry=retry_if_exception_type(
-            (OpenAIError, Exception, ValueError)
-        ),  # 不要重试TokenLimitExceeded
-    )
+    @llm_retry
     async def ask(
         self,
         messages: List[Union[dict, Message]],
@@ -383,6 +1305,11 @@ class LLM:
             # 检查模型是否支持图像
             supports_images = self.model in MULTIMODAL_MODELS
 
+            # 在格式化之前计算输入token数量，Message对象可以使用缓存的计数
+            input_tokens = self.count_message_tokens(
+                (system_msgs or []) + messages, supports_images
+            )
+
             # 使用图像支持检查格式化系统和用户消息
             if system_msgs:
                 system_msgs = self.format_messages(system_msgs, supports_images)
@@ -390,9 +1317,6 @@ class LLM:
             else:
                 messages = self.format_messages(messages, supports_images)
 
-            # 计算输入token数量
-            input_tokens = self.count_message_tokens(messages)
-
             # 检查是否超过token限制
             if not self.check_token_limit(input_tokens):
                 error_message = self.get_limit_error_message(input_tokens)
@@ -412,26 +1336,36 @@ class LLM:
                     temperature if temperature is not None else self.temperature
                 )
 
+            cache_key = self._cache_key("ask", params)
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
+                return cached["content"]
+
             if not stream:
                 # 非流式请求
-                response = await self.client.chat.completions.create(
-                    **params, stream=False
+                response = await self._create_chat_completion(
+                    input_tokens, **params, stream=False
                 )
 
                 if not response.choices or not response.choices[0].message.content:
-                    raise ValueError("来自LLM的空或无效响应")
+                    raise LLMResponseError("来自LLM的空或无效响应")
 
                 # 更新token计数
                 self.update_token_count(
                     response.usage.prompt_tokens, response.usage.completion_tokens
                 )
 
+                await self._cache_put(
+                    cache_key, {"content": response.choices[0].message.content}
+                )
                 return response.choices[0].message.content
 
             # 流式请求，对于流式传输，在发出请求前更新估计的token计数
             self.update_token_count(input_tokens)
 
-            response = await self.client.chat.completions.create(**params, stream=True)
+            response = await self._create_chat_completion(
+                input_tokens, **params, stream=True
+            )
 
             collected_messages = []
             completion_text = ""
@@ -444,7 +1378,7 @@ class LLM:
             print()  # 流式传输后的换行
             full_response = "".join(collected_messages).strip()
             if not full_response:
-                raise ValueError("流式LLM响应为空")
+                raise LLMResponseError("流式LLM响应为空")
 
             # 估计流式响应的完成tokens
             completion_tokens = self.count_tokens(completion_text)
@@ -453,6 +1387,7 @@ class LLM:
             )
             self.total_completion_tokens += completion_tokens
 
+            await self._cache_put(cache_key, {"content": full_response})
             return full_response
 
         except TokenLimitExceeded:
@@ -474,13 +1409,7 @@ class LLM:
             logger.exception(f"ask中的意外错误")
             raise
 
-    @retry(
-        wait=wait_random_exponential(min=1, max=60),
-        stop=stop_after_attempt(6),
-        retry=retry_if_exception_type(
-            (OpenAIError, Exception, ValueError)
-        ),  # 不要重试TokenLimitExceeded
-    )
+    @llm_retry
     async def ask_with_images(
         self,
         messages: List[Union[dict, Message]],
@@ -584,19 +1513,27 @@ class LLM:
                     temperature if temperature is not None else self.temperature
                 )
 
+            cache_key = self._cache_key("ask_with_images", params)
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
+                return cached["content"]
+
             # 处理非流式请求
             if not stream:
-                response = await self.client.chat.completions.create(**params)
+                response = await self._create_chat_completion(input_tokens, **params)
 
                 if not response.choices or not response.choices[0].message.content:
-                    raise ValueError("来自LLM的空或无效响应")
+                    raise LLMResponseError("来自LLM的空或无效响应")
 
                 self.update_token_count(response.usage.prompt_tokens)
+                await self._cache_put(
+                    cache_key, {"content": response.choices[0].message.content}
+                )
                 return response.choices[0].message.content
 
             # 处理流式请求
             self.update_token_count(input_tokens)
-            response = await self.client.chat.completions.create(**params)
+            response = await self._create_chat_completion(input_tokens, **params)
 
             collected_messages = []
             async for chunk in response:
@@ -608,8 +1545,9 @@ class LLM:
             full_response = "".join(collected_messages).strip()
 
             if not full_response:
-                raise ValueError("流式LLM响应为空")
+                raise LLMResponseError("流式LLM响应为空")
 
+            await self._cache_put(cache_key, {"content": full_response})
             return full_response
 
         except TokenLimitExceeded:
@@ -630,13 +1568,7 @@ class LLM:
             logger.error(f"ask_with_images中的意外错误: {e}")
             raise
 
-    @retry(
-        wait=wait_random_exponential(min=1, max=60),
-        stop=stop_after_attempt(6),
-        retry=retry_if_exception_type(
-            (OpenAIError, Exception, ValueError)
-        ),  # 不要重试TokenLimitExceeded
-    )
+    @llm_retry
     async def ask_tool(
         self,
         messages: List[Union[dict, Message]],
@@ -645,6 +1577,9 @@ class LLM:
         tools: Optional[List[dict]] = None,
         tool_choice: TOOL_CHOICE_TYPE = ToolChoice.AUTO,  # type: ignore
         temperature: Optional[float] = None,
+        tools_tokens: Optional[int] = None,
+        stream: bool = False,
+        delta_queue: Optional[asyncio.Queue] = None,
         **kwargs,
     ) -> Tuple[ChatCompletionMessage | None, TokenUsage]:
         """
@@ -657,6 +1592,9 @@ class LLM:
             tools: 要使用的工具列表
             tool_choice: 工具选择策略
             temperature: 响应的采样温度
+            tools_tokens: 预先计算好的工具描述token数量，未提供时逐个计算
+            stream: 是否以流式方式请求，增量组装工具调用
+            delta_queue: 流式模式下接收增量事件的队列（格式见ToolCallStream）
             **kwargs: 额外的完成参数
 
         返回:
@@ -676,6 +1614,11 @@ class LLM:
             # 检查模型是否支持图像
             supports_images = self.model in MULTIMODAL_MODELS
 
+            # 在格式化之前计算输入token数量，Message对象可以使用缓存的计数
+            input_tokens = self.count_message_tokens(
+                (system_msgs or []) + messages, supports_images
+            )
+
             # 格式化消息
             if system_msgs:
                 system_msgs = self.format_messages(system_msgs, supports_images)
@@ -683,14 +1626,12 @@ class LLM:
             else:
                 messages = self.format_messages(messages, supports_images)
 
-            # 计算输入token数量
-            input_tokens = self.count_message_tokens(messages)
-
-            # 如果有工具，计算工具描述的token数量
-            tools_tokens = 0
-            if tools:
-                for tool in tools:
-                    tools_tokens += self.count_tokens(str(tool))
+            # 如果有工具且未提供预计算结果，计算工具描述的token数量
+            if tools_tokens is None:
+                tools_tokens = 0
+                if tools:
+                    for tool in tools:
+                        tools_tokens += self.count_tokens(str(tool))
 
             input_tokens += tools_tokens
 
@@ -724,8 +1665,29 @@ class LLM:
                     temperature if temperature is not None else self.temperature
                 )
 
-            response: ChatCompletion = await self.client.chat.completions.create(
-                **params, stream=False
+            cache_key = self._cache_key("ask_tool", params)
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
+                message = ChatCompletionMessage.model_validate(cached["message"])
+                if stream:
+                    self._emit_message_deltas(message, delta_queue)
+                return message, TokenUsage(**cached["token_usage"])
+
+            if stream:
+                message, token_usage = await self._stream_tool_completion(
+                    params, input_tokens, delta_queue
+                )
+                await self._cache_put(
+                    cache_key,
+                    {
+                        "message": message.model_dump(mode="json"),
+                        "token_usage": token_usage.to_dict(),
+                    },
+                )
+                return message, token_usage
+
+            response: ChatCompletion = await self._create_chat_completion(
+                input_tokens, **params, stream=False
             )
 
             # 检查响应是否有效
@@ -742,8 +1704,16 @@ class LLM:
             token_usage = TokenUsage(
                 input_tokens=response.usage.prompt_tokens,
                 output_tokens=response.usage.completion_tokens,
+                cached_tokens=self._cached_tokens(response.usage),
             )
 
+            await self._cache_put(
+                cache_key,
+                {
+                    "message": response.choices[0].message.model_dump(mode="json"),
+                    "token_usage": token_usage.to_dict(),
+                },
+            )
             return response.choices[0].message, token_usage
 
         except TokenLimitExceeded:
@@ -764,3 +1734,167 @@ class LLM:
         except Exception as e:
             logger.error(f"ask_tool中的意外错误: {e}")
             raise
+
+    async def _stream_tool_completion(
+        self,
+        params: dict,
+        input_tokens: int,
+        delta_queue: Optional[asyncio.Queue] = None,
+    ) -> Tuple[ChatCompletionMessage, TokenUsage]:
+        """以流式方式请求补全，边接收边转发增量并组装工具调用
+
+        中途失败时若已发送过增量，先发送reset事件，消费方丢弃本次尝试的内容，
+        避免重试后重复或错乱。
+        """
+        emitted = False
+
+        def emit(event: dict) -> None:
+            nonlocal emitted
+            if delta_queue is not None:
+                delta_queue.put_nowait(event)
+                emitted = True
+
+        response = await self._open_stream(input_tokens, params)
+
+        content_parts: List[str] = []
+        # 工具调用索引 -> 已组装的id、名称和参数
+        calls: Dict[int, Dict[str, str]] = {}
+        usage = None
+        try:
+            async for chunk in response:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+
+                if delta.content:
+                    content_parts.append(delta.content)
+                    emit({"type": "content", "text": delta.content})
+
+                for tool_call in delta.tool_calls or []:
+                    call = calls.setdefault(
+                        tool_call.index, {"id": "", "name": "", "arguments": ""}
+                    )
+                    if tool_call.id:
+                        call["id"] = tool_call.id
+                    arguments = ""
+                    if tool_call.function:
+                        if tool_call.function.name:
+                            call["name"] += tool_call.function.name
+                        arguments = tool_call.function.arguments or ""
+                        call["arguments"] += arguments
+                    emit(
+                        {
+                            "type": "tool_call",
+                            "index": tool_call.index,
+                            "id": call["id"],
+                            "name": call["name"],
+                            "arguments": arguments,
+                        }
+                    )
+        except Exception:
+            if emitted:
+                emit({"type": "reset"})
+            raise
+
+        content = "".join(content_parts)
+        message = ChatCompletionMessage(
+            role="assistant",
+            content=content or None,
+            tool_calls=[
+                ChatCompletionMessageToolCall(
+                    id=call["id"],
+                    type="function",
+                    function=Function(name=call["name"], arguments=call["arguments"]),
+                )
+                for _, call in sorted(calls.items())
+            ]
+            or None,
+        )
+
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            # 服务端未返回usage时使用本地估计
+            prompt_tokens = input_tokens
+            completion_tokens = self.count_tokens(content) + sum(
+                self.count_tokens(call["name"]) + self.count_tokens(call["arguments"])
+                for call in calls.values()
+            )
+        self.update_token_count(prompt_tokens, completion_tokens)
+
+        return message, TokenUsage(
+            input_tokens=prompt_tokens,
+            output_tokens=completion_tokens,
+            cached_tokens=self._cached_tokens(usage),
+        )
+
+    async def _open_stream(self, input_tokens: int, params: dict):
+        """发送流式请求；端点以400拒绝stream_options时去掉该参数重试一次，之后不再发送"""
+        if not self.stream_usage:
+            return await self._create_chat_completion(input_tokens, **params, stream=True)
+        try:
+            return await self._create_chat_completion(
+                input_tokens, **params, stream=True, stream_options={"include_usage": True}
+            )
+        except BadRequestError as e:
+            logger.warning(f"端点拒绝了带stream_options的流式请求（{e}），不带该参数重试")
+            response = await self._create_chat_completion(input_tokens, **params, stream=True)
+            # 不带该参数成功说明端点不支持，之后使用本地估计的用量
+            self.stream_usage = False
+            return response
+
+    @staticmethod
+    def _cached_tokens(usage: Any) -> int:
+        """从usage中读取命中服务端提示词缓存的输入token数"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+        if cached is None:
+            # 部分兼容网关直接在usage中返回Anthropic风格的字段
+            cached = getattr(usage, "cache_read_input_tokens", None)
+        return cached or 0
+
+    @staticmethod
+    def _emit_message_deltas(
+        message: ChatCompletionMessage, delta_queue: Optional[asyncio.Queue]
+    ) -> None:
+        """将完整消息作为增量事件发送（用于缓存命中时保持流式接口一致）"""
+        if delta_queue is None:
+            return
+        if message.content:
+            delta_queue.put_nowait({"type": "content", "text": message.content})
+        for index, call in enumerate(message.tool_calls or []):
+            delta_queue.put_nowait(
+                {
+                    "type": "tool_call",
+                    "index": index,
+                    "id": call.id,
+                    "name": call.function.name,
+                    "arguments": call.function.arguments,
+                }
+            )
+
+    def ask_tool_stream(self, messages: List[Union[dict, Message]], **kwargs) -> ToolCallStream:
+        """
+        以流式方式调用ask_tool
+
+        参数与ask_tool相同。返回的ToolCallStream可异步迭代得到增量事件，
+        并通过result()获取最终的(ChatCompletionMessage, TokenUsage)。
+        调用stream.disable_retry()后，中途失败不再重试。
+        """
+        stream: Optional[ToolCallStream] = None
+
+        def run(queue: asyncio.Queue):
+            return self.retry_policy.call(
+                type(self).ask_tool.__wrapped__,
+                self,
+                messages=messages,
+                stream=True,
+                delta_queue=queue,
+                retry_allowed=lambda: stream.retryable,
+                **kwargs,
+            )
+
+        stream = ToolCallStream(run)
+        return stream
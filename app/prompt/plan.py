@@ -0,0 +1,18 @@
+"""计划-执行模式代理的提示。"""
+
+from app.prompt.mcp import SYSTEM_PROMPT as MCP_SYSTEM_PROMPT
+
+SYSTEM_PROMPT = MCP_SYSTEM_PROMPT + """
+为了减少往返次数，优先使用`submit_plan`工具一次提交多步工具调用计划：
+- 计划中的步骤会按顺序在本地执行，不会每一步都询问你
+- 后续步骤的字符串参数可以用{{步骤id}}引用前面步骤的输出，用{{步骤id.字段}}引用JSON输出中的字段
+- 某一步失败时会停止执行，并把已有结果交给你重新规划
+- 下一步取决于某一步的结果时（分支点），为该步骤设置replan_after，执行到该步后会交给你决定
+- 当计划能完成任务时，将终止交互的工具作为最后一步
+只有在无法预先规划时，才直接调用单个工具。
+"""
+
+NEXT_STEP_PROMPT = """根据当前状态和已执行步骤的结果，提交接下来的工具调用计划。
+如果上一个计划失败了，先分析失败原因再调整计划。
+如果任务已经完成，请选择用于标记“终止交互”的工具来结束工作。
+"""
@@ -1,7 +1,7 @@
 from enum import Enum
-from typing import Any, List, Literal, Optional, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Set, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class Role(str, Enum):
@@ -61,6 +61,14 @@ class Message(BaseModel):
     tool_call_id: Optional[str] = Field(default=None)
     base64_image: Optional[str] = Field(default=None)
 
+    # Token count of to_dict() cached by TokenCounter, reset whenever a field is assigned
+    _token_count: Optional[int] = PrivateAttr(default=None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in type(self).model_fields:
+            self._token_count = None
+
     def __add__(self, other) -> List["Message"]:
         """支持 Message + list 或 Message + Message 的操作"""
         if isinstance(other, list):
@@ -156,6 +164,9 @@ class Message(BaseModel):
         )
 
 
+ELIDED_TOOL_OUTPUT_PREFIX = "[Earlier tool output elided to save context, original length "
+
+
 class Memory(BaseModel):
     messages: List[Message] = Field(default_factory=list)
     max_messages: int = Field(default=100)
@@ -183,9 +194,119 @@ class Memory(BaseModel):
         """Convert messages to list of dicts"""
         return [msg.to_dict() for msg in self.messages]
 
+    def _protected_indices(self, keep_recent: int) -> Set[int]:
+        """Indices of messages that compaction must keep verbatim.
+
+        These are system messages, the first user message (the task), the most
+        recent ``keep_recent`` messages and assistant messages whose tool calls
+        have not all been answered yet.
+        """
+        messages = self.messages
+        protected = {i for i, msg in enumerate(messages) if msg.role == Role.SYSTEM}
+        first_user = next(
+            (i for i, msg in enumerate(messages) if msg.role == Role.USER), None
+        )
+        if first_user is not None:
+            protected.add(first_user)
+        protected.update(range(max(len(messages) - keep_recent, 0), len(messages)))
+
+        answered = {msg.tool_call_id for msg in messages if msg.role == Role.TOOL}
+        for i, msg in enumerate(messages):
+            if msg.tool_calls and any(call.id not in answered for call in msg.tool_calls):
+                protected.add(i)
+        return protected
+
+    def _tool_call_groups(self) -> List[List[int]]:
+        """Group each assistant tool-call message with its tool results.
+
+        A group has to be dropped as a whole, otherwise the request would contain
+        tool calls without results (or results without calls).
+        """
+        groups: List[List[int]] = []
+        owner: Dict[str, List[int]] = {}
+        for i, msg in enumerate(self.messages):
+            if msg.role == Role.TOOL and msg.tool_call_id in owner:
+                owner[msg.tool_call_id].append(i)
+                continue
+            group = [i]
+            groups.append(group)
+            for call in msg.tool_calls or []:
+                owner[call.id] = group
+        return groups
+
+    def compact(
+        self,
+        count_tokens: Callable[[List[Message]], int],
+        max_tokens: int,
+        keep_recent: int = 6,
+        preview_chars: int = 200,
+    ) -> int:
+        """Shrink the history until it fits into ``max_tokens``.
+
+        Old tool observations are elided first, keeping a short preview. If the
+        history is still too large, the oldest messages are dropped together with
+        their tool_call/tool pairs. Protected messages are never touched, see
+        ``_protected_indices``.
+
+        Args:
+            count_tokens: Counts the prompt tokens of a list of messages
+            max_tokens: Token budget for the history
+            keep_recent: Number of most recent messages kept verbatim
+            preview_chars: Characters of an elided tool output that are kept
+
+        Returns:
+            int: Number of tokens saved
+        """
+        before = count_tokens(self.messages)
+        current = before
+        if current <= max_tokens:
+            return 0
+
+        protected = self._protected_indices(keep_recent)
+
+        # 1. Elide old tool outputs, oldest first
+        for i, msg in enumerate(self.messages):
+            if current <= max_tokens:
+                break
+            if (
+                i in protected
+                or msg.role != Role.TOOL
+                or not msg.content
+                or msg.content.startswith(ELIDED_TOOL_OUTPUT_PREFIX)
+                or len(msg.content) <= preview_chars
+            ):
+                continue
+            msg.content = (
+                f"{ELIDED_TOOL_OUTPUT_PREFIX}{len(msg.content)} chars]\n"
+                f"{msg.content[:preview_chars]}"
+            )
+            msg.base64_image = None
+            current = count_tokens(self.messages)
+
+        # 2. Drop the oldest unprotected messages, keeping tool call pairs intact
+        if current > max_tokens:
+            dropped: Set[int] = set()
+            for group in self._tool_call_groups():
+                if current <= max_tokens:
+                    break
+                if protected.intersection(group):
+                    continue
+                dropped.update(group)
+                current = count_tokens(
+                    [m for i, m in enumerate(self.messages) if i not in dropped]
+                )
+            self.messages = [m for i, m in enumerate(self.messages) if i not in dropped]
+
+        return before - current
+
+
 class TokenUsage(BaseModel):
     input_tokens: int = Field(default=0)
     output_tokens: int = Field(default=0)
+    # Input tokens served from the provider's prompt cache
+    cached_tokens: int = Field(default=0)
+    # Prompt tokens removed from the history by context compaction in this step
+    saved_tokens: int = Field(default=0)
 
     def to_dict(self) -> dict:
         return self.model_dump()
@@ -2,7 +2,8 @@ from app.config import WORKSPACE_ROOT
 
 def get_aml_model_evaluation_prompt(model_name: str, 
                                    zip_filename: str,
-                                   metrics_list: list = None) -> str:
+                                   metrics_list: list = None,
+                                   output_dir: str = f"{WORKSPACE_ROOT}/temp") -> str:
     """
     生成AML模型技术评测的提示词
     
@@ -10,6 +11,7 @@ def get_aml_model_evaluation_prompt(model_name: str,
         model_name: 需要评测的模型名称
         zip_filename: 数据集文件路径
         metrics_list: 评测指标列表，默认为None（评测所有指标）
+        output_dir: 评测结果的输出目录
     
     返回:
         用于Agent的提示词字符串
@@ -30,6 +32,6 @@ def get_aml_model_evaluation_prompt(model_name: str,
     如果使用数据集文件访问MCP服务失败，可以直接用云上数据集url访问：https://lhcos-84055-1317429791.cos.ap-shanghai.myqcloud.com/ioeb/test_dataset.zip
     但是请注意，如果使用url请求MCP服务，必须将url作为MCP Tool的参数传入才能正确访问MCP工具
     此外，MCP Tool的Model Name 需要使用 `HattenGCN` 作为参数
-    请将评测结果写入`{WORKSPACE_ROOT}/temp/model_evaluation_result.json`文件中。
+    请将评测结果写入`{output_dir}/model_evaluation_result.json`文件中。
     """
     return prompt 
\ No newline at end of file
@@ -1,13 +1,15 @@
 from app.config import WORKSPACE_ROOT
 
 def get_aml_report_prompt(workspace: str, 
-                          input_dir: str) -> str:
+                          input_dir: str,
+                          output_dir: str = f"{WORKSPACE_ROOT}/temp") -> str:
     """
     生成AML报告任务的提示词
     
     参数:
         workspace: 工作区路径
         input_dir: 输入数据集文件路径
+        output_dir: 报告的输出目录
         
     返回:
         构建好的提示词字符串
@@ -17,7 +19,7 @@ def get_aml_report_prompt(workspace: str,
 
     输入数据集位于: {input_dir}
 
-    请将AML报告写入 `{WORKSPACE_ROOT}/temp/aml_report.md` 文件中。
+    请将AML报告写入 `{output_dir}/aml_report.md` 文件中。
     """
     
     return prompt 
\ No newline at end of file
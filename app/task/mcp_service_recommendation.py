@@ -1,13 +1,15 @@
 import os
 from app.config import WORKSPACE_ROOT
 
-def get_mcp_service_recommendation_prompt(message: str, service_type: str):
+def get_mcp_service_recommendation_prompt(message: str, service_type: str,
+                                          output_dir: str = f"{WORKSPACE_ROOT}/temp"):
     """
     生成MCP服务推荐任务的prompt
     
     参数：
         message: 用户的需求描述
         service_type: 服务类型，用于过滤domain字段
+        output_dir: 推荐结果的输出目录
     
     返回：
         生成的prompt字符串
@@ -41,7 +43,7 @@ def get_mcp_service_recommendation_prompt(message: str, service_type: str):
 
 5. 如果数据库中没有合适的服务能够满足用户需求，应该返回推荐失败的结果。
 
-6. 将推荐结果按照指定的JSON格式保存到 `{WORKSPACE_ROOT}/temp/mcp_recommendation_result.json` 文件中。
+6. 将推荐结果按照指定的JSON格式保存到 `{output_dir}/mcp_recommendation_result.json` 文件中。
 
 输出格式要求：
 - 文件内容必须是严格的JSON格式
@@ -2,7 +2,8 @@ from app.config import WORKSPACE_ROOT
 
 def get_meta_app_validation_prompt(meta_app_api: str, 
                                      metrics_list: list, 
-                                     zip_filename: str) -> str:
+                                     zip_filename: str,
+                                     output_dir: str = f"{WORKSPACE_ROOT}/temp") -> str:
     """
     生成元应用数据验证任务的提示词
     
@@ -10,6 +11,7 @@ def get_meta_app_validation_prompt(meta_app_api: str,
         meta_app_api: 待测试的元应用的API端点（SSE端点）
         metrics_list: 需要评测的指标列表（查全率/查准率/计算效率中的一个或多个）
         zip_filename: 数据集文件路径
+        output_dir: 评测结果的输出目录
         
     返回:
         构建好的提示词字符串
@@ -33,6 +35,6 @@ def get_meta_app_validation_prompt(meta_app_api: str,
 
     **由于目前元应用 API尚不可用，因此请直接返回mock的评测结果**
     
-    请将评测结果写入 `{WORKSPACE_ROOT}/temp/validation_result.json` 文件中。
+    请将评测结果写入 `{output_dir}/validation_result.json` 文件中。
     """
     return prompt 
\ No newline at end of file
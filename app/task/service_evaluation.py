@@ -63,7 +63,8 @@ services = """[
 
 def get_service_evaluation_prompt(service_name:str, 
                                   metrics_list:list, 
-                                  zip_filename:str) -> str:
+                                  zip_filename:str,
+                                  output_dir:str = f"{WORKSPACE_ROOT}/temp") -> str:
     prompt = f"""对远程服务 '{service_name}' 进行以下指标的评测: {', '.join(metrics_list)}。
     评测数据位于: {zip_filename}
 
@@ -76,6 +77,6 @@ def get_service_evaluation_prompt(service_name:str,
 
     不用解压评测数据，直接使用其访问远程服务的API端点。
     
-    请将评测结果写入`{WORKSPACE_ROOT}/temp/evaluation_result.json`文件中。
+    请将评测结果写入`{output_dir}/evaluation_result.json`文件中。
     """
     return prompt
\ No newline at end of file
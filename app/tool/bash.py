@@ -136,10 +136,18 @@ class Bash(BaseTool):
     }
 
     _session: Optional[_BashSession] = None
+    _lock: Optional[asyncio.Lock] = None
 
     async def execute(
         self, command: str | None = None, restart: bool = False, **kwargs
     ) -> CLIResult:
+        # 同一个shell会话一次只能运行一条命令，并发调用按顺序执行，避免输出和哨兵交错
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await self._execute(command, restart)
+
+    async def _execute(self, command: str | None, restart: bool) -> CLIResult:
         if restart:
             if self._session:
                 self._session.stop()
@@ -1,14 +1,21 @@
-from contextlib import AsyncExitStack
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import asyncio
 
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.sse import sse_client
-from mcp.client.stdio import stdio_client
+from mcp import ClientSession
 from mcp.types import TextContent
 
+from app.exceptions import MCPServerUnavailable
 from app.logger import logger
 from app.tool.base import BaseTool, ToolResult
+from app.tool.mcp_cache import LazySession, ToolSchemaCache
+from app.tool.mcp_guard import MCPCallGuards, ServerGuard, resolve_timeout
+from app.tool.mcp_lifecycle import ManagedConnection, MCPLifecycleManager
+from app.tool.mcp_pool import (
+    MCPSessionPool,
+    NotifyingClientSession,
+    PooledSession,
+    server_key,
+)
 from app.tool.tool_collection import ToolCollection
 
 
@@ -18,6 +25,8 @@ class MCPClientTool(BaseTool):
     session: Optional[ClientSession] = None
     server_id: str = None  # 添加服务器ID以跟踪工具所属的服务器
     original_name: str = None  # 存储原始工具名（无前缀）
+    guard: Optional[Any] = None  # 所属服务器的ServerGuard，负责隔离舱和熔断
+    timeout: Optional[float] = None  # 调用超时（秒），None表示不限制
 
     def __init__(
         self,
@@ -27,12 +36,16 @@ class MCPClientTool(BaseTool):
         session: ClientSession = None,
         server_id: str = None,
         original_name: str = None,
+        guard: Optional[ServerGuard] = None,
+        timeout: Optional[float] = None,
     ):
         """初始化MCP客户端工具。"""
         super().__init__(name=name, description=description, parameters=parameters)
         self.session = session
         self.server_id = server_id
         self.original_name = original_name
+        self.guard = guard
+        self.timeout = timeout
 
     async def execute(self, **kwargs) -> ToolResult:
         """通过向MCP服务器发起远程调用来执行工具。"""
@@ -50,12 +63,24 @@ class MCPClientTool(BaseTool):
                 # 对于终止工具，只记录简单的日志，避免与_handle_special_tool重复
                 logger.info(f"准备执行终止工具 {self.name} -> {tool_name}")
             
-            result = await self.session.call_tool(tool_name, kwargs)
+            call = lambda: self.session.call_tool(tool_name, kwargs)
+            if self.guard is not None:
+                result = await self.guard.call(call, self.timeout)
+            else:
+                result = await asyncio.wait_for(call(), self.timeout)
             content_str = ", ".join(
                 item.text for item in result.content if isinstance(item, TextContent)
             )
             
             return ToolResult(output=content_str or "未返回输出。")
+        except MCPServerUnavailable as e:
+            logger.warning(f"MCP服务器 {self.server_id} 不可用，跳过工具 {self.name}: {str(e)}")
+            return ToolResult(
+                error=f"MCP服务器 {self.server_id} 暂时不可用（{str(e)}），请改用其他工具或稍后再试"
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"执行工具 {self.name} -> {tool_name} 超时（{self.timeout}秒）")
+            return ToolResult(error=f"执行工具超时（{self.timeout}秒），MCP服务器 {self.server_id} 未及时响应")
         except Exception as e:
             logger.error(f"执行工具 {self.name} -> {tool_name} 时出错: {str(e)}")
             return ToolResult(error=f"执行工具时出错: {str(e)}")
@@ -67,18 +92,120 @@ class MCPClients(ToolCollection):
     """
 
     sessions: Dict[str, ClientSession] = {}  # 服务器ID到会话的映射
-    exit_stacks: Dict[str, AsyncExitStack] = {}  # 服务器ID到退出栈的映射
+    connections: Dict[str, ManagedConnection] = {}  # 服务器ID到独占连接的映射（不使用会话池时）
+    guards: Dict[str, ServerGuard] = {}  # 服务器ID到调用保护的映射
     description: str = "用于服务器交互的MCP客户端工具"
     
     # 保留默认会话以保持向后兼容
     session: Optional[ClientSession] = None
-    exit_stack: Optional[AsyncExitStack] = None
 
-    def __init__(self):
+    def __init__(
+        self,
+        use_session_pool: Optional[bool] = None,
+        pool_stdio: Optional[bool] = None,
+        lazy_connect: Optional[bool] = None,
+        schema_cache: Optional[ToolSchemaCache] = None,
+    ):
+        """
+        参数:
+            use_session_pool: 是否从进程级会话池获取连接，None表示按config.mcp.session_pool
+            pool_stdio: 会话池是否也用于stdio服务器，None表示按config.mcp.pool_stdio
+            lazy_connect: 是否先用缓存的工具模式注册工具、首次调用时才连接，
+                None表示按config.mcp.lazy_connect
+            schema_cache: 工具模式缓存，None表示使用config.mcp.schema_cache_dir
+        """
         super().__init__()  # 使用空工具列表初始化
         self.name = "mcp"  # 保持名称以向后兼容
         self.sessions = {}
-        self.exit_stacks = {}
+        self.connections = {}
+        self.guards = {}
+
+        from app.config import config
+
+        if use_session_pool is None:
+            use_session_pool = config.mcp.session_pool
+        if pool_stdio is None:
+            pool_stdio = config.mcp.pool_stdio
+        if lazy_connect is None:
+            lazy_connect = config.mcp.lazy_connect
+        self.use_session_pool = use_session_pool
+        self.pool_stdio = pool_stdio
+        self.lazy_connect = lazy_connect
+        self.schema_cache = schema_cache or ToolSchemaCache(
+            config.mcp.schema_cache_dir,
+            version_ttl=config.mcp.schema_version_ttl,
+            max_age=config.mcp.schema_cache_max_age,
+        )
+
+    def _pooled(self, key) -> bool:
+        """该服务器是否使用共享会话池；stdio服务器保存shell等状态，默认不共享"""
+        return self.use_session_pool and (key[0] != "stdio" or self.pool_stdio)
+
+    async def _connect_pooled(self, key, server_id: str) -> str:
+        """从共享会话池获取连接，并以本集合的前缀注册工具"""
+        session = await MCPSessionPool.shared().acquire(key)
+        self.sessions[server_id] = session
+        if not self.session:
+            self.session = session
+        self._register_tools(server_id, session, session.server.tools)
+        if self.lazy_connect:
+            await asyncio.to_thread(self.schema_cache.store, key, session.server.tools)
+        return server_id
+
+    async def _open_direct(self, key, server_id: str) -> ManagedConnection:
+        """建立本集合独占的连接，连接由生命周期管理器的后台任务持有并在关闭时回收"""
+        connection = await MCPLifecycleManager.shared().open(
+            key, NotifyingClientSession, label=server_id
+        )
+        self.connections[server_id] = connection
+        return connection
+
+    async def _connect_direct(self, key, server_id: str) -> str:
+        """不使用会话池时建立连接并注册工具"""
+        connection = await self._open_direct(key, server_id)
+        try:
+            self.sessions[server_id] = connection.session
+            if not self.session:
+                self.session = connection.session
+            await self._initialize_and_list_tools(server_id, key)
+        except BaseException:
+            self.sessions.pop(server_id, None)
+            self.connections.pop(server_id, None)
+            if self.session is connection.session:
+                self.session = next(iter(self.sessions.values()), None)
+            await connection.close()
+            raise
+        return server_id
+
+    def _try_connect_lazy(self, key, server_id: str) -> bool:
+        """工具模式已缓存时注册延迟连接的会话，不进行握手
+
+        返回:
+            bool: 是否命中缓存
+        """
+        cached_tools = self.schema_cache.load(key)
+        if cached_tools is None:
+            return False
+
+        async def connect():
+            if self._pooled(key):
+                return await MCPSessionPool.shared().acquire(key)
+            connection = await self._open_direct(key, server_id)
+            try:
+                await connection.session.initialize()
+            except BaseException:
+                self.connections.pop(server_id, None)
+                await connection.close()
+                raise
+            return connection.session
+
+        session = LazySession(key, cached_tools, connect, self.schema_cache)
+        self.sessions[server_id] = session
+        if not self.session:
+            self.session = session
+        self._register_tools(server_id, session, cached_tools)
+        logger.info(f"使用缓存的工具模式注册服务器 {server_id}，首次调用工具时再连接")
+        return True
 
     async def connect_sse(self, server_url: str, server_id: str = None) -> str:
         """
@@ -97,45 +224,18 @@ class MCPClients(ToolCollection):
         # 如果未提供ID则生成唯一ID
         if not server_id:
             server_id = f"sse_{len(self.sessions)}"
-            
-        # 创建新的退出栈
-        exit_stack = AsyncExitStack()
-        
-        try:
-            # 将退出栈添加到字典中，这样可以在出错时找到它
-            self.exit_stacks[server_id] = exit_stack
-
-            # 连接到服务器
-            streams_context = sse_client(url=server_url)
-            streams = await exit_stack.enter_async_context(streams_context)
-            session = await exit_stack.enter_async_context(
-                ClientSession(*streams)
-            )
-            
-            # 存储会话
-            self.sessions[server_id] = session
-            
-            # 设置默认会话（向后兼容）
-            if not self.session:
-                self.session = session
-                self.exit_stack = exit_stack
 
-            # 初始化工具
-            await self._initialize_and_list_tools(server_id)
-            
+        key = server_key("sse", server_url=server_url)
+        self.guards[server_id] = MCPCallGuards.shared().get(key)
+        if self.lazy_connect and self._try_connect_lazy(key, server_id):
             return server_id
+        if self._pooled(key):
+            return await self._connect_pooled(key, server_id)
+
+        try:
+            return await self._connect_direct(key, server_id)
         except Exception as e:
-            # 如果在过程中出错，确保退出栈被正确关闭
             logger.error(f"连接SSE服务器时出错: {str(e)}")
-            try:
-                await exit_stack.aclose()
-                # 移除对退出栈的引用
-                if server_id in self.exit_stacks:
-                    del self.exit_stacks[server_id]
-                if server_id in self.sessions:
-                    del self.sessions[server_id]
-            except Exception as close_err:
-                logger.error(f"关闭退出栈时出错: {str(close_err)}")
             raise
 
     async def connect_stdio(self, command: str, args: List[str], server_id: str = None) -> str:
@@ -156,56 +256,27 @@ class MCPClients(ToolCollection):
         # 如果未提供ID则生成唯一ID
         if not server_id:
             server_id = f"stdio_{len(self.sessions)}"
-        
-        # 创建新的退出栈    
-        exit_stack = AsyncExitStack()
-        
-        try:
-            # 保存退出栈引用
-            self.exit_stacks[server_id] = exit_stack
-
-            # 连接到服务器
-            server_params = StdioServerParameters(command=command, args=args)
-            stdio_transport = await exit_stack.enter_async_context(
-                stdio_client(server_params)
-            )
-            read, write = stdio_transport
-            session = await exit_stack.enter_async_context(
-                ClientSession(read, write)
-            )
-            
-            # 存储会话
-            self.sessions[server_id] = session
-            
-            # 设置默认会话（向后兼容）
-            if not self.session:
-                self.session = session
-                self.exit_stack = exit_stack
 
-            # 初始化工具
-            await self._initialize_and_list_tools(server_id)
-            
+        key = server_key("stdio", command=command, args=args)
+        self.guards[server_id] = MCPCallGuards.shared().get(key)
+        if self.lazy_connect and self._try_connect_lazy(key, server_id):
             return server_id
+        if self._pooled(key):
+            return await self._connect_pooled(key, server_id)
+
+        try:
+            return await self._connect_direct(key, server_id)
         except Exception as e:
-            # 如果在过程中出错，确保退出栈被正确关闭
             logger.error(f"连接stdio服务器时出错: {str(e)}")
-            try:
-                await exit_stack.aclose()
-                # 移除对退出栈的引用
-                if server_id in self.exit_stacks:
-                    del self.exit_stacks[server_id]
-                if server_id in self.sessions:
-                    del self.sessions[server_id]
-            except Exception as close_err:
-                logger.error(f"关闭退出栈时出错: {str(close_err)}")
             raise
 
-    async def _initialize_and_list_tools(self, server_id: str) -> None:
+    async def _initialize_and_list_tools(self, server_id: str, key=None) -> None:
         """
         初始化会话并填充工具映射。
         
         参数:
             server_id: 服务器的唯一标识符
+            key: 服务器配置的池键，启用延迟连接时用于写入工具模式缓存
         """
         session = self.sessions.get(server_id)
         if not session:
@@ -213,28 +284,43 @@ class MCPClients(ToolCollection):
 
         await session.initialize()
         response = await session.list_tools()
+        self._register_tools(server_id, session, response.tools)
+        if self.lazy_connect and key is not None:
+            await asyncio.to_thread(self.schema_cache.store, key, response.tools)
 
+    def _register_tools(self, server_id: str, session, tools) -> None:
+        """以服务器ID为前缀将服务器工具加入工具映射"""
         # 为每个服务器工具创建适当的工具对象
         new_tools = []
-        for tool in response.tools:
+        for tool in tools:
             # 使用服务器ID前缀来避免工具名称冲突，用下划线替代点号
             tool_name = f"{server_id}_{tool.name}"
             
-            server_tool = MCPClientTool(
-                name=tool_name,
-                description=f"[{server_id}] {tool.description}",
-                parameters=tool.inputSchema,
-                session=session,
-                server_id=server_id,
-                original_name=tool.name,  # 存储原始工具名
-            )
+            server_tool = self._make_tool(server_id, session, tool)
             self.tool_map[tool_name] = server_tool
             new_tools.append(server_tool)
 
         # 更新工具列表
         self.tools = tuple(list(self.tools) + new_tools)
+        if new_tools:
+            self.invalidate_params()
         logger.info(
-            f"已连接到服务器 {server_id}，具有以下工具: {[tool.name for tool in response.tools]}"
+            f"已连接到服务器 {server_id}，具有以下工具: {[tool.name for tool in tools]}"
+        )
+
+    def _make_tool(self, server_id: str, session, tool) -> MCPClientTool:
+        """创建带服务器前缀的工具代理，超时按工具、服务器、全局默认的顺序确定"""
+        guard = self.guards.get(server_id)
+        server_url = guard.key[1] if guard is not None and guard.key[0] == "sse" else None
+        return MCPClientTool(
+            name=f"{server_id}_{tool.name}",
+            description=f"[{server_id}] {tool.description}",
+            parameters=tool.inputSchema,
+            session=session,
+            server_id=server_id,
+            original_name=tool.name,  # 存储原始工具名
+            guard=guard,
+            timeout=resolve_timeout(server_id, tool.name, server_url),
         )
 
     async def disconnect(self, server_id: str = None) -> None:
@@ -245,14 +331,14 @@ class MCPClients(ToolCollection):
             server_id: 要断开的服务器ID，如果为None则断开所有连接
         """
         if server_id is None:
-            # 断开所有连接
-            # 先保存服务器ID列表，以免在循环中修改字典
+            # 断开所有连接，各连接的关闭时限相互独立
             server_ids = list(self.sessions.keys())
-            for sid in server_ids:
-                try:
-                    await self.disconnect(sid)
-                except Exception as e:
-                    logger.error(f"断开服务器 {sid} 连接时出错: {str(e)}")
+            results = await asyncio.gather(
+                *(self.disconnect(sid) for sid in server_ids), return_exceptions=True
+            )
+            for sid, result in zip(server_ids, results):
+                if isinstance(result, Exception):
+                    logger.error(f"断开服务器 {sid} 连接时出错: {str(result)}")
             return
             
         if server_id in self.sessions:
@@ -269,72 +355,80 @@ class MCPClients(ToolCollection):
                 # 更新工具列表，不包括要删除的服务器的工具
                 self.tools = tuple(tool for tool in self.tools if 
                                 not (isinstance(tool, MCPClientTool) and tool.server_id == server_id))
-                
-                # 保存一个本地引用，这样即使删除了字典中的引用，也能关闭这个会话和栈
-                session_ref = self.sessions.get(server_id)
-                exit_stack_ref = self.exit_stacks.get(server_id)
+                if tools_to_remove:
+                    self.invalidate_params()
                 
                 # 先从字典中移除引用，防止任何后续操作继续使用这些引用
-                if server_id in self.sessions:
-                    del self.sessions[server_id]
-                if server_id in self.exit_stacks:
-                    del self.exit_stacks[server_id]
+                session_ref = self.sessions.pop(server_id, None)
+                connection = self.connections.pop(server_id, None)
+                self.guards.pop(server_id, None)
                     
                 # 如果断开的是默认会话，则重置默认会话
-                if self.session == session_ref:
-                    if self.sessions:
-                        # 随机选择一个会话作为新的默认会话
-                        first_id = next(iter(self.sessions))
-                        self.session = self.sessions[first_id]
-                        self.exit_stack = self.exit_stacks[first_id]
-                    else:
-                        self.session = None
-                        self.exit_stack = None
+                if self.session is session_ref:
+                    self.session = next(iter(self.sessions.values()), None)
                 
-                # 安全关闭会话和退出栈
-                if exit_stack_ref is not None:
-                    logger.info(f"安全关闭服务器 {server_id} 的会话和退出栈")
-                    
-                    # 使用一个分离的、不受当前取消作用域影响的函数来关闭会话
-                    async def close_detached():
-                        try:
-                            # 使用一个新的事件循环来关闭栈，避免cancel scope传播
-                            def sync_close():
-                                try:
-                                    # 创建一个新的事件循环并在其中运行关闭操作
-                                    loop = asyncio.new_event_loop()
-                                    asyncio.set_event_loop(loop)
-                                    try:
-                                        # 在新循环中关闭栈
-                                        loop.run_until_complete(exit_stack_ref.aclose())
-                                    finally:
-                                        loop.close()
-                                except Exception as e:
-                                    # 不能在这里使用日志（可能会导致异步问题）
-                                    pass
-                            
-                            # 在一个新线程中运行同步关闭函数
-                            import threading
-                            close_thread = threading.Thread(target=sync_close)
-                            close_thread.daemon = True  # 设置为守护线程，不阻止程序退出
-                            close_thread.start()
-                            close_thread.join(timeout=2.0)  # 等待最多2秒
-                        except Exception:
-                            # 任何错误都被忽略
-                            pass
-                    
-                    # 创建并立即运行关闭任务，不等待其完成
-                    asyncio.create_task(close_detached())
+                # 共享会话只归还引用，由会话池决定何时关闭
+                if isinstance(session_ref, (PooledSession, LazySession)):
+                    await session_ref.release()
+
+                # 独占连接在持有它的后台任务中关闭，超时后强制结束并回收子进程
+                if connection is not None:
+                    logger.info(f"关闭服务器 {server_id} 的连接")
+                    await connection.close()
                 
                 logger.info(f"已断开与MCP服务器 {server_id} 的连接")
                 
             except Exception as e:
                 logger.error(f"断开服务器 {server_id} 连接时出错: {str(e)}")
                 # 确保从字典中移除，即使出错
-                if server_id in self.sessions:
-                    del self.sessions[server_id]
-                if server_id in self.exit_stacks:
-                    del self.exit_stacks[server_id]
+                self.sessions.pop(server_id, None)
+                self.connections.pop(server_id, None)
+
+    def sync_server_tools(self, server_id: str, tools) -> None:
+        """用服务器的最新工具列表更新该服务器的工具，其他服务器的工具不变
+
+        已有工具原位更新描述和参数，新工具追加在该服务器已有工具之后。
+        """
+        session = self.sessions.get(server_id)
+        current = {f"{server_id}_{tool.name}": tool for tool in tools}
+        updated = []
+        for existing in self.tools:
+            if getattr(existing, "server_id", None) != server_id:
+                updated.append(existing)
+                continue
+            tool = current.pop(existing.name, None)
+            if tool is not None:
+                existing.description = f"[{server_id}] {tool.description}"
+                existing.parameters = tool.inputSchema
+                updated.append(existing)
+        new_tools = [self._make_tool(server_id, session, tool) for tool in current.values()]
+        # 新工具放在该服务器最后一个工具之后
+        last = max(
+            (i for i, t in enumerate(updated) if getattr(t, "server_id", None) == server_id),
+            default=len(updated) - 1,
+        )
+        updated[last + 1:last + 1] = new_tools
+
+        self.tools = tuple(updated)
+        self.tool_map = {tool.name: tool for tool in updated}
+        self.invalidate_params()
+
+    def reorder_tools(self, server_ids: List[str]) -> None:
+        """按给定的服务器顺序排列工具，使并发连接后的工具顺序与完成顺序无关
+
+        同一服务器的工具保持list_tools返回的顺序，不属于这些服务器的工具排在最前。
+        """
+        position = {server_id: index for index, server_id in enumerate(server_ids)}
+        ordered = tuple(
+            sorted(
+                self.tools,
+                key=lambda tool: position.get(getattr(tool, "server_id", None), -1),
+            )
+        )
+        if ordered != self.tools:
+            self.tools = ordered
+            self.tool_map = {tool.name: tool for tool in ordered}
+            self.invalidate_params()
 
     def get_server_ids(self) -> List[str]:
         """获取所有已连接服务器的ID列表"""
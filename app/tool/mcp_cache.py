@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from mcp.types import ListToolsResult, Tool
+
+from app.config import CACHE_ROOT, PROJECT_ROOT
+from app.logger import logger
+from app.tool.mcp_pool import ServerKey
+
+
+# stdio服务器 -> (过期时间, 版本哈希)，每个进程一份
+_versions: Dict[ServerKey, Tuple[float, str]] = {}
+
+
+def server_version(key: ServerKey, ttl: float = 0.0) -> str:
+    """服务器代码的版本哈希，代码变化后缓存的工具模式自动失效
+
+    stdio服务器按`-m 模块`所在的顶层包或脚本所在目录中.py文件的路径、大小和修改时间计算，
+    ttl大于0时在ttl秒内复用上次的结果，不重复遍历目录；
+    其他服务器（如sse）无法从本地判断版本，返回空字符串，由ToolSchemaCache按max_age过期。
+    """
+    if key[0] != "stdio":
+        return ""
+    now = time.monotonic()
+    cached = _versions.get(key)
+    if ttl > 0 and cached is not None and now < cached[0]:
+        return cached[1]
+    version = _hash_server_code(key[2])
+    if ttl > 0:
+        _versions[key] = (now + ttl, version)
+    return version
+
+
+def _hash_server_code(args) -> str:
+    roots: List[Path] = []
+    if "-m" in args and args.index("-m") + 1 < len(args):
+        package = args[args.index("-m") + 1].split(".")[0]
+        roots.append(PROJECT_ROOT / package)
+    roots += [Path(arg).parent for arg in args if arg.endswith(".py") and Path(arg).is_file()]
+
+    digest = hashlib.sha256()
+    for root in roots:
+        if not root.is_dir():
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+            for filename in sorted(filenames):
+                if filename.endswith(".py"):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    relative = os.path.relpath(os.path.join(dirpath, filename), root)
+                    digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+class ToolSchemaCache:
+    """MCP服务器工具模式的磁盘缓存
+
+    以服务器配置（命令和参数或URL）加上服务器代码的版本哈希为键，
+    每个服务器对应cache_dir下的一个JSON文件。没有版本哈希的服务器（如sse）
+    的缓存在最后一次确认（写入或与实时工具列表一致）max_age秒后过期。
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        version_ttl: float = 10.0,
+        max_age: float = 3600.0,
+    ):
+        """
+        参数:
+            cache_dir: 缓存目录
+            version_ttl: stdio服务器版本哈希的复用时间（秒）
+            max_age: 没有版本哈希的服务器缓存的有效期（秒），0表示不过期
+        """
+        self.cache_dir = Path(cache_dir or CACHE_ROOT / "mcp_tools")
+        self.version_ttl = version_ttl
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.writes = 0
+
+    def _path(self, key: ServerKey, version: str) -> Path:
+        name = json.dumps([list(key), version], ensure_ascii=False)
+        return self.cache_dir / f"{hashlib.sha256(name.encode()).hexdigest()}.json"
+
+    def load(self, key: ServerKey) -> Optional[List[Tool]]:
+        """读取缓存的工具模式，不存在、已过期或已损坏时返回None"""
+        version = server_version(key, self.version_ttl)
+        path = self._path(key, version)
+        try:
+            if not version and self.max_age and time.time() - path.stat().st_mtime > self.max_age:
+                self.expired += 1
+                self.misses += 1
+                return None
+            data = json.loads(path.read_text(encoding="utf-8"))
+            tools = [Tool.model_validate(tool) for tool in data["tools"]]
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"工具模式缓存 {path} 无效: {str(e)}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tools
+
+    def store(self, key: ServerKey, tools: List[Tool]) -> bool:
+        """写入工具模式，内容未变化时不写入
+
+        返回:
+            bool: 是否写入了新的内容
+        """
+        serialized = [tool.model_dump(mode="json", exclude_none=True) for tool in tools]
+        path = self._path(key, server_version(key, self.version_ttl))
+        try:
+            if path.exists():
+                cached = json.loads(path.read_text(encoding="utf-8")).get("tools")
+                if cached == serialized:
+                    # 内容已由实时工具列表确认，重新开始计算有效期
+                    os.utime(path)
+                    return False
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再替换，避免并发读取到不完整的内容
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(
+                json.dumps(
+                    {"key": list(key), "updated_at": time.time(), "tools": serialized},
+                    ensure_ascii=False,
+                ),
+                encoding="utf-8",
+            )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入工具模式缓存失败: {str(e)}")
+            return False
+        self.writes += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "writes": self.writes,
+        }
+
+
+class LazySession:
+    """在首次调用工具时才建立连接的MCP会话
+
+    连接之前list_tools返回缓存的工具模式，send_ping直接返回；连接之后请求都转发到
+    真实会话，并在后台用实时工具列表更新缓存。
+    """
+
+    def __init__(
+        self,
+        key: ServerKey,
+        cached_tools: List[Tool],
+        connect: Callable[[], Awaitable[Any]],
+        cache: ToolSchemaCache,
+    ):
+        self.key = key
+        self.cached_tools = cached_tools
+        self.cache = cache
+        self.session = None
+        self._connect = connect
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def connected(self) -> bool:
+        return self.session is not None
+
+    @property
+    def supports_tool_notifications(self) -> bool:
+        """连接之前工具列表来自缓存，不需要轮询"""
+        if self.session is None:
+            return True
+        return getattr(self.session, "supports_tool_notifications", False)
+
+    def add_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+        if self.session is not None and hasattr(self.session, "add_tools_changed_listener"):
+            self.session.add_tools_changed_listener(listener)
+
+    def remove_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+        if self.session is not None and hasattr(self.session, "remove_tools_changed_listener"):
+            self.session.remove_tools_changed_listener(listener)
+
+    async def connect(self):
+        """建立真实连接，并发调用只连接一次"""
+        async with self._lock:
+            if self.session is None:
+                logger.info(f"首次调用工具，连接MCP服务器 {self.key}")
+                self.session = await self._connect()
+                self._refresh_task = asyncio.create_task(self._refresh_cache())
+                for listener in self._listeners:
+                    if hasattr(self.session, "add_tools_changed_listener"):
+                        self.session.add_tools_changed_listener(listener)
+                    # 实时工具列表可能与缓存不同
+                    listener()
+        return self.session
+
+    async def _refresh_cache(self) -> None:
+        """实时工具列表与缓存不同时更新缓存"""
+        try:
+            tools = (await self.session.list_tools()).tools
+            if await asyncio.to_thread(self.cache.store, self.key, tools):
+                logger.info(f"MCP服务器 {self.key} 的工具模式已变化，已更新缓存")
+        except Exception as e:
+            logger.warning(f"刷新工具模式缓存失败: {str(e)}")
+
+    async def initialize(self):
+        """连接在首次调用时初始化"""
+
+    async def call_tool(self, name: str, arguments: Optional[dict] = None):
+        session = await self.connect()
+        return await session.call_tool(name, arguments)
+
+    async def list_tools(self):
+        if self.session is None:
+            return ListToolsResult(tools=self.cached_tools)
+        return await self.session.list_tools()
+
+    async def send_ping(self):
+        if self.session is not None:
+            return await self.session.send_ping()
+
+    async def release(self) -> None:
+        for listener in list(self._listeners):
+            self.remove_tools_changed_listener(listener)
+        if self._refresh_task and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        release = getattr(self.session, "release", None)
+        if release is not None:
+            await release()
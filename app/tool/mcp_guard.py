@@ -0,0 +1,274 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from mcp.shared.exceptions import McpError
+
+from app.exceptions import MCPServerUnavailable
+from app.logger import logger
+
+
+class CircuitBreaker:
+    """MCP服务器的熔断器
+
+    连续失败达到阈值后打开，打开期间的调用直接失败；reset_timeout后进入半开状态，
+    只放行一个探测调用，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.opens = 0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        """是否放行本次调用，半开状态下同一时间只放行一个探测调用"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        probing, self._probing = self._probing, False
+        if probing or self.consecutive_failures >= self.failure_threshold:
+            if self.opened_at is None or probing:
+                self.opens += 1
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """探测调用没有得出结果（例如被取消）时允许下一个探测"""
+        self._probing = False
+
+
+class ServerGuard:
+    """一个MCP服务器的调用保护：超时、并发隔离舱和熔断器
+
+    同一服务器配置的所有智能体共享一个实例，一台服务器挂起时只影响发往它的调用，
+    不会占满其他服务器的并发额度或让智能体的步骤无限期等待。
+    """
+
+    LATENCY_WINDOW = 200
+
+    def __init__(
+        self,
+        key: Tuple[Any, ...],
+        max_concurrency: int = 8,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.key = key
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    async def call(self, func: Callable[[], Awaitable[Any]], timeout: Optional[float]) -> Any:
+        """在隔离舱和熔断器保护下调用func，timeout包括等待并发额度的时间
+
+        异常:
+            MCPServerUnavailable: 熔断器打开，或在timeout内没有空闲的并发额度
+            asyncio.TimeoutError: 调用超时
+        """
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise MCPServerUnavailable(
+                f"连续失败{self.breaker.failure_threshold}次，已暂停调用，"
+                f"约{self.breaker.retry_after():.0f}秒后重试"
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        settled = False
+        try:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise MCPServerUnavailable(
+                    f"{self.max_concurrency}个并发调用均未在{timeout}秒内完成"
+                ) from None
+
+            self.in_flight += 1
+            self.calls += 1
+            started = loop.time()
+            try:
+                remaining = None if deadline is None else max(deadline - started, 0.0)
+                result = await asyncio.wait_for(func(), remaining)
+            except McpError:
+                # 服务器返回了JSON-RPC错误，说明服务器本身可用
+                self._record(success=True)
+                settled = True
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                self.failures += 1
+                self._record(success=False)
+                settled = True
+                raise
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+
+            self._latencies.append(loop.time() - started)
+            self._record(success=True)
+            settled = True
+            return result
+        finally:
+            if not settled:
+                self.breaker.release_probe()
+
+    def _record(self, success: bool) -> None:
+        before = self.breaker.state
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        after = self.breaker.state
+        if after == CircuitBreaker.OPEN and before != CircuitBreaker.OPEN:
+            logger.warning(
+                f"MCP服务器 {self.key} 连续失败{self.breaker.consecutive_failures}次，"
+                f"熔断{self.breaker.reset_timeout}秒"
+            )
+        elif after == CircuitBreaker.CLOSED and before != CircuitBreaker.CLOSED:
+            logger.info(f"MCP服务器 {self.key} 已恢复，熔断器关闭")
+
+    def latency_quantile(self, quantile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * quantile), len(ordered) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "key": list(self.key),
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "p50_latency": self.latency_quantile(0.5),
+            "p95_latency": self.latency_quantile(0.95),
+            "p99_latency": self.latency_quantile(0.99),
+        }
+
+
+class MCPCallGuards:
+    """当前事件循环中按服务器配置共享的ServerGuard"""
+
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MCPCallGuards]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._guards: Dict[Tuple[Any, ...], ServerGuard] = {}
+
+    @classmethod
+    def shared(cls) -> "MCPCallGuards":
+        from app.config import config
+
+        loop = asyncio.get_running_loop()
+        guards = cls._instances.get(loop)
+        if guards is None:
+            settings = config.mcp
+            guards = cls(
+                max_concurrency=settings.max_concurrent_calls,
+                failure_threshold=settings.breaker_failure_threshold,
+                reset_timeout=settings.breaker_reset_timeout,
+            )
+            cls._instances[loop] = guards
+        return guards
+
+    def get(self, key: Tuple[Any, ...]) -> ServerGuard:
+        guard = self._guards.get(key)
+        if guard is None:
+            guard = ServerGuard(
+                key,
+                max_concurrency=self.max_concurrency,
+                failure_threshold=self.failure_threshold,
+                reset_timeout=self.reset_timeout,
+            )
+            self._guards[key] = guard
+        return guard
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "servers": [guard.stats() for guard in self._guards.values()],
+            "open_breakers": sum(
+                guard.breaker.state != CircuitBreaker.CLOSED for guard in self._guards.values()
+            ),
+        }
+
+
+def resolve_timeout(
+    server_id: str,
+    tool_name: str,
+    server_url: Optional[str] = None,
+    settings=None,
+) -> Optional[float]:
+    """工具调用的超时时间，优先级：工具 > 服务器 > 全局默认，0表示不限制
+
+    tool_timeouts的键可以是带服务器前缀的工具名或原始工具名，
+    server_timeouts的键可以是服务器ID或SSE服务器的URL。
+    """
+    if settings is None:
+        from app.config import config
+
+        settings = config.mcp
+    for timeouts, keys in (
+        (settings.tool_timeouts, (f"{server_id}_{tool_name}", tool_name)),
+        (settings.server_timeouts, (server_id, server_url)),
+    ):
+        for key in keys:
+            if key is not None and key in timeouts:
+                return timeouts[key] or None
+    return settings.call_timeout or None
+
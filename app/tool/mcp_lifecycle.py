@@ -0,0 +1,328 @@
+import asyncio
+import os
+import sys
+import time
+import weakref
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Dict, Optional, Set, Tuple
+
+import anyio
+import anyio.lowlevel
+from anyio.streams.text import TextReceiveStream
+from mcp import StdioServerParameters
+from mcp import types
+from mcp.client.sse import sse_client
+from mcp.client.stdio import get_default_environment
+
+from app.logger import logger
+
+
+class MCPLifecycleManager:
+    """MCP会话和stdio服务器子进程的生命周期管理
+
+    每个事件循环一个实例。连接由所属事件循环中的后台任务持有并在该任务中关闭，
+    关闭有时限，超时后取消该任务；stdio子进程退出时先关闭stdin等待其退出，
+    超时后依次terminate和kill并回收，避免留下僵尸进程和文件描述符。
+    同时统计存活的会话和子进程，供leak_report检查泄漏。
+    """
+
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MCPLifecycleManager]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(self, shutdown_timeout: float = 5.0):
+        self.shutdown_timeout = shutdown_timeout
+
+        self._connections: Set["ManagedConnection"] = set()
+        self._sessions: Dict[int, Tuple[str, float]] = {}
+        self._processes: Dict[int, Tuple[Any, str, float]] = {}
+        self.sessions_opened = 0
+        self.sessions_closed = 0
+        self.processes_started = 0
+        self.processes_reaped = 0
+        self.processes_killed = 0
+        self.close_timeouts = 0
+
+    @classmethod
+    def shared(cls) -> "MCPLifecycleManager":
+        """当前事件循环的生命周期管理器"""
+        from app.config import config
+
+        loop = asyncio.get_running_loop()
+        manager = cls._instances.get(loop)
+        if manager is None:
+            manager = cls(shutdown_timeout=config.mcp.shutdown_timeout)
+            cls._instances[loop] = manager
+        return manager
+
+    @asynccontextmanager
+    async def track_session(self, label: str):
+        """在上下文期间把会话计为存活"""
+        token = object()
+        self._sessions[id(token)] = (label, time.monotonic())
+        self.sessions_opened += 1
+        try:
+            yield
+        finally:
+            del self._sessions[id(token)]
+            self.sessions_closed += 1
+
+    def transport(self, key: Tuple[Any, ...], label: Optional[str] = None):
+        """按服务器池键创建传输上下文，stdio子进程由本管理器跟踪和回收"""
+        if key[0] == "sse":
+            return sse_client(url=key[1])
+        _, command, args = key
+        return self.stdio_client(
+            StdioServerParameters(command=command, args=list(args)), label or str(key)
+        )
+
+    @asynccontextmanager
+    async def stdio_client(self, server: StdioServerParameters, label: str):
+        """与mcp.client.stdio.stdio_client相同的stdio传输，退出时在时限内回收子进程
+
+        mcp自带的实现退出时无限期等待子进程结束，子进程不退出时会一直阻塞。
+        """
+        read_stream_writer, read_stream = anyio.create_memory_object_stream(0)
+        write_stream, write_stream_reader = anyio.create_memory_object_stream(0)
+
+        process = await anyio.open_process(
+            [server.command, *server.args],
+            env=server.env if server.env is not None else get_default_environment(),
+            stderr=sys.stderr,
+        )
+        self._processes[process.pid] = (process, label, time.monotonic())
+        self.processes_started += 1
+
+        async def stdout_reader():
+            try:
+                async with read_stream_writer:
+                    buffer = ""
+                    async for chunk in TextReceiveStream(
+                        process.stdout,
+                        encoding=server.encoding,
+                        errors=server.encoding_error_handler,
+                    ):
+                        lines = (buffer + chunk).split("\n")
+                        buffer = lines.pop()
+                        for line in lines:
+                            try:
+                                message = types.JSONRPCMessage.model_validate_json(line)
+                            except Exception as exc:
+                                await read_stream_writer.send(exc)
+                                continue
+                            await read_stream_writer.send(message)
+            except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+                await anyio.lowlevel.checkpoint()
+
+        async def stdin_writer():
+            try:
+                async with write_stream_reader:
+                    async for message in write_stream_reader:
+                        json = message.model_dump_json(by_alias=True, exclude_none=True)
+                        await process.stdin.send(
+                            (json + "\n").encode(
+                                encoding=server.encoding,
+                                errors=server.encoding_error_handler,
+                            )
+                        )
+            except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+                await anyio.lowlevel.checkpoint()
+
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(stdout_reader)
+                tg.start_soon(stdin_writer)
+                try:
+                    yield read_stream, write_stream
+                finally:
+                    await self._reap(process, label)
+                    tg.cancel_scope.cancel()
+        finally:
+            # 传输建立失败或任务组出错时也要回收子进程
+            if process.pid in self._processes:
+                await self._reap(process, label)
+
+    async def _reap(self, process, label: str) -> None:
+        """关闭stdin让子进程自行退出，超时后terminate，再超时后kill，最后回收
+
+        各阶段合计不超过shutdown_timeout的80%，留出关闭会话的时间。
+        """
+        grace = self.shutdown_timeout * 0.4
+        killed = False
+        try:
+            with anyio.CancelScope(shield=True):
+                try:
+                    await process.stdin.aclose()
+                except Exception:
+                    pass
+                with anyio.move_on_after(grace):
+                    await process.wait()
+                if process.returncode is None:
+                    logger.warning(f"MCP服务器进程 {process.pid}（{label}）未在{grace:.1f}秒内退出，终止进程")
+                    killed = True
+                    self._signal(process, "terminate")
+                    with anyio.move_on_after(grace / 2):
+                        await process.wait()
+                if process.returncode is None:
+                    self._signal(process, "kill")
+                    with anyio.move_on_after(grace / 2):
+                        await process.wait()
+                if process.returncode is not None:
+                    await process.aclose()
+        except BaseException:
+            # 连接任务被强制取消时直接kill，退出状态由事件循环的子进程监视器回收
+            if process.returncode is None:
+                killed = True
+                self._signal(process, "kill")
+            raise
+        finally:
+            if self._processes.pop(process.pid, None) is not None:
+                self.processes_reaped += 1
+                self.processes_killed += killed
+
+    @staticmethod
+    def _signal(process, method: str) -> None:
+        try:
+            getattr(process, method)()
+        except ProcessLookupError:
+            pass
+
+    async def open(
+        self, key: Tuple[Any, ...], session_class, label: Optional[str] = None
+    ) -> "ManagedConnection":
+        """建立由后台任务持有的连接，返回时会话已进入但尚未initialize
+
+        异常:
+            ConnectionError: 无法建立传输或会话
+        """
+        connection = ManagedConnection(self, key, session_class, label or str(key))
+        try:
+            await connection.wait_ready()
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def finish(self, task: asyncio.Task, label: str) -> None:
+        """等待持有连接的任务退出，超过shutdown_timeout时取消该任务"""
+        if task.done():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(task), self.shutdown_timeout)
+            return
+        except asyncio.TimeoutError:
+            self.close_timeouts += 1
+            logger.warning(f"关闭MCP连接 {label} 超时（{self.shutdown_timeout}秒），取消连接任务")
+        except Exception:
+            return
+        task.cancel()
+        try:
+            await asyncio.wait_for(task, self.shutdown_timeout)
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def shutdown(self) -> Dict[str, Any]:
+        """关闭所有直接连接并强制结束残留的子进程，返回关闭后的泄漏报告"""
+        connections = list(self._connections)
+        await asyncio.gather(*(c.close() for c in connections), return_exceptions=True)
+        for pid, (process, label, _) in list(self._processes.items()):
+            if process.returncode is None:
+                logger.warning(f"强制结束残留的MCP服务器进程 {pid}（{label}）")
+                await self._reap(process, label)
+        return self.leak_report()
+
+    def leak_report(self) -> Dict[str, Any]:
+        """存活的会话和子进程及累计计数
+
+        服务空闲时存活数应等于会话池中的连接数，持续增长说明存在泄漏。
+        """
+        now = time.monotonic()
+        try:
+            open_fds = len(os.listdir("/proc/self/fd"))
+        except OSError:
+            open_fds = None
+        return {
+            "sessions": {
+                "live": len(self._sessions),
+                "opened": self.sessions_opened,
+                "closed": self.sessions_closed,
+            },
+            "processes": {
+                "live": len(self._processes),
+                "started": self.processes_started,
+                "reaped": self.processes_reaped,
+                "killed": self.processes_killed,
+            },
+            "connections": len(self._connections),
+            "close_timeouts": self.close_timeouts,
+            "open_fds": open_fds,
+            "live_sessions": [
+                {"label": label, "age": round(now - started, 1)}
+                for label, started in self._sessions.values()
+            ],
+            "live_processes": [
+                {
+                    "pid": pid,
+                    "label": label,
+                    "age": round(now - started, 1),
+                    "returncode": process.returncode,
+                }
+                for pid, (process, label, started) in self._processes.items()
+            ],
+        }
+
+
+class ManagedConnection:
+    """由后台任务持有的单个MCP连接
+
+    传输和会话在同一个任务中进入和退出，任何任务都可以调用close，
+    在所属事件循环中有时限地关闭连接。
+    """
+
+    def __init__(
+        self,
+        manager: MCPLifecycleManager,
+        key: Tuple[Any, ...],
+        session_class,
+        label: str,
+    ):
+        self.manager = manager
+        self.key = key
+        self.label = label
+        self.session = None
+        self._session_class = session_class
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._error: Optional[BaseException] = None
+        manager._connections.add(self)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        try:
+            async with AsyncExitStack() as stack:
+                read, write = await stack.enter_async_context(
+                    self.manager.transport(self.key, self.label)
+                )
+                await stack.enter_async_context(self.manager.track_session(self.label))
+                self.session = await stack.enter_async_context(
+                    self._session_class(read, write)
+                )
+                self._ready.set()
+                await self._closing.wait()
+        except Exception as e:
+            self._error = e
+            logger.warning(f"MCP连接 {self.label} 出错: {str(e)}")
+        finally:
+            self.session = None
+            self._ready.set()
+            self.manager._connections.discard(self)
+
+    async def wait_ready(self):
+        await self._ready.wait()
+        if self.session is None:
+            raise ConnectionError(f"无法连接到MCP服务器 {self.label}: {self._error}")
+        return self.session
+
+    async def close(self) -> None:
+        self._closing.set()
+        await self.manager.finish(self._task, self.label)
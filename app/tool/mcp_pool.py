@@ -0,0 +1,387 @@
+import asyncio
+import random
+import weakref
+from contextlib import AsyncExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import anyio
+from mcp import ClientSession
+from mcp import types
+from mcp.types import Tool
+
+from app.logger import logger
+from app.tool.mcp_lifecycle import MCPLifecycleManager
+
+
+# 说明连接已断开、请求尚未发出的异常，可以在重连后安全重试
+CONNECTION_ERRORS = (
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    ConnectionError,
+)
+
+ServerKey = Tuple[Any, ...]
+
+
+class NotifyingClientSession(ClientSession):
+    """转发tools/list_changed通知的ClientSession
+
+    ClientSession会把服务器发来的通知写入一个无缓冲的流，没有读取方时接收循环会阻塞，
+    这里在会话的任务组中持续读取该流，并在工具列表变化时调用监听函数。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.supports_tool_notifications = False
+        self._tools_changed_listeners: List[Callable[[], None]] = []
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        self._task_group.start_soon(self._drain_incoming)
+        return self
+
+    async def _drain_incoming(self) -> None:
+        try:
+            async for _ in self.incoming_messages:
+                pass
+        except (anyio.ClosedResourceError, anyio.EndOfStream):
+            pass
+
+    async def initialize(self) -> types.InitializeResult:
+        result = await super().initialize()
+        tools = result.capabilities.tools
+        self.supports_tool_notifications = bool(tools and tools.listChanged)
+        return result
+
+    async def _received_notification(self, notification) -> None:
+        if isinstance(notification.root, types.ToolListChangedNotification):
+            for listener in list(self._tools_changed_listeners):
+                listener()
+
+    def add_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        self._tools_changed_listeners.append(listener)
+
+    def remove_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        if listener in self._tools_changed_listeners:
+            self._tools_changed_listeners.remove(listener)
+
+
+def server_key(
+    connection_type: str,
+    command: Optional[str] = None,
+    args: Optional[List[str]] = None,
+    server_url: Optional[str] = None,
+) -> ServerKey:
+    """服务器配置的池键：stdio按命令和参数，sse按URL"""
+    if connection_type == "sse":
+        return ("sse", server_url)
+    return ("stdio", command, tuple(args or []))
+
+
+class PooledServer:
+    """池中的一个MCP服务器连接
+
+    连接由专门的后台任务持有：stdio/sse传输和ClientSession都在该任务中进入和退出，
+    避免跨任务关闭anyio作用域。连接断开后按指数退避重连，其他任务通过
+    session属性并发发起请求。stdio服务器在进程中保存状态（例如bash的shell会话），
+    其工具调用用call_lock串行执行，避免不同智能体的命令交错。
+    """
+
+    def __init__(self, key: ServerKey, pool: "MCPSessionPool"):
+        self.key = key
+        self.pool = pool
+        self.session: Optional[ClientSession] = None
+        self.tools: List[Tool] = []
+        self.refs = 0
+        self.reconnects = 0
+        self.closed = False
+        self.supports_tool_notifications = False
+        self._ever_connected = False
+        self._tools_changed_listeners: List[Callable[[], None]] = []
+        self.call_lock: Optional[asyncio.Lock] = asyncio.Lock() if key[0] == "stdio" else None
+
+        self._ready = asyncio.Event()
+        self._broken = asyncio.Event()
+        self._error: Optional[BaseException] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self.lifecycle = MCPLifecycleManager.shared()
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def connected(self) -> bool:
+        return self.session is not None and self._ready.is_set()
+
+    async def _run(self) -> None:
+        """持有连接的后台任务：连接、等待断开或关闭、按退避重连"""
+        attempt = 0
+        while not self.closed:
+            try:
+                async with AsyncExitStack() as stack:
+                    read, write = await stack.enter_async_context(
+                        self.lifecycle.transport(self.key)
+                    )
+                    await stack.enter_async_context(self.lifecycle.track_session(str(self.key)))
+                    session = await stack.enter_async_context(
+                        NotifyingClientSession(read, write)
+                    )
+                    await session.initialize()
+                    session.add_tools_changed_listener(self._notify_tools_changed)
+                    self.supports_tool_notifications = session.supports_tool_notifications
+                    self.tools = (await session.list_tools()).tools
+                    self.session = session
+                    self._error = None
+                    reconnected = self._ever_connected
+                    self._ever_connected = True
+                    self._broken.clear()
+                    self._ready.set()
+                    attempt = 0
+                    # 重连后服务器的工具可能已经变化
+                    if reconnected:
+                        self._notify_tools_changed()
+                    await self._broken.wait()
+            except Exception as e:
+                self._error = e
+                logger.warning(f"MCP服务器 {self.key} 连接出错: {str(e)}")
+            finally:
+                self.session = None
+                self._ready.clear()
+
+            if self.closed:
+                break
+            attempt += 1
+            # 从未成功连接或重连次数耗尽时放弃，由等待方收到错误
+            if not self._ever_connected or attempt > self.pool.reconnect_max_attempts:
+                self.closed = True
+                break
+            self.reconnects += 1
+            self.pool.reconnects += 1
+            delay = min(
+                self.pool.reconnect_max_wait,
+                self.pool.reconnect_min_wait * 2 ** (attempt - 1),
+            )
+            logger.info(f"{delay:.1f}秒后重连MCP服务器 {self.key}（第{attempt}次）")
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+        self.pool._forget(self)
+        # 唤醒仍在等待连接的调用方
+        self._ready.set()
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> ClientSession:
+        """等待连接可用
+
+        异常:
+            ConnectionError: 连接失败且不再重试
+        """
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        if self.session is None:
+            raise ConnectionError(f"无法连接到MCP服务器 {self.key}: {self._error}")
+        return self.session
+
+    def _notify_tools_changed(self) -> None:
+        for listener in list(self._tools_changed_listeners):
+            listener()
+
+    def mark_broken(self) -> None:
+        """通知后台任务关闭当前连接并重连，之后的调用等待新连接"""
+        self.session = None
+        self._ready.clear()
+        self._broken.set()
+
+    async def close(self) -> None:
+        self.closed = True
+        self._cancel_idle_close()
+        self._broken.set()
+        await self.lifecycle.finish(self._task, str(self.key))
+
+    def _schedule_idle_close(self) -> None:
+        ttl = self.pool.idle_ttl
+        if ttl and ttl > 0:
+            loop = asyncio.get_running_loop()
+            self._idle_handle = loop.call_later(
+                ttl, lambda: asyncio.ensure_future(self.close())
+            )
+
+    def _cancel_idle_close(self) -> None:
+        if self._idle_handle:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+
+class PooledSession:
+    """池中连接的轻量视图，供MCPClients和MCPClientTool像ClientSession一样使用
+
+    调用总是转发到当前的活动连接；连接已断开时等待重连并重试一次。
+    """
+
+    def __init__(self, server: PooledServer):
+        self.server = server
+        self.released = False
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def supports_tool_notifications(self) -> bool:
+        return self.server.supports_tool_notifications
+
+    def add_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+        self.server._tools_changed_listeners.append(listener)
+
+    def remove_tools_changed_listener(self, listener: Callable[[], None]) -> None:
+        for listeners in (self._listeners, self.server._tools_changed_listeners):
+            if listener in listeners:
+                listeners.remove(listener)
+
+    async def _call(self, method: str, *args, **kwargs):
+        for attempt in range(2):
+            session = await self.server.wait_ready(self.server.pool.connect_timeout)
+            try:
+                return await getattr(session, method)(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                if attempt:
+                    raise
+                logger.warning(f"MCP服务器 {self.server.key} 连接已断开，重连后重试")
+                self.server.mark_broken()
+
+    async def initialize(self):
+        """连接在池中已完成初始化"""
+        await self.server.wait_ready(self.server.pool.connect_timeout)
+
+    async def call_tool(self, name: str, arguments: Optional[dict] = None):
+        if self.server.call_lock is None:
+            return await self._call("call_tool", name, arguments)
+        async with self.server.call_lock:
+            return await self._call("call_tool", name, arguments)
+
+    async def list_tools(self):
+        result = await self._call("list_tools")
+        self.server.tools = result.tools
+        return result
+
+    async def send_ping(self):
+        return await self._call("send_ping")
+
+    async def release(self) -> None:
+        """归还引用；最后一个引用归还后空闲超过idle_ttl时关闭连接"""
+        if self.released:
+            return
+        self.released = True
+        for listener in list(self._listeners):
+            self.remove_tools_changed_listener(listener)
+        self.server.refs -= 1
+        if self.server.refs <= 0 and not self.server.closed:
+            self.server._schedule_idle_close()
+
+
+class MCPSessionPool:
+    """进程级MCP会话池，按服务器配置复用长连接
+
+    同一事件循环中的所有MCPClients共享一个池：相同命令和参数（或URL）的服务器
+    只启动一次，各智能体通过PooledSession并发调用工具（stdio服务器上的调用串行执行），
+    工具名前缀仍由各自的MCPClients决定。
+    """
+
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MCPSessionPool]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(
+        self,
+        idle_ttl: float = 600.0,
+        connect_timeout: float = 30.0,
+        reconnect_max_attempts: int = 5,
+        reconnect_min_wait: float = 0.5,
+        reconnect_max_wait: float = 30.0,
+    ):
+        self.idle_ttl = idle_ttl
+        self.connect_timeout = connect_timeout
+        self.reconnect_max_attempts = reconnect_max_attempts
+        self.reconnect_min_wait = reconnect_min_wait
+        self.reconnect_max_wait = reconnect_max_wait
+
+        self._servers: Dict[ServerKey, PooledServer] = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    @classmethod
+    def shared(cls) -> "MCPSessionPool":
+        """当前事件循环的共享池"""
+        from app.config import config
+
+        loop = asyncio.get_running_loop()
+        pool = cls._instances.get(loop)
+        if pool is None:
+            settings = config.mcp
+            pool = cls(
+                idle_ttl=settings.session_idle_ttl,
+                connect_timeout=settings.connect_timeout,
+                reconnect_max_attempts=settings.reconnect_max_attempts,
+                reconnect_min_wait=settings.reconnect_min_wait,
+                reconnect_max_wait=settings.reconnect_max_wait,
+            )
+            cls._instances[loop] = pool
+        return pool
+
+    async def acquire(self, key: ServerKey) -> PooledSession:
+        """获取服务器连接的视图，必要时建立连接"""
+        server = self._servers.get(key)
+        if server is not None and not server.closed:
+            self.hits += 1
+        else:
+            self.misses += 1
+            server = PooledServer(key, self)
+            self._servers[key] = server
+
+        server.refs += 1
+        server._cancel_idle_close()
+        view = PooledSession(server)
+        try:
+            await server.wait_ready(self.connect_timeout)
+        except BaseException:
+            await view.release()
+            raise
+        return view
+
+    def _forget(self, server: PooledServer) -> None:
+        if self._servers.get(server.key) is server:
+            del self._servers[server.key]
+
+    async def check(self, ping_timeout: float = 5.0) -> Dict[ServerKey, bool]:
+        """ping所有连接，失败的连接会被标记为断开并在后台重连"""
+        results = {}
+        for key, server in list(self._servers.items()):
+            try:
+                session = await server.wait_ready(ping_timeout)
+                await asyncio.wait_for(session.send_ping(), ping_timeout)
+                results[key] = True
+            except Exception:
+                server.mark_broken()
+                results[key] = False
+        return results
+
+    async def close(self) -> None:
+        servers = list(self._servers.values())
+        await asyncio.gather(*(s.close() for s in servers), return_exceptions=True)
+        self._servers.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "servers": len(self._servers),
+            "connected": sum(s.connected for s in self._servers.values()),
+            "references": sum(max(s.refs, 0) for s in self._servers.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reconnects": self.reconnects,
+            "by_server": [
+                {
+                    "key": list(key),
+                    "connected": server.connected,
+                    "refs": server.refs,
+                    "reconnects": server.reconnects,
+                }
+                for key, server in self._servers.items()
+            ],
+        }
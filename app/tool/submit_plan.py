@@ -0,0 +1,50 @@
+from app.tool.base import BaseTool, ToolResult
+
+
+_SUBMIT_PLAN_DESCRIPTION = """Submit a multi-step tool plan that the runtime executes without asking you after every step.
+Use it whenever the next steps are predictable. Steps run in order. A string argument may reference
+the output of an earlier step with {{step_id}}, or a field of a JSON output with {{step_id.field}}.
+Execution stops early and you are consulted again when a step fails or when a step sets `replan_after`
+(use it for branch points whose outcome decides what to do next). Put `terminate` as the last step
+when the plan completes the task."""
+
+
+class SubmitPlan(BaseTool):
+    name: str = "submit_plan"
+    description: str = _SUBMIT_PLAN_DESCRIPTION
+    parameters: dict = {
+        "type": "object",
+        "properties": {
+            "steps": {
+                "type": "array",
+                "description": "The tool calls to execute, in order.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {
+                            "type": "string",
+                            "description": "Unique step id used to reference its output.",
+                        },
+                        "tool": {
+                            "type": "string",
+                            "description": "Name of the tool to call.",
+                        },
+                        "args": {
+                            "type": "object",
+                            "description": "Arguments of the tool call.",
+                        },
+                        "replan_after": {
+                            "type": "boolean",
+                            "description": "Stop after this step and return the results for a new decision.",
+                        },
+                    },
+                    "required": ["id", "tool", "args"],
+                },
+            }
+        },
+        "required": ["steps"],
+    }
+
+    async def execute(self, **kwargs) -> ToolResult:
+        """Plans are executed by PlanExecuteAgent, not by the tool itself"""
+        return ToolResult(error="submit_plan can only be used with PlanExecuteAgent")
@@ -1,5 +1,5 @@
 """Collection classes for managing multiple tools."""
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional
 
 from app.exceptions import ToolError
 from app.tool.base import BaseTool, ToolFailure, ToolResult
@@ -14,12 +14,37 @@ class ToolCollection:
     def __init__(self, *tools: BaseTool):
         self.tools = tools
         self.tool_map = {tool.name: tool for tool in tools}
+        # 工具集合的版本号，工具集变化时递增
+        self.params_version = 0
+        self._params_cache: Optional[List[Dict[str, Any]]] = None
+        self._params_tokens: Dict[Callable[[str], int], int] = {}
 
     def __iter__(self):
         return iter(self.tools)
 
+    def invalidate_params(self) -> None:
+        """Mark the cached tool params as stale after the tool set changed."""
+        self.params_version += 1
+        self._params_cache = None
+        self._params_tokens = {}
+
     def to_params(self) -> List[Dict[str, Any]]:
-        return [tool.to_param() for tool in self.tools]
+        """Return the tool params, serialized once per tool-set version."""
+        if self._params_cache is None:
+            self._params_cache = [tool.to_param() for tool in self.tools]
+        return self._params_cache
+
+    def count_params_tokens(self, count_tokens: Callable[[str], int]) -> int:
+        """Return the token cost of the tool params, computed once per version.
+
+        Args:
+            count_tokens: Token counting function of the LLM the params are sent to.
+        """
+        if count_tokens not in self._params_tokens:
+            self._params_tokens[count_tokens] = sum(
+                count_tokens(str(param)) for param in self.to_params()
+            )
+        return self._params_tokens[count_tokens]
 
     async def execute(
         self, *, name: str, tool_input: Dict[str, Any] = None
@@ -50,6 +75,7 @@ class ToolCollection:
     def add_tool(self, tool: BaseTool):
         self.tools += (tool,)
         self.tool_map[tool.name] = tool
+        self.invalidate_params()
         return self
 
     def add_tools(self, *tools: BaseTool):
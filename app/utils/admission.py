@@ -0,0 +1,248 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse
+
+from app.config import AdmissionSettings
+from app.exceptions import AdmissionRejected
+from app.logger import logger
+
+
+class AdmissionController:
+    """智能体运行的准入控制
+
+    限制全局和每个任务同时运行的数量，超出时请求按到达顺序排队等待；
+    排队的请求数达到max_waiting或等待超过queue_timeout时拒绝，
+    并根据最近的运行耗时估算Retry-After。
+    """
+
+    WINDOW = 200
+
+    def __init__(self, settings: Optional[AdmissionSettings] = None):
+        self.settings = settings or AdmissionSettings()
+        self._running: Dict[str, int] = {}
+        self._running_total = 0
+        self._waiters: Deque[Tuple[str, asyncio.Future]] = deque()
+        self._durations: Deque[float] = deque(maxlen=self.WINDOW)
+        self._wait_times: Deque[float] = deque(maxlen=self.WINDOW)
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.peak_waiting = 0
+
+    def limit_to(self, capacity: int) -> None:
+        """将全局并发上限限制在capacity以内
+
+        每个运行都要从智能体池租用一个智能体，准入上限大于池容量时，
+        多出的请求被准入后只能在池中等待直到AgentPoolExhausted，无法得到429和Retry-After。
+        """
+        limit = self.settings.max_concurrent_runs
+        if capacity <= 0 or (limit and limit <= capacity):
+            return
+        logger.warning(
+            f"准入上限max_concurrent_runs={limit or '不限制'}超过智能体池容量{capacity}，"
+            f"已调整为{capacity}"
+        )
+        self.settings = self.settings.model_copy(update={"max_concurrent_runs": capacity})
+        self._wake()
+
+    def _global_full(self) -> bool:
+        limit = self.settings.max_concurrent_runs
+        return bool(limit) and self._running_total >= limit
+
+    def _has_capacity(self, task_name: str) -> bool:
+        if self._global_full():
+            return False
+        task_limit = self.settings.task_limits.get(task_name)
+        return not task_limit or self._running.get(task_name, 0) < task_limit
+
+    def _admit(self, task_name: str) -> None:
+        self._running[task_name] = self._running.get(task_name, 0) + 1
+        self._running_total += 1
+        self.admitted += 1
+
+    def _wake(self) -> None:
+        """按排队顺序放行有空闲额度的请求，任务额度已满的请求不阻塞其他任务的请求"""
+        for entry in list(self._waiters):
+            task_name, future = entry
+            if future.done():
+                self._waiters.remove(entry)
+            elif self._has_capacity(task_name):
+                self._waiters.remove(entry)
+                self._admit(task_name)
+                future.set_result(None)
+            elif self._global_full():
+                break
+
+    def retry_after(self, task_name: str) -> int:
+        """估算的重试等待时间（秒）：排在前面的请求需要的运行轮数乘以平均运行耗时"""
+        if self._durations:
+            duration = sum(self._durations) / len(self._durations)
+        else:
+            duration = self.settings.default_retry_after
+        capacities = [
+            limit
+            for limit in (
+                self.settings.max_concurrent_runs,
+                self.settings.task_limits.get(task_name, 0),
+            )
+            if limit
+        ]
+        capacity = min(capacities) if capacities else 1
+        rounds = len(self._waiters) // capacity + 1
+        return max(1, math.ceil(duration * rounds))
+
+    async def acquire(self, task_name: str, reject: bool = True) -> None:
+        """取得一个运行额度，必要时排队等待
+
+        参数:
+            task_name: 任务名称，用于按任务限制并发
+            reject: 为False时不受max_waiting和queue_timeout限制，一直等待（用于后台任务）
+
+        异常:
+            AdmissionRejected: 排队已满或等待超时
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        if not self._waiters and self._has_capacity(task_name):
+            self._admit(task_name)
+            self._wait_times.append(0.0)
+            return
+
+        if reject and len(self._waiters) >= self.settings.max_waiting:
+            self.rejected += 1
+            retry_after = self.retry_after(task_name)
+            logger.warning(f"运行队列已满，拒绝任务 {task_name}，建议{retry_after}秒后重试")
+            raise AdmissionRejected(
+                f"服务繁忙，{len(self._waiters)}个请求正在排队，请稍后重试", retry_after
+            )
+
+        future = loop.create_future()
+        self._waiters.append((task_name, future))
+        self.peak_waiting = max(self.peak_waiting, len(self._waiters))
+        self._wake()
+        try:
+            await asyncio.wait_for(future, self.settings.queue_timeout if reject else None)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 已被放行但调用方不再需要，归还额度
+                self.release(task_name)
+            elif (task_name, future) in self._waiters:
+                self._waiters.remove((task_name, future))
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                self.timeouts += 1
+                raise AdmissionRejected(
+                    f"排队等待超过{self.settings.queue_timeout}秒，请稍后重试",
+                    self.retry_after(task_name),
+                ) from None
+            raise
+        self._wait_times.append(loop.time() - started)
+
+    def release(self, task_name: str, duration: Optional[float] = None) -> None:
+        """归还运行额度，duration为本次运行的耗时，用于估算Retry-After"""
+        self._running[task_name] -= 1
+        if not self._running[task_name]:
+            del self._running[task_name]
+        self._running_total -= 1
+        if duration is not None:
+            self._durations.append(duration)
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, task_name: str, reject: bool = True):
+        """在上下文期间占用一个运行额度"""
+        await self.acquire(task_name, reject=reject)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(task_name, time.monotonic() - started)
+
+    @staticmethod
+    def _quantile(values: Sequence[float], quantile: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[min(int(len(ordered) * quantile), len(ordered) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._running_total,
+            "running_by_task": dict(self._running),
+            "waiting": len(self._waiters),
+            "peak_waiting": self.peak_waiting,
+            "max_concurrent_runs": self.settings.max_concurrent_runs,
+            "task_limits": self.settings.task_limits,
+            "max_waiting": self.settings.max_waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "p50_wait": self._quantile(self._wait_times, 0.5),
+            "p95_wait": self._quantile(self._wait_times, 0.95),
+            "mean_run_duration": (
+                sum(self._durations) / len(self._durations) if self._durations else None
+            ),
+        }
+
+
+class AdmissionMiddleware:
+    """对指定前缀下的请求做准入控制的ASGI中间件
+
+    任务名取路径前缀后的第一段，例如/api/agent/code_analysis对应code_analysis。
+    额度在整个请求期间（包括流式响应）占用，响应结束或客户端断开后归还；
+    未被准入的请求返回429并带有Retry-After头。
+    状态码不低于400的响应（参数错误、任务不存在等）不计入运行耗时，避免拉低Retry-After的估算。
+    """
+
+    def __init__(self, app, controller: AdmissionController, prefixes: Sequence[str]):
+        self.app = app
+        self.controller = controller
+        self.prefixes = tuple(prefixes)
+
+    def _task_name(self, path: str) -> Optional[str]:
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return path[len(prefix):].split("/", 1)[0] or None
+        return None
+
+    async def __call__(self, scope, receive, send):
+        task_name = None
+        if scope["type"] == "http" and self.controller.settings.enabled:
+            task_name = self._task_name(scope["path"])
+        if task_name is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.controller.acquire(task_name)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": str(e)},
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.monotonic() - started
+            self.controller.release(
+                task_name, duration if status is not None and status < 400 else None
+            )
@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.config import WORKSPACE_ROOT, DatasetSettings
+from app.exceptions import UploadTooLarge
+from app.logger import logger
+from app.utils.file_utils import extract_zip
+from app.utils.locks import KeyedLocks
+
+
+DATASETS_ROOT = WORKSPACE_ROOT / "datasets"
+
+
+@dataclass
+class StoredDataset:
+    """存储中的一个数据集文件"""
+
+    sha256: str
+    path: Path
+    size: int
+    deduplicated: bool
+
+
+class DatasetStore:
+    """按内容寻址的数据集存储
+
+    上传的文件分块写入磁盘并同时计算SHA-256，不阻塞事件循环；内容相同的文件只保存一份，
+    ZIP文件按哈希只解压一次。目录结构:
+        blobs/<sha256前两位>/<sha256>  文件内容
+        extracted/<sha256>/           解压缓存（只读，运行时复制到运行目录）
+        incoming/                     正在写入的上传文件
+
+    用法:
+        stored = await store.ingest(upload_file)
+        await asyncio.to_thread(store.copy_to, stored.sha256, run.path(filename))
+    """
+
+    def __init__(self, settings: Optional[DatasetSettings] = None, root: Optional[Path] = None):
+        self.settings = settings or DatasetSettings()
+        self.root = Path(root or DATASETS_ROOT)
+        self._extract_locks = KeyedLocks()
+
+        self.ingested = 0
+        self.deduplicated = 0
+        self.bytes_received = 0
+        self.bytes_deduplicated = 0
+        self.extraction_hits = 0
+        self.extraction_misses = 0
+        self.pruned = 0
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / "blobs" / sha256[:2] / sha256
+
+    def extracted_path(self, sha256: str) -> Path:
+        return self.root / "extracted" / sha256
+
+    async def ingest(self, upload, size_hint: Optional[int] = None) -> StoredDataset:
+        """分块读取upload（具有async read(size)方法，例如UploadFile）并存入存储
+
+        异常:
+            UploadTooLarge: 文件超过max_upload_size
+        """
+        max_size = self.settings.max_upload_size
+        if max_size and size_hint is not None and size_hint > max_size:
+            raise UploadTooLarge(f"文件大小{size_hint}字节超过上限{max_size}字节")
+
+        incoming = self.root / "incoming"
+        await asyncio.to_thread(incoming.mkdir, parents=True, exist_ok=True)
+        part = incoming / f"{uuid.uuid4().hex}.part"
+        hasher = hashlib.sha256()
+        size = 0
+        f = await asyncio.to_thread(open, part, "wb")
+        try:
+            while True:
+                chunk = await upload.read(self.settings.chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadTooLarge(f"文件大小超过上限{max_size}字节")
+                # 写入和哈希都在线程中进行，大块数据不占用事件循环
+                await asyncio.to_thread(self._write_chunk, f, hasher, chunk)
+            await asyncio.to_thread(f.close)
+        except BaseException:
+            await asyncio.to_thread(self._discard, f, part)
+            raise
+
+        stored = await asyncio.to_thread(self._commit, part, hasher.hexdigest(), size)
+        self.bytes_received += size
+        if stored.deduplicated:
+            self.deduplicated += 1
+            self.bytes_deduplicated += size
+        else:
+            self.ingested += 1
+        return stored
+
+    @staticmethod
+    def _write_chunk(f, hasher, chunk: bytes) -> None:
+        hasher.update(chunk)
+        f.write(chunk)
+
+    @staticmethod
+    def _discard(f, part: Path) -> None:
+        f.close()
+        part.unlink(missing_ok=True)
+
+    def _commit(self, part: Path, sha256: str, size: int) -> StoredDataset:
+        blob = self.blob_path(sha256)
+        if blob.exists():
+            part.unlink()
+            # 以最后使用时间作为TTL的起点
+            os.utime(blob)
+            return StoredDataset(sha256, blob, size, deduplicated=True)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(part, blob)
+        return StoredDataset(sha256, blob, size, deduplicated=False)
+
+    def copy_to(self, sha256: str, destination: str) -> str:
+        """把数据集文件复制到destination
+
+        运行目录对智能体可写，不能与存储共享inode（硬链接），
+        否则原地修改会破坏所有运行共用的文件内容。
+        """
+        shutil.copyfile(self.blob_path(sha256), destination)
+        return destination
+
+    async def extract(self, sha256: str) -> Path:
+        """返回ZIP数据集的解压目录，同一哈希只解压一次"""
+        target = self.extracted_path(sha256)
+        async with self._extract_locks(sha256):
+            if await asyncio.to_thread(target.is_dir):
+                self.extraction_hits += 1
+                await asyncio.to_thread(os.utime, target)
+                return target
+            self.extraction_misses += 1
+            await asyncio.to_thread(self._extract, sha256, target)
+        return target
+
+    def _extract(self, sha256: str, target: Path) -> None:
+        # 先解压到临时目录再改名，中途失败不会留下不完整的缓存
+        staging = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            extract_zip(self.blob_path(sha256), staging)
+            try:
+                os.rename(staging, target)
+            except OSError:
+                if not target.is_dir():
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    async def extract_to(self, sha256: str, destination: str) -> str:
+        """把缓存的解压结果复制到destination，运行可以修改自己的副本而不影响缓存"""
+        source = await self.extract(sha256)
+        await asyncio.to_thread(shutil.copytree, source, destination, dirs_exist_ok=True)
+        return destination
+
+    def prune(self, cutoff: float) -> int:
+        """删除最后使用时间早于cutoff的数据集和解压缓存，返回删除的数量"""
+        removed = 0
+        for directory, pattern in (
+            (self.root / "blobs", "*/*"),
+            (self.root / "extracted", "*"),
+            (self.root / "incoming", "*.part"),
+        ):
+            if not directory.is_dir():
+                continue
+            for path in directory.glob(pattern):
+                try:
+                    if path.stat().st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            logger.info(f"已删除 {removed} 个过期的数据集文件或解压缓存")
+        self.pruned += removed
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "ingested": self.ingested,
+            "deduplicated": self.deduplicated,
+            "bytes_received": self.bytes_received,
+            "bytes_deduplicated": self.bytes_deduplicated,
+            "extraction_hits": self.extraction_hits,
+            "extraction_misses": self.extraction_misses,
+            "pruned": self.pruned,
+        }
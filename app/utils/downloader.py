@@ -0,0 +1,359 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.config import CACHE_ROOT, DownloadSettings
+from app.exceptions import DownloadError
+from app.logger import logger
+from app.utils.locks import KeyedLocks
+
+
+class _SourceChanged(Exception):
+    """范围请求收到200：文件在HEAD之后发生了变化，If-Range没有匹配"""
+
+
+@dataclass
+class DownloadResult:
+    """一次下载的结果"""
+
+    path: str
+    size: int
+    from_cache: bool
+    parts: int
+
+
+class DatasetDownloader:
+    """共享连接池的异步数据集下载器
+
+    每次下载先发送HEAD请求，用ETag/Last-Modified验证磁盘缓存，未变化时直接使用缓存；
+    否则按大小决定是否分段并行下载（需要服务器支持范围请求）。各分段写入单独的文件，
+    失败重试以及之后的再次下载都从已写入的位置继续，完成后合并并写入缓存。
+    下载期间文件发生变化时丢弃已下载的分段，从HEAD开始重新下载。
+    服务器不支持HEAD时无法验证缓存，每次都完整下载。
+    缓存超过cache_ttl未使用时由prune删除（WorkspaceJanitor定期调用）。
+
+    用法:
+        result = await downloader.download(file_url, run.path("dataset.zip"))
+    """
+
+    def __init__(self, settings: Optional[DownloadSettings] = None, cache_dir: Optional[Path] = None):
+        self.settings = settings or DownloadSettings()
+        self.cache_dir = Path(cache_dir or self.settings.cache_dir or CACHE_ROOT / "downloads")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._locks = KeyedLocks()
+
+        self.downloads = 0
+        self.cache_hits = 0
+        self.range_downloads = 0
+        self.resumed = 0
+        self.retries = 0
+        self.restarts = 0
+        self.bytes_downloaded = 0
+        self.pruned = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.settings.max_connections),
+                timeout=httpx.Timeout(
+                    self.settings.read_timeout, connect=self.settings.connect_timeout
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _entry_dir(self, url: str) -> Path:
+        return self.cache_dir / hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    async def download(self, url: str, destination: str) -> DownloadResult:
+        """下载url到destination（缓存文件的副本）
+
+        异常:
+            DownloadError: 服务器返回错误状态、文件超过大小上限或重试后仍然失败
+        """
+        entry = self._entry_dir(url)
+        async with self._locks(entry.name):
+            size, from_cache, parts = await self._fetch(url, entry)
+            await asyncio.to_thread(self._place, entry, destination)
+        return DownloadResult(destination, size, from_cache, parts)
+
+    async def _fetch(self, url: str, entry: Path) -> Tuple[int, bool, int]:
+        """下载期间文件发生变化时从头重新下载，最多重新开始max_retries次"""
+        for attempt in range(self.settings.max_retries + 1):
+            try:
+                return await self._fetch_version(url, entry)
+            except _SourceChanged:
+                # 删除进度记录，已下载的分段属于旧版本，下次准备时全部丢弃
+                await asyncio.to_thread((entry / "partial.json").unlink, missing_ok=True)
+                if attempt >= self.settings.max_retries:
+                    raise DownloadError(f"下载期间文件反复发生变化: {url}") from None
+                self.restarts += 1
+                logger.warning(f"下载期间文件已变化，重新开始下载: {url}")
+
+    async def _fetch_version(self, url: str, entry: Path) -> Tuple[int, bool, int]:
+        meta = await asyncio.to_thread(self._read_json, entry / "meta.json")
+        info = await self._head(url)
+        if meta and info and self._is_fresh(meta, info):
+            self.cache_hits += 1
+            logger.info(f"使用缓存的下载文件: {url}")
+            return meta["size"], True, 0
+
+        size = info["size"] if info else None
+        max_size = self.settings.max_size
+        if max_size and size is not None and size > max_size:
+            raise DownloadError(f"文件大小{size}字节超过上限{max_size}字节", 413)
+
+        # If-Range只接受强ETag或Last-Modified
+        etag = info["etag"] if info else None
+        if etag and etag.startswith("W/"):
+            etag = None
+        validator = etag or (info["last_modified"] if info else None)
+        ranged = bool(info and info["ranges"] and size and validator)
+        parts = self._plan(size) if ranged else [(0, None)]
+
+        # 上次未完成的下载针对的是同一版本时保留已下载的分段，否则重新开始
+        state = {"validator": validator, "size": size, "parts": [list(p) for p in parts]}
+        await asyncio.to_thread(self._prepare, entry, state, ranged)
+
+        self.downloads += 1
+        if len(parts) > 1:
+            self.range_downloads += 1
+            logger.info(f"分{len(parts)}段并行下载 {url}（{size}字节）")
+        tasks = [
+            asyncio.create_task(
+                self._fetch_part(url, entry / f"part{i}", start, end, validator, ranged)
+            )
+            for i, (start, end) in enumerate(parts)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        meta = {
+            "url": url,
+            "etag": info["etag"] if info else None,
+            "last_modified": info["last_modified"] if info else None,
+        }
+        size = await asyncio.to_thread(self._assemble, entry, len(parts), size, meta)
+        return size, False, len(parts)
+
+    async def _head(self, url: str) -> Optional[Dict[str, Any]]:
+        """获取文件的大小、验证器和是否支持范围请求，服务器不支持HEAD时返回None"""
+        try:
+            response = await self.client.head(url)
+        except httpx.HTTPError as e:
+            logger.warning(f"HEAD请求失败，跳过缓存验证: {url}: {str(e)}")
+            return None
+        if response.status_code in (401, 403, 404, 410):
+            raise DownloadError(
+                f"无法从URL下载文件，状态码: {response.status_code}", response.status_code
+            )
+        if response.status_code >= 400:
+            return None
+        headers = response.headers
+        length = headers.get("content-length")
+        return {
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            # 压缩传输时Content-Length不是文件大小
+            "size": int(length) if length and not headers.get("content-encoding") else None,
+            "ranges": headers.get("accept-ranges", "").lower() == "bytes",
+        }
+
+    @staticmethod
+    def _is_fresh(meta: Dict[str, Any], info: Dict[str, Any]) -> bool:
+        if info["size"] is not None and info["size"] != meta.get("size"):
+            return False
+        if info["etag"] and meta.get("etag"):
+            return info["etag"] == meta["etag"]
+        if info["last_modified"] and meta.get("last_modified"):
+            return info["last_modified"] == meta["last_modified"]
+        return False
+
+    def _plan(self, size: int) -> List[Tuple[int, Optional[int]]]:
+        """把[0, size)分成若干段，小文件只分一段（仍可断点续传）"""
+        count = self.settings.max_parts if size >= self.settings.parallel_threshold else 1
+        count = max(1, min(count, size))
+        step = -(-size // count)
+        return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    async def _fetch_part(
+        self,
+        url: str,
+        path: Path,
+        start: int,
+        end: Optional[int],
+        validator: Optional[str],
+        ranged: bool,
+    ) -> None:
+        expected = None if end is None else end - start + 1
+        wait = self.settings.retry_wait
+        for attempt in range(self.settings.max_retries + 1):
+            have = await asyncio.to_thread(self._file_size, path) if ranged else 0
+            if expected is not None and have >= expected:
+                return
+            headers = {}
+            if ranged:
+                headers["Range"] = f"bytes={start + have}-{end}"
+                # 文件已变化时服务器返回200而不是206，避免拼接不同版本的内容
+                headers["If-Range"] = validator
+                if have:
+                    self.resumed += 1
+            try:
+                await self._stream_to(url, path, headers, append=have > 0, ranged=ranged)
+                return
+            except (httpx.TransportError, DownloadError) as e:
+                retryable = not isinstance(e, DownloadError) or (e.status_code or 0) >= 500
+                if not retryable or attempt >= self.settings.max_retries:
+                    if isinstance(e, DownloadError):
+                        raise
+                    raise DownloadError(f"下载失败: {str(e)}") from e
+                self.retries += 1
+                logger.warning(f"下载 {url} 出错，{wait:.1f}秒后重试（第{attempt + 1}次）: {str(e)}")
+                await asyncio.sleep(wait)
+                wait *= 2
+
+    async def _stream_to(
+        self, url: str, path: Path, headers: Dict[str, str], append: bool, ranged: bool
+    ) -> None:
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if ranged and response.status_code == 200:
+                raise _SourceChanged()
+            expected_status = 206 if ranged else 200
+            if response.status_code != expected_status:
+                raise DownloadError(
+                    f"无法从URL下载文件，状态码: {response.status_code}", response.status_code
+                )
+            f = await asyncio.to_thread(open, path, "ab" if append else "wb")
+            buffer = bytearray()
+            try:
+                written = 0
+                async for data in response.aiter_bytes():
+                    written += len(data)
+                    self.bytes_downloaded += len(data)
+                    if not ranged and self.settings.max_size and written > self.settings.max_size:
+                        raise DownloadError(f"文件大小超过上限{self.settings.max_size}字节", 413)
+                    buffer += data
+                    if len(buffer) >= self.settings.chunk_size:
+                        # 写入在线程中进行，不阻塞事件循环
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+            finally:
+                # 连接中断时也写入已收到的数据，重试从这里继续
+                await asyncio.to_thread(self._flush_and_close, f, bytes(buffer))
+
+    @staticmethod
+    def _flush_and_close(f, data: bytes) -> None:
+        try:
+            if data:
+                f.write(data)
+        finally:
+            f.close()
+
+    @staticmethod
+    def _file_size(path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _read_json(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _prepare(self, entry: Path, state: Dict[str, Any], ranged: bool) -> None:
+        entry.mkdir(parents=True, exist_ok=True)
+        progress = entry / "partial.json"
+        if not ranged or self._read_json(progress) != state:
+            for part in entry.glob("part*"):
+                part.unlink(missing_ok=True)
+            with open(progress, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+
+    @staticmethod
+    def _assemble(entry: Path, count: int, size: Optional[int], meta: Dict[str, Any]) -> int:
+        """合并分段并写入缓存，返回文件大小"""
+        staging = entry / "data.tmp"
+        if count == 1:
+            os.replace(entry / "part0", staging)
+        else:
+            with open(staging, "wb") as out:
+                for i in range(count):
+                    with open(entry / f"part{i}", "rb") as f:
+                        shutil.copyfileobj(f, out)
+        actual = staging.stat().st_size
+        if size is not None and actual != size:
+            staging.unlink()
+            raise DownloadError(f"下载的文件不完整：{actual}/{size}字节")
+        os.replace(staging, entry / "data")
+        with open(entry / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({**meta, "size": actual, "downloaded_at": time.time()}, f)
+        for part in entry.glob("part*"):
+            part.unlink(missing_ok=True)
+        (entry / "partial.json").unlink(missing_ok=True)
+        return actual
+
+    @staticmethod
+    def _place(entry: Path, destination: str) -> None:
+        """把缓存文件复制到destination并记录使用时间
+
+        运行目录对智能体可写，不能与缓存共享inode（硬链接），否则原地修改会破坏缓存，
+        而缓存验证只比较HEAD返回的元数据，发现不了这种修改。
+        """
+        shutil.copyfile(entry / "data", destination)
+        # 以最后使用时间作为TTL的起点
+        os.utime(entry)
+
+    def prune(self, cutoff: float) -> int:
+        """删除最后使用时间早于cutoff的缓存（包括未完成的下载），返回删除的数量"""
+        if not self.cache_dir.is_dir():
+            return 0
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name in self._locks:
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+        if removed:
+            logger.info(f"已删除 {removed} 个过期的下载缓存")
+        self.pruned += removed
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "downloads": self.downloads,
+            "cache_hits": self.cache_hits,
+            "range_downloads": self.range_downloads,
+            "resumed": self.resumed,
+            "retries": self.retries,
+            "restarts": self.restarts,
+            "bytes_downloaded": self.bytes_downloaded,
+            "pruned": self.pruned,
+        }
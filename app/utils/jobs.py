@@ -0,0 +1,256 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set, Tuple
+
+from app.config import JobSettings
+from app.exceptions import JobQueueFull
+from app.logger import logger
+
+
+# 产生任务事件（与MCPRunner.run_stream的步骤结果格式相同）的异步生成器工厂
+EventFactory = Callable[[], AsyncIterator[Dict[str, Any]]]
+
+
+class Job:
+    """后台队列中的一次智能体运行
+
+    步骤事件按顺序编号并缓存最近的max_events条，订阅者可以从任意事件ID之后重放，
+    之后继续接收新事件。LLM增量事件（is_delta）只转发给在线的订阅者，不编号也不缓存。
+    每个订阅者的缓冲最多queue_size个事件：已满时丢弃增量事件；步骤事件放不下时停止向该订阅者推送，
+    它读完缓冲后从缓存的步骤事件继续，慢速客户端不会让内存无限增长。
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(
+        self,
+        task_name: str,
+        factory: EventFactory,
+        max_events: int = 1000,
+        queue_size: int = 256,
+    ):
+        self.id = uuid.uuid4().hex
+        self.task_name = task_name
+        self.status = self.QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+
+        self._factory = factory
+        self._events: deque = deque(maxlen=max_events)
+        self._last_event_id = 0
+        self._queue_size = queue_size
+        self._subscribers: Set[asyncio.Queue] = set()
+        # 步骤事件放不下、读完缓冲后需要从缓存继续的订阅者
+        self._lagging: Set[asyncio.Queue] = set()
+        self.dropped_deltas = 0
+
+    @property
+    def done(self) -> bool:
+        return self.status in (self.SUCCEEDED, self.FAILED, self.CANCELLED)
+
+    def publish(self, event: Dict[str, Any]) -> Optional[int]:
+        """记录一个事件并转发给订阅者，返回事件ID（增量事件为None）"""
+        event_id = None
+        if not event.get("is_delta"):
+            self._last_event_id += 1
+            event_id = self._last_event_id
+            self._events.append((event_id, event))
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((event_id, event))
+            except asyncio.QueueFull:
+                if event_id is None:
+                    self.dropped_deltas += 1
+                else:
+                    self._lag(queue)
+        return event_id
+
+    def _lag(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+        self._lagging.add(queue)
+
+    def _close(self) -> None:
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self._lag(queue)
+
+    async def events(self, last_event_id: int = 0) -> AsyncIterator[Tuple[Optional[int], Dict[str, Any]]]:
+        """重放ID大于last_event_id的已缓存事件，然后持续产生新事件直到任务结束
+
+        产生(事件ID, 事件)，事件ID早于缓存范围时从最早的缓存事件开始重放。
+        """
+        while True:
+            # 先订阅再重放，重放期间发布的事件进入缓冲，按事件ID去重
+            queue: asyncio.Queue = asyncio.Queue(self._queue_size)
+            done = self.done
+            if not done:
+                self._subscribers.add(queue)
+            try:
+                for event_id, event in list(self._events):
+                    if event_id > last_event_id:
+                        last_event_id = event_id
+                        yield event_id, event
+                if done:
+                    return
+                while True:
+                    if queue in self._lagging and queue.empty():
+                        break
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    event_id, event = item
+                    if event_id is not None:
+                        if event_id <= last_event_id:
+                            continue
+                        last_event_id = event_id
+                    yield item
+            finally:
+                self._subscribers.discard(queue)
+                self._lagging.discard(queue)
+            logger.warning(f"后台任务 {self.id} 的订阅者读取过慢，从缓存的事件{last_event_id}之后继续")
+
+    async def _run(self) -> None:
+        self.status = self.RUNNING
+        self.started_at = time.time()
+        try:
+            async for event in self._factory():
+                self.publish(event)
+                if event.get("is_last"):
+                    self.result = event.get("final_results")
+                    self.error = event.get("error")
+            self.status = self.FAILED if self.error else self.SUCCEEDED
+        except asyncio.CancelledError:
+            self.status = self.CANCELLED
+            self.publish({"error": "任务已取消", "is_last": True})
+            raise
+        except Exception as e:
+            self.error = f"执行出错: {str(e)}"
+            self.status = self.FAILED
+            logger.error(f"后台任务 {self.id}（{self.task_name}）出错: {str(e)}", exc_info=True)
+            self.publish({"error": self.error, "is_last": True})
+        finally:
+            self.finished_at = time.time()
+            self._close()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "task_name": self.task_name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "last_event_id": self._last_event_id,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """有界的进程内后台任务队列
+
+    固定数量的工作协程依次执行排队的任务，运行中的任务数不再取决于打开的HTTP连接数，
+    客户端断开也不会中断任务。队列已满时submit抛出JobQueueFull。
+    结束的任务保留result_ttl秒供查询结果和重放事件。
+
+    用法:
+        job = queue.submit("code_analysis", lambda: run_task_events(...))
+        async for event_id, event in job.events(last_event_id):
+            ...
+    """
+
+    def __init__(self, settings: Optional[JobSettings] = None):
+        self.settings = settings or JobSettings()
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: Set[asyncio.Task] = set()
+
+        self.submitted = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.settings.max_queued)
+        for _ in range(self.settings.max_workers):
+            self._workers.add(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        """停止工作协程，取消运行中的任务并将排队的任务标记为已取消"""
+        workers, self._workers = self._workers, set()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for job in self._jobs.values():
+            if job.status == Job.QUEUED:
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+                job._close()
+        self._queue = None
+
+    def submit(self, task_name: str, factory: EventFactory) -> Job:
+        """提交任务，返回排队中的Job
+
+        异常:
+            JobQueueFull: 排队的任务数已达到max_queued
+        """
+        if self._queue is None:
+            self.start()
+        self._purge()
+        job = Job(
+            task_name,
+            factory,
+            max_events=self.settings.max_events,
+            queue_size=self.settings.subscriber_queue_size,
+        )
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise JobQueueFull(f"后台任务队列已满（{self.settings.max_queued}个任务排队中）") from None
+        self._jobs[job.id] = job
+        self.submitted += 1
+        logger.info(f"后台任务 {job.id}（{task_name}）已提交，排队 {self._queue.qsize()} 个")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self._jobs.get(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.status == Job.QUEUED:
+                await job._run()
+
+    def _purge(self) -> None:
+        """删除结束超过result_ttl的任务"""
+        cutoff = time.time() - self.settings.result_ttl
+        for job_id in [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.done and job.finished_at is not None and job.finished_at < cutoff
+        ]:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        statuses = [job.status for job in self._jobs.values()]
+        return {
+            "workers": len(self._workers),
+            "queued": statuses.count(Job.QUEUED),
+            "running": statuses.count(Job.RUNNING),
+            "retained": len(statuses),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,34 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List
+
+
+class KeyedLocks:
+    """按键区分的异步锁，没有协程持有或等待某个键时删除该键的锁，字典不会无限增长
+
+    用法:
+        async with locks(sha256):
+            ...
+    """
+
+    def __init__(self):
+        # 键 -> [锁, 持有或等待该锁的协程数]
+        self._entries: Dict[Hashable, List] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        entry = self._entries.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from app.logger import logger
 
 from app.config import TEMPLATE_ROOT, VISUALIZATION_ROOT
@@ -18,12 +19,13 @@ def save_record_to_json(task_name: str, record: str) -> None:
     with open(json_path, 'w', encoding='utf-8') as f:
         f.write(record)
 
-def generate_visualization_html(task_name: str) -> None:
+def generate_visualization_html(task_name: str, title: Optional[str] = None) -> None:
     """
     根据任务名生成可视化HTML文件，将record.html作为模板
     
     参数:
         task_name: 任务名称，用于生成HTML文件名和JSON文件名
+        title: 页面标题中显示的名称，默认使用task_name
     """
     # 确保visualization目录存在
     os.makedirs(VISUALIZATION_ROOT, exist_ok=True)
@@ -49,14 +51,15 @@ def generate_visualization_html(task_name: str) -> None:
     )
     
     # 更新页面标题
+    title = (title or task_name).replace('_', ' ').capitalize()
     modified_content = modified_content.replace(
         "<title>Agent执行过程可视化</title>",
-        f"<title>{task_name.replace('_', ' ').capitalize()} Agent执行过程可视化</title>"
+        f"<title>{title} Agent执行过程可视化</title>"
     )
     
     modified_content = modified_content.replace(
         "<h1 class=\"display-4\">Agent执行过程可视化</h1>",
-        f"<h1 class=\"display-4\">{task_name.replace('_', ' ').capitalize()} Agent执行过程可视化</h1>"
+        f"<h1 class=\"display-4\">{title} Agent执行过程可视化</h1>"
     )
     
     # 写入新的HTML文件
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
+from app.config import WORKSPACE_ROOT, WorkspaceSettings
+from app.logger import logger
+
+if TYPE_CHECKING:
+    from app.utils.dataset_store import DatasetStore
+    from app.utils.downloader import DatasetDownloader
+
+
+RUNS_ROOT = WORKSPACE_ROOT / "runs"
+
+# 正在使用的运行目录名，清理程序不会删除这些目录
+_active_runs: Set[str] = set()
+
+
+def new_run_id(task_name: str) -> str:
+    """生成唯一的运行ID，例如20250101_120000_code_analysis_1a2b3c4d"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{timestamp}_{task_name}_{uuid.uuid4().hex[:8]}"
+
+
+class RunWorkspace:
+    """一次智能体运行独占的工作目录
+
+    上传的文件、解压目录和任务输出都放在WORKSPACE_ROOT/runs/<run_id>/下，
+    任务输出写入其中的temp子目录，并发运行的任务不会互相覆盖。
+
+    用法:
+        run = RunWorkspace.create("code_analysis")
+        output_file = run.path("temp", "function.json")
+        ...
+        run.cleanup()
+    """
+
+    def __init__(self, run_id: str, root: Path):
+        self.run_id = run_id
+        self.root = root
+        self.temp_dir = root / "temp"
+
+    @classmethod
+    def create(cls, task_name: str, runs_root: Optional[Path] = None) -> "RunWorkspace":
+        run_id = new_run_id(task_name)
+        run = cls(run_id, Path(runs_root or RUNS_ROOT) / run_id)
+        run.temp_dir.mkdir(parents=True, exist_ok=True)
+        _active_runs.add(run_id)
+        return run
+
+    def path(self, *parts: str) -> str:
+        """运行目录下的路径"""
+        return str(self.root.joinpath(*parts))
+
+    def release(self, keep: bool = False) -> None:
+        """运行结束；keep为False时立即删除运行目录，否则留给清理程序按TTL删除"""
+        _active_runs.discard(self.run_id)
+        if keep:
+            # 以结束时间作为TTL的起点
+            os.utime(self.root)
+            return
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        _active_runs.discard(self.run_id)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class WorkspaceJanitor:
+    """定期删除超过TTL的运行目录
+
+    删除在线程中进行，不阻塞事件循环；正在使用的运行目录不会被删除。
+    用于回收客户端断开等情况下没有被及时清理的目录。
+    指定dataset_store时同时删除超过其TTL未使用的数据集和解压缓存，
+    指定downloader时同时删除超过cache_ttl未使用的下载缓存。
+    """
+
+    def __init__(
+        self,
+        settings: Optional[WorkspaceSettings] = None,
+        runs_root: Optional[Path] = None,
+        dataset_store: Optional["DatasetStore"] = None,
+        downloader: Optional["DatasetDownloader"] = None,
+    ):
+        self.settings = settings or WorkspaceSettings()
+        self.runs_root = Path(runs_root or RUNS_ROOT)
+        self.dataset_store = dataset_store
+        self.downloader = downloader
+        self._task: Optional[asyncio.Task] = None
+
+        self.sweeps = 0
+        self.removed = 0
+
+    def start(self) -> None:
+        if self._task is None and self.settings.janitor_interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"清理过期的运行目录失败: {str(e)}")
+            await asyncio.sleep(self.settings.janitor_interval)
+
+    async def sweep(self) -> int:
+        """删除最后修改时间早于run_ttl的运行目录，返回删除的数量"""
+        removed = await asyncio.to_thread(self._sweep, time.time() - self.settings.run_ttl)
+        self.sweeps += 1
+        self.removed += removed
+        if removed:
+            logger.info(f"已删除 {removed} 个过期的运行目录")
+        store = self.dataset_store
+        if store is not None and store.settings.ttl > 0:
+            await asyncio.to_thread(store.prune, time.time() - store.settings.ttl)
+        downloader = self.downloader
+        if downloader is not None and downloader.settings.cache_ttl > 0:
+            await asyncio.to_thread(downloader.prune, time.time() - downloader.settings.cache_ttl)
+        return removed
+
+    def _sweep(self, cutoff: float) -> int:
+        if not self.runs_root.is_dir():
+            return 0
+        removed = 0
+        for entry in os.scandir(self.runs_root):
+            if not entry.is_dir() or entry.name in _active_runs:
+                continue
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_runs": len(_active_runs),
+            "sweeps": self.sweeps,
+            "removed": self.removed,
+        }
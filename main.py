@@ -33,37 +33,27 @@ async def run_agent(task_name: str, prompt: str) -> None:
         else:
             logger.warning(f"配置文件 {config_path} 不存在，将使用默认服务器")
         
-        # 添加内置MCP服务器
-        logger.info("添加默认内置MCP服务器")
-        built_in_server_id = await runner.add_server(
-            connection_type="stdio",
-            server_url=None,
-            command=None,  # 使用默认Python解释器
-            args=None,     # 使用默认的app.mcp.server模块
-            server_id="stdio_built_in"  # 指定一个固定ID以便识别
-        )
-        logger.info(f"已添加内置MCP服务器: {built_in_server_id}")
+        # 内置MCP服务器和配置文件中的所有服务器并发连接
+        server_configs = [{
+            "connection_type": "stdio",
+            "server_url": None,
+            "command": None,  # 使用默认Python解释器
+            "args": None,     # 使用默认的app.mcp.server模块
+            "server_id": "stdio_built_in"  # 指定一个固定ID以便识别
+        }]
+        for idx, server_config in enumerate(servers_config):
+            # 只有当有足够的配置信息时才添加服务器
+            if server_config.get("server_url") or server_config.get("command"):
+                server_configs.append({
+                    "connection_type": server_config.get("connection_type", "stdio"),
+                    "server_url": server_config.get("server_url"),
+                    "command": server_config.get("command"),
+                    "args": server_config.get("args"),
+                    "server_id": server_config.get("server_id") or f"config_server_{idx}"
+                })
         
-        # 添加配置文件中的所有服务器
-        if servers_config:
-            for idx, server_config in enumerate(servers_config):
-                connection_type = server_config.get("connection_type", "stdio")
-                server_url = server_config.get("server_url")
-                command = server_config.get("command")
-                args = server_config.get("args")
-                server_id = server_config.get("server_id") or f"config_server_{idx}"
-                
-                # 只有当有足够的配置信息时才添加服务器
-                if server_url or command:
-                    logger.info(f"添加配置文件中的服务器 #{idx+1}")
-                    server_id = await runner.add_server(
-                        connection_type=connection_type,
-                        server_url=server_url,
-                        command=command,
-                        args=args,
-                        server_id=server_id
-                    )
-                    logger.info(f"已添加服务器: {server_id}, 类型: {connection_type}")
+        connected = await runner.add_servers(server_configs)
+        logger.info(f"已添加服务器: {connected}")
         
         # 执行智能体任务
         result = await runner.agent.run(prompt)
@@ -4,7 +4,9 @@ import asyncio
 import sys
 import json
 from datetime import datetime
+from typing import List, Optional
 from app.agent.mcp import MCPAgent
+from app.agent.plan import PlanExecuteAgent
 from app.config import config
 from app.logger import logger
 from app.task.code_analysis import (
@@ -15,16 +17,35 @@ from app.task.code_analysis import (
 from app.utils.visualize_record import save_record_to_json, generate_visualization_html
 from app.schema import AgentState
 from app.tool.mcp import MCPClientTool
+from app.tool.mcp_lifecycle import MCPLifecycleManager
+from app.tool.mcp_pool import MCPSessionPool
 
 class MCPRunner:
     """MCP智能体运行器类，具有适当的路径处理和配置。"""
 
-    def __init__(self, agent_name: str = "Micro-Agent"):
+    def __init__(
+        self,
+        agent_name: str = "Micro-Agent",
+        plan_mode: bool = False,
+        agent: Optional[MCPAgent] = None,
+        server_configs: Optional[List[dict]] = None,
+    ):
+        """
+        参数:
+            agent_name: 智能体名称
+            plan_mode: 是否使用计划-执行模式
+            agent: 已连接服务器的智能体（例如从智能体池租用），为None时新建
+            server_configs: agent已连接的服务器配置，用于重连
+        """
         self.root_path = config.root_path
         self.server_reference = "app.mcp.server"
-        self.agent = MCPAgent(name=agent_name)
+        if agent is None:
+            # 计划模式下由LLM一次规划多步工具调用，在本地批量执行
+            agent_class = PlanExecuteAgent if plan_mode else MCPAgent
+            agent = agent_class(name=agent_name)
+        self.agent = agent
         # 存储服务器配置，支持多个服务器连接
-        self.server_configs = []
+        self.server_configs = [dict(c) for c in (server_configs or [])]
 
     async def add_server(
         self,
@@ -91,6 +112,48 @@ class MCPRunner:
         logger.info(f"通过{connection_type}连接到MCP服务器 {server_id}")
         return server_id
 
+    async def add_servers(
+        self, server_configs: List[dict], timeout: Optional[float] = None
+    ) -> List[str]:
+        """并发添加并连接多个MCP服务器，单个服务器失败不影响其他服务器。
+
+        参数:
+            server_configs: 服务器配置列表，字段与add_server的参数相同
+            timeout: 每个服务器的连接超时（秒），None表示使用配置中的默认值
+
+        返回:
+            List[str]: 连接成功的服务器ID，按配置顺序排列
+        """
+        configs = []
+        for server in server_configs:
+            server = dict(server)
+            connection_type = server.get("connection_type", "stdio")
+            # 设置默认值 - 使用内置的MCP服务器模块
+            if connection_type == "stdio" and not server.get("command"):
+                server["command"] = sys.executable
+                server["args"] = server.get("args") or ["-m", self.server_reference]
+            configs.append(server)
+
+        logger.info(f"并发连接 {len(configs)} 个MCP服务器...")
+        results = await self.agent.add_servers(configs, timeout=timeout)
+
+        connected = []
+        for server, (server_id, error) in zip(configs, results):
+            if error is not None:
+                continue
+            connected.append(server_id)
+            # 保存服务器配置以便后续重连
+            self.server_configs.append({
+                "server_id": server_id,
+                "connection_type": server.get("connection_type", "stdio"),
+                "server_url": server.get("server_url"),
+                "command": server.get("command"),
+                "args": server.get("args"),
+            })
+
+        logger.info(f"已连接 {len(connected)}/{len(configs)} 个MCP服务器: {connected}")
+        return connected
+
     async def ensure_connections(self) -> bool:
         """确保所有MCP连接可用，如果断开则重新连接。
         
@@ -111,7 +174,7 @@ class MCPRunner:
                 
                 # 创建新的Agent实例
                 agent_name = self.agent.name
-                self.agent = MCPAgent(name=agent_name)
+                self.agent = type(self.agent)(name=agent_name)
                 
                 # 重新连接所有配置的服务器
                 successful_connections = 0
@@ -209,37 +272,55 @@ class MCPRunner:
         )
 
     async def cleanup(self) -> None:
-        """清理智能体资源。"""
+        """清理智能体资源，返回时MCP连接已关闭。"""
+        logger.info("正在清理资源")
         try:
-            # 创建一个分离的任务来执行清理，无需等待其完成
-            logger.info("正在清理资源")
-            
-            async def detached_cleanup():
-                try:
-                    # 尝试调用agent的cleanup
-                    if hasattr(self.agent, 'cleanup'):
-                        await self.agent.cleanup()
-                except Exception as e:
-                    logger.error(f"代理清理过程中出错: {str(e)}")
-            
-            # 创建任务但不等待其完成
-            asyncio.create_task(detached_cleanup())
-            
-            # 记录清理开始信息
-            logger.info("会话已结束，清理过程已在后台启动")
+            await self.agent.cleanup()
         except Exception as e:
-            logger.error(f"启动清理过程时出错: {str(e)}")
-            # 即使清理失败，也不影响主程序退出
+            logger.error(f"代理清理过程中出错: {str(e)}")
+
+    async def _step_with_deltas(self):
+        """
+        执行单个步骤，同时转发LLM生成过程中的增量事件
+
+        返回:
+            异步生成器，先产生增量事件({"is_delta": True, ...})，最后产生步骤结果
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        self.agent.delta_queue = queue
+        step_task = asyncio.create_task(self.agent.step())
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    {getter, step_task}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if getter not in done:
+                    getter.cancel()
+                    break
+                # 不使用step字段，避免前端将增量事件当作步骤渲染
+                yield {"is_delta": True, "current_step": self.agent.current_step, **getter.result()}
+
+            while not queue.empty():
+                yield {"is_delta": True, "current_step": self.agent.current_step, **queue.get_nowait()}
+
+            yield step_task.result()
+        finally:
+            self.agent.delta_queue = None
+            if not step_task.done():
+                step_task.cancel()
 
-    async def run_stream(self, prompt: str):
+    async def run_stream(self, prompt: str, stream_deltas: bool = False):
         """
         以流式方式运行智能体，每完成一个步骤就yield结果
 
         参数:
             prompt: 任务的prompt
+            stream_deltas: 是否在步骤进行中转发LLM的内容和工具参数增量
         
         返回:
-            异步生成器，每次返回单个步骤的结果
+            异步生成器，每次返回单个步骤的结果；启用stream_deltas时，
+            步骤结果之前还会返回带有is_delta标记的增量事件
         """
         if not await self.ensure_connections():
             yield {"error": "无法连接到MCP服务器，请检查服务器状态或重启程序"}
@@ -263,7 +344,14 @@ class MCPRunner:
                     logger.info(f"执行步骤 {self.agent.current_step}/{self.agent.max_steps}")
                     
                     # 执行单个步骤
-                    step_result = await self.agent.step()
+                    if stream_deltas:
+                        async for event in self._step_with_deltas():
+                            if event.get("is_delta"):
+                                yield event
+                            else:
+                                step_result = event
+                    else:
+                        step_result = await self.agent.step()
                     step_result["step"] = self.agent.current_step
                     
                     # 检查是否陷入循环
@@ -352,6 +440,9 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--interactive", "-i", action="store_true", help="以交互模式运行"
     )
+    parser.add_argument(
+        "--plan", action="store_true", help="使用计划-执行模式，减少LLM往返次数"
+    )
     parser.add_argument("--prompt", "-p", help="执行单个提示并退出")
     parser.add_argument("--subtask", "-s", choices=["1", "2", "3", ""], 
                         default="", help="执行子任务并退出")
@@ -361,68 +452,46 @@ def parse_args() -> argparse.Namespace:
 async def run_mcp() -> None:
     """MCP运行器的主入口点。"""
     args = parse_args()
-    runner = MCPRunner()
+    runner = MCPRunner(plan_mode=args.plan)
     
     try:
-        # 首先添加内置MCP服务器
-        built_in_server_id = None
-        try:
-            logger.info("添加默认内置MCP服务器")
-            built_in_server_id = await runner.add_server(
-                connection_type="stdio",
-                server_url=None,
-                command=None,  # 使用默认Python解释器
-                args=None,     # 使用默认的app.mcp.server模块
-                server_id="stdio_built_in"  # 指定一个固定ID以便识别
-            )
-            logger.info(f"成功添加内置MCP服务器: {built_in_server_id}")
-        except Exception as e:
-            logger.error(f"添加内置MCP服务器时出错: {str(e)}")
-            # 如果内置服务器失败，仍然尝试用户指定的服务器
+        # 内置MCP服务器、主服务器和额外的服务器并发连接
+        server_configs = [{
+            "connection_type": "stdio",
+            "server_url": None,
+            "command": None,  # 使用默认Python解释器
+            "args": None,     # 使用默认的app.mcp.server模块
+            "server_id": "stdio_built_in"  # 指定一个固定ID以便识别
+        }]
         
         # 连接到主服务器（如果与内置服务器不同）
         if args.connection != "stdio" or args.server_url or args.server_id:
-            try:
-                await runner.add_server(
-                    connection_type=args.connection,
-                    server_url=args.server_url,
-                    server_id=args.server_id
-                )
-            except Exception as e:
-                logger.error(f"连接到主服务器时出错: {str(e)}")
-                # 如果至少有内置服务器，则不需要中断程序
-                if not built_in_server_id:
-                    raise RuntimeError("无法连接到任何MCP服务器，程序无法继续执行") from e
+            server_configs.append({
+                "connection_type": args.connection,
+                "server_url": args.server_url,
+                "server_id": args.server_id
+            })
         
         # 连接到额外的SSE服务器
-        if args.sse_servers:
-            for i, url in enumerate(args.sse_servers):
-                try:
-                    server_id = args.sse_ids[i] if i < len(args.sse_ids) else None
-                    await runner.add_server(
-                        connection_type="sse",
-                        server_url=url,
-                        server_id=server_id
-                    )
-                except Exception as e:
-                    logger.error(f"连接到额外的SSE服务器 {url} 时出错: {str(e)}")
-                    # 继续连接其他服务器，不中断整个程序
+        for i, url in enumerate(args.sse_servers):
+            server_configs.append({
+                "connection_type": "sse",
+                "server_url": url,
+                "server_id": args.sse_ids[i] if i < len(args.sse_ids) else None
+            })
             
         # 连接到额外的stdio服务器
-        if args.stdio_servers:
-            for i, command in enumerate(args.stdio_servers):
-                try:
-                    server_id = args.stdio_ids[i] if i < len(args.stdio_ids) else None
-                    cmd_args = args.stdio_args[i] if i < len(args.stdio_args) else None
-                    await runner.add_server(
-                        connection_type="stdio",
-                        command=command,
-                        args=cmd_args,
-                        server_id=server_id
-                    )
-                except Exception as e:
-                    logger.error(f"连接到额外的stdio服务器 {command} 时出错: {str(e)}")
-                    # 继续连接其他服务器，不中断整个程序
+        for i, command in enumerate(args.stdio_servers):
+            server_configs.append({
+                "connection_type": "stdio",
+                "command": command,
+                "args": args.stdio_args[i] if i < len(args.stdio_args) else None,
+                "server_id": args.stdio_ids[i] if i < len(args.stdio_ids) else None
+            })
+
+        # 单个服务器连接失败不中断程序，只要至少连接了一个服务器
+        if not await runner.add_servers(server_configs):
+            raise RuntimeError("无法连接到任何MCP服务器，程序无法继续执行")
 
         # 根据参数执行不同的操作
         try:
@@ -443,17 +512,13 @@ async def run_mcp() -> None:
     except Exception as e:
         logger.error(f"运行MCPAgent时出错: {str(e)}", exc_info=True)
     finally:
-        # 确保在程序退出前尝试清理资源，但不等待其完成
-        # 这里使用不会抛出异常的方式调用cleanup
-        try:
-            # 创建分离的清理任务但不等待它
-            logger.info("程序退出前执行最终清理")
-            asyncio.create_task(runner.cleanup())
-            # 给清理任务一点启动时间，但不等待它完成
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"最终清理时出错: {str(e)}")
-            # 继续退出程序
+        # 程序退出前关闭所有MCP连接并回收服务器子进程
+        logger.info("程序退出前执行最终清理")
+        await runner.cleanup()
+        await MCPSessionPool.shared().close()
+        report = await MCPLifecycleManager.shared().shutdown()
+        if report["sessions"]["live"] or report["processes"]["live"]:
+            logger.warning(f"仍有未关闭的MCP资源: {report}")
 
 
 if __name__ == "__main__":
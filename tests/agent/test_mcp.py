@@ -0,0 +1,157 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app.agent.mcp import MCPAgent
+from app.tool.mcp import MCPClients
+from app.tool.mcp_pool import MCPSessionPool
+from tests.test_llm import _make_llm
+
+
+class FakeSession:
+    def __init__(self, tools, supports_notifications: bool = False):
+        self.tools = tools
+        self.supports_tool_notifications = supports_notifications
+        self.listeners = []
+        self.list_calls = 0
+
+    async def list_tools(self):
+        self.list_calls += 1
+        return SimpleNamespace(tools=self.tools)
+
+    def add_tools_changed_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_tools_changed_listener(self, listener):
+        self.listeners.remove(listener)
+
+
+def _tool(name):
+    return SimpleNamespace(name=name, description=name, inputSchema={"type": "object"})
+
+
+class SlowConnectClients(MCPClients):
+    """按命令配置握手延迟的假MCPClients"""
+
+    def __init__(self, delays):
+        super().__init__(use_session_pool=False)
+        self.delays = delays
+
+    async def connect_stdio(self, command, args, server_id=None):
+        delay = self.delays[command]
+        if delay is None:
+            raise ConnectionError(f"{command} refused")
+        await asyncio.sleep(delay)
+        session = FakeSession([_tool(f"{command}_a"), _tool(f"{command}_b")])
+        self.sessions[server_id] = session
+        self._register_tools(server_id, session, session.tools)
+        return server_id
+
+
+def _agent(delays) -> MCPAgent:
+    clients = SlowConnectClients(delays)
+    return MCPAgent(llm=_make_llm("test_mcp_add_servers"), mcp_clients=clients)
+
+
+def _configs(*commands):
+    return [
+        {"connection_type": "stdio", "command": c, "args": [], "server_id": c}
+        for c in commands
+    ]
+
+
+@pytest.mark.asyncio
+async def test_add_servers_connects_concurrently_in_config_order():
+    """连接并发进行，工具按配置顺序注册，与完成顺序无关"""
+    agent = _agent({"slow": 0.3, "medium": 0.2, "fast": 0.1})
+
+    start = time.monotonic()
+    results = await agent.add_servers(_configs("slow", "medium", "fast"))
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 0.5  # 串行连接需要0.6秒
+    assert results == [("slow", None), ("medium", None), ("fast", None)]
+    assert agent.connected_servers == ["slow", "medium", "fast"]
+    assert [t.name for t in agent.mcp_clients.tools] == [
+        "slow_slow_a", "slow_slow_b",
+        "medium_medium_a", "medium_medium_b",
+        "fast_fast_a", "fast_fast_b",
+    ]
+    assert list(agent.mcp_clients.tool_map) == [t.name for t in agent.mcp_clients.tools]
+    assert agent.available_tools is agent.mcp_clients
+
+
+@pytest.mark.asyncio
+async def test_add_servers_tolerates_failures_and_timeouts():
+    agent = _agent({"ok": 0.01, "broken": None, "hung": 5})
+
+    results = dict(await agent.add_servers(_configs("ok", "broken", "hung"), timeout=0.2))
+
+    assert results["ok"] is None
+    assert isinstance(results["broken"], ConnectionError)
+    assert isinstance(results["hung"], TimeoutError)
+    assert agent.connected_servers == ["ok"]
+    assert set(agent.mcp_clients.tool_map) == {"ok_ok_a", "ok_ok_b"}
+
+
+@pytest.mark.asyncio
+async def test_only_notified_servers_are_refreshed():
+    """收到通知的服务器在下一步刷新，支持通知的其他服务器不再被轮询"""
+    agent = _agent({})
+    notifying = FakeSession([_tool("a")], supports_notifications=True)
+    quiet = FakeSession([_tool("b")], supports_notifications=True)
+    polled = FakeSession([_tool("c")])
+    for server_id, session in (("notifying", notifying), ("quiet", quiet), ("polled", polled)):
+        agent.mcp_clients.sessions[server_id] = session
+        agent.mcp_clients._register_tools(server_id, session, session.tools)
+        agent.connected_servers.append(server_id)
+    await agent._refresh_tools()
+    baseline = [s.list_calls for s in (notifying, quiet, polled)]
+
+    agent.current_step = 1
+    assert agent._servers_to_refresh() == []
+
+    notifying.tools = [_tool("a"), _tool("a2")]
+    notifying.listeners[0]()
+    assert agent._servers_to_refresh() == ["notifying"]
+    added, _ = await agent._refresh_tools(agent._servers_to_refresh())
+
+    assert added == ["notifying_a2"]
+    assert "notifying_a2" in agent.mcp_clients.tool_map
+    assert [s.list_calls for s in (notifying, quiet, polled)] == [
+        baseline[0] + 1, baseline[1], baseline[2]
+    ]
+    # 不支持通知的服务器按间隔轮询
+    agent.current_step = 5
+    assert agent._servers_to_refresh() == ["polled"]
+
+
+@pytest.mark.asyncio
+async def test_list_changed_notification_from_real_server():
+    """真实服务器发送tools/list_changed后只刷新该服务器，新工具可用"""
+    clients = MCPClients(use_session_pool=True, pool_stdio=True, lazy_connect=False)
+    agent = MCPAgent(llm=_make_llm("test_mcp_add_servers"), mcp_clients=clients)
+    echo_server = str(Path(__file__).parents[1] / "tool" / "mcp_echo_server.py")
+    try:
+        await agent.initialize(connection_type="stdio", command=sys.executable,
+                               args=[echo_server], server_id="echo")
+        assert "echo_greet" not in clients.tool_map
+
+        result = await clients.execute(name="echo_add_tool", tool_input={"name": "greet"})
+        assert result.output == "added"
+        await asyncio.sleep(0.1)
+
+        assert agent._servers_to_refresh() == ["echo"]
+        await agent._refresh_tools(agent._servers_to_refresh())
+        assert (await clients.execute(name="echo_greet", tool_input={})).output == "greet"
+    finally:
+        await MCPSessionPool.shared().close()
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
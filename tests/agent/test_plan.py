@@ -0,0 +1,198 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from app.agent.plan import SKIPPED_AFTER_FINISH, PlanExecuteAgent
+from app.schema import AgentState
+from app.tool.base import BaseTool, ToolResult
+from app.tool.mcp import MCPClients
+from tests.test_llm import _make_llm
+
+
+class RecordingTool(BaseTool):
+    """返回固定输出并记录调用参数的假工具"""
+
+    description: str = "recording tool"
+    parameters: dict = {"type": "object", "properties": {}}
+    output: str = ""
+    error: str = ""
+    calls: list = []
+
+    async def execute(self, **kwargs) -> ToolResult:
+        self.calls.append(kwargs)
+        if self.error:
+            return ToolResult(error=self.error)
+        return ToolResult(output=self.output or f"{self.name} done")
+
+
+def _response(tool_calls):
+    """包含给定工具调用的LLM响应"""
+    message = ChatCompletionMessage(
+        role="assistant",
+        content="",
+        tool_calls=[
+            {
+                "id": f"call_{i}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)},
+            }
+            for i, (name, args) in enumerate(tool_calls)
+        ],
+    )
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message)],
+        usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15),
+    )
+
+
+def _plan(*steps):
+    return _response([("submit_plan", {"steps": list(steps)})])
+
+
+def _agent(config_name: str, responses, *tools) -> PlanExecuteAgent:
+    llm = _make_llm(config_name)
+    create = mock.AsyncMock(side_effect=responses)
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    clients = MCPClients()
+    clients.sessions["srv"] = object()
+    for tool in (*tools, RecordingTool(name="terminate")):
+        clients.add_tool(tool)
+    return PlanExecuteAgent(llm=llm, mcp_clients=clients, available_tools=clients)
+
+
+@pytest.mark.asyncio
+async def test_plan_runs_all_steps_with_one_llm_call():
+    """整个计划在一次LLM调用后本地执行，步骤输出传递给后续步骤"""
+    fetch = RecordingTool(name="fetch", output='{"title": "报告", "pages": [3, 5]}')
+    save = RecordingTool(name="save")
+    agent = _agent(
+        "test_plan_data_passing",
+        [
+            _plan(
+                {"id": "s1", "tool": "fetch", "args": {"url": "http://example"}},
+                {"id": "s2", "tool": "save",
+                 "args": {"data": "{{s1}}", "name": "{{s1.title}}-p{{s1.pages.1}}"}},
+                {"id": "s3", "tool": "terminate", "args": {"status": "success"}},
+            )
+        ],
+        fetch,
+        save,
+    )
+
+    await agent.run("生成报告")
+
+    assert agent.state == AgentState.IDLE
+    assert agent.llm_round_trips == 1
+    assert agent.executed_tool_calls == 3
+    # 整体引用保留原始输出，字段引用从JSON输出中取值
+    assert save.calls == [{"data": fetch.output, "name": "报告-p5"}]
+    plan_result = [m for m in agent.memory.messages if m.role == "tool"][-1]
+    assert plan_result.tool_call_id == "call_0"
+    assert "[s2] save" in plan_result.content
+
+
+@pytest.mark.asyncio
+async def test_failed_step_triggers_replan():
+    """步骤失败时停止执行剩余步骤，并把失败信息交给LLM重新规划"""
+    broken = RecordingTool(name="convert", error="格式不支持")
+    fallback = RecordingTool(name="convert_v2")
+    never = RecordingTool(name="publish")
+    agent = _agent(
+        "test_plan_replan",
+        [
+            _plan(
+                {"id": "s1", "tool": "convert", "args": {}},
+                {"id": "s2", "tool": "publish", "args": {"data": "{{s1}}"}},
+            ),
+            _plan(
+                {"id": "s1", "tool": "convert_v2", "args": {}},
+                {"id": "s2", "tool": "terminate", "args": {"status": "success"}},
+            ),
+        ],
+        broken,
+        fallback,
+        never,
+    )
+
+    await agent.run("转换文件")
+
+    assert agent.llm_round_trips == 2
+    assert never.calls == []
+    assert len(fallback.calls) == 1
+    first_result = [m for m in agent.memory.messages if m.role == "tool"][0]
+    assert "格式不支持" in first_result.content
+    assert "重新规划" in first_result.content
+
+
+@pytest.mark.asyncio
+async def test_replan_after_stops_at_branch_point():
+    inspect = RecordingTool(name="inspect")
+    later = RecordingTool(name="later")
+    agent = _agent(
+        "test_plan_branch",
+        [
+            _plan(
+                {"id": "s1", "tool": "inspect", "args": {}, "replan_after": True},
+                {"id": "s2", "tool": "later", "args": {}},
+            ),
+            _response([("terminate", {"status": "success"})]),
+        ],
+        inspect,
+        later,
+    )
+
+    await agent.run("检查后决定")
+
+    assert len(inspect.calls) == 1
+    assert later.calls == []
+    assert agent.llm_round_trips == 2
+
+
+@pytest.mark.asyncio
+async def test_calls_after_finishing_plan_are_skipped_in_order():
+    """工具结果按调用顺序记录，计划结束任务后同一轮的剩余调用只记录跳过"""
+    fetch = RecordingTool(name="fetch")
+    later = RecordingTool(name="later")
+    save = RecordingTool(name="save")
+    agent = _agent(
+        "test_plan_finish_in_batch",
+        [
+            _response(
+                [
+                    ("fetch", {}),
+                    ("submit_plan", {"steps": [
+                        {"id": "s1", "tool": "terminate", "args": {"status": "success"}},
+                    ]}),
+                    ("submit_plan", {"steps": [{"id": "s1", "tool": "later", "args": {}}]}),
+                    ("save", {}),
+                ]
+            )
+        ],
+        fetch,
+        later,
+        save,
+    )
+
+    await agent.run("完成任务")
+
+    assert agent.llm_round_trips == 1
+    assert len(fetch.calls) == 1
+    assert later.calls == [] and save.calls == []
+    # 每个tool_call_id都有对应的工具消息，顺序与调用一致
+    tool_messages = [m for m in agent.memory.messages if m.role == "tool"]
+    assert [m.tool_call_id for m in tool_messages] == ["call_0", "call_1", "call_2", "call_3"]
+    assert [m.content for m in tool_messages[2:]] == [SKIPPED_AFTER_FINISH] * 2
+
+
+def test_unknown_reference_is_rejected():
+    with pytest.raises(KeyError):
+        PlanExecuteAgent._resolve_references({"data": "{{missing}}"}, {})
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
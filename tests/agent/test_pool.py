@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+from typing import ClassVar
+
+import pytest
+
+from app.agent.mcp import MCPAgent
+from app.agent.pool import AgentPool
+from app.config import AgentPoolSettings
+from app.exceptions import AgentPoolExhausted
+from app.schema import AgentState, Message
+from tests.test_llm import _make_llm
+
+
+class FakeSession:
+    """可配置ping是否成功的假MCP会话"""
+
+    def __init__(self):
+        self.healthy = True
+
+    async def send_ping(self):
+        if not self.healthy:
+            raise ConnectionError("server gone")
+
+    async def list_tools(self):
+        return SimpleNamespace(tools=[])
+
+
+class FakeMCPAgent(MCPAgent):
+    """不启动服务器进程、只登记假会话的MCPAgent"""
+
+    connects: ClassVar[int] = 0
+
+    async def initialize(self, server_id=None, **kwargs) -> str:
+        type(self).connects += 1
+        self.mcp_clients.sessions[server_id] = FakeSession()
+        self.available_tools = self.mcp_clients
+        self.connected_servers.append(server_id)
+        return server_id
+
+
+def _pool(**settings) -> AgentPool:
+    FakeMCPAgent.connects = 0
+    settings = AgentPoolSettings(**{"health_check_interval": 0, **settings})
+    return AgentPool(FakeMCPAgent, settings, agent_kwargs={"llm": _make_llm("test_pool")})
+
+
+@pytest.mark.asyncio
+async def test_leased_agent_is_prewarmed_and_reset_on_release():
+    pool = _pool(min_size=1, max_size=2)
+    await pool.start()
+    assert pool.stats()["created"] == 1
+
+    agent = await pool.lease("Task Agent")
+    assert pool.stats()["created"] == 1  # 租用时不再创建智能体
+    built_in = agent.mcp_clients.sessions["stdio_built_in"]
+    assert agent.name == "Task Agent"
+    await agent.connect_additional_server(connection_type="stdio", server_id="task_server")
+    agent.memory.add_message(Message.user_message("任务"))
+    agent.current_step = 7
+    agent.state = AgentState.FINISHED
+    agent.handle_stuck_state()
+
+    await pool.release(agent)
+
+    again = await pool.lease()
+    assert again is agent
+    # stdio基础服务器在归还时重新连接，服务器端状态不会带到下一个请求
+    assert agent.mcp_clients.sessions["stdio_built_in"] is not built_in
+    assert agent.connected_servers == ["stdio_built_in"]
+    assert "task_server" not in agent.mcp_clients.sessions
+    assert agent.memory.messages == []
+    assert agent.current_step == 0
+    assert agent.state == AgentState.IDLE
+    assert agent.next_step_prompt == FakeMCPAgent.model_fields["next_step_prompt"].default
+    await pool.release(again)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_lease_waits_for_release_and_respects_max_size():
+    pool = _pool(min_size=0, max_size=2, lease_timeout=0.2)
+    first, second = await pool.lease(), await pool.lease()
+
+    with pytest.raises(AgentPoolExhausted):
+        await pool.lease()
+
+    waiter = asyncio.create_task(pool.lease())
+    await asyncio.sleep(0.05)
+    await pool.release(first)
+    assert await waiter is first
+    assert pool.stats()["size"] == 2
+    assert pool.stats()["created"] == 2
+
+
+@pytest.mark.asyncio
+async def test_unhealthy_idle_agent_is_replaced():
+    pool = _pool(min_size=1, max_size=1)
+    await pool.start()
+    stale = pool._idle[0]
+    stale.mcp_clients.sessions["stdio_built_in"].healthy = False
+
+    agent = await pool.lease()
+
+    assert agent is not stale
+    assert stale.connected_servers == []
+    assert pool.stats()["discarded"] == 1
+    assert pool.stats()["created"] == 2
+
+
+@pytest.mark.asyncio
+async def test_stdio_restart_on_release_can_be_disabled():
+    pool = _pool(min_size=1, max_size=1, restart_stdio_servers=False)
+    await pool.start()
+    agent = await pool.lease()
+    built_in = agent.mcp_clients.sessions["stdio_built_in"]
+    await pool.release(agent)
+
+    assert agent.mcp_clients.sessions["stdio_built_in"] is built_in
+    assert FakeMCPAgent.connects == 1
+    await pool.close()
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,354 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+
+import httpx
+import pytest
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from app.agent.toolcall import ToolCallAgent
+from app.schema import AgentState, Function, Message, ToolCall
+from app.tool import ToolCollection
+from app.tool.base import BaseTool, ToolResult
+from app.tool.mcp import MCPClientTool, MCPClients
+from mcp.types import TextContent
+from tests.test_llm import _chunk, _make_llm
+
+
+def _agent(config_name: str) -> ToolCallAgent:
+    """创建使用假OpenAI客户端的ToolCallAgent"""
+    llm = _make_llm(config_name)
+    response = SimpleNamespace(
+        choices=[
+            SimpleNamespace(message=ChatCompletionMessage(role="assistant", content="继续"))
+        ],
+        usage=SimpleNamespace(
+            prompt_tokens=100,
+            completion_tokens=5,
+            total_tokens=105,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=80),
+        ),
+    )
+    create = mock.AsyncMock(return_value=response)
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    agent = ToolCallAgent(llm=llm)
+    agent.memory.add_message(Message.user_message("原始任务"))
+    return agent
+
+
+def _sent_messages(agent: ToolCallAgent):
+    """每次请求发送给LLM的消息列表"""
+    create = agent.llm.client.chat.completions.create
+    return [call.kwargs["messages"] for call in create.await_args_list]
+
+
+@pytest.mark.asyncio
+async def test_step_prompt_is_not_stored_in_memory():
+    """每步的提示只出现在请求末尾，不会累积到历史消息中"""
+    agent = _agent("test_prompt_prefix")
+
+    await agent.think()
+    await agent.think()
+
+    assert all(m.content != agent.next_step_prompt for m in agent.memory.messages)
+    requests = _sent_messages(agent)
+    # 第一次请求的前缀（去掉末尾的临时提示）在第二次请求中保持不变
+    assert requests[1][: len(requests[0]) - 1] == requests[0][:-1]
+    assert requests[0][0]["role"] == "system"
+    assert requests[1][-1] == {"role": "user", "content": agent.next_step_prompt}
+
+
+@pytest.mark.asyncio
+async def test_notices_are_sent_once():
+    """临时通知只附加到下一次请求"""
+    agent = _agent("test_prompt_notice")
+    agent.add_notice("新可用工具: demo")
+
+    await agent.think()
+    await agent.think()
+
+    requests = _sent_messages(agent)
+    assert requests[0][-1]["content"].startswith("新可用工具: demo")
+    assert "新可用工具" not in requests[1][-1]["content"]
+
+
+@pytest.mark.asyncio
+async def test_cached_tokens_reported_in_token_usage():
+    agent = _agent("test_prompt_cached_tokens")
+
+    _, _, _, token_usage = await agent.think()
+
+    assert token_usage.cached_tokens == 80
+
+
+class SlowTool(BaseTool):
+    """耗时固定的假工具，记录同时运行的调用数"""
+
+    name: str
+    description: str = "slow tool"
+    parameters: dict = {"type": "object", "properties": {}}
+    server_id: Optional[str] = None
+    delay: float = 0.1
+    running: int = 0
+    peak: int = 0
+
+    async def execute(self, **kwargs) -> ToolResult:
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        return ToolResult(output=f"{self.name} done", base64_image=kwargs.get("image"))
+
+
+def _calls(*specs):
+    return [
+        ToolCall(id=f"call_{i}", function=Function(name=name, arguments=arguments))
+        for i, (name, arguments) in enumerate(specs)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_parallel_tool_calls_keep_order_and_images():
+    """并行执行的结果按原始调用顺序写入记忆，图片归属各自的调用"""
+    tools = [SlowTool(name=f"tool_{i}", delay=0.3 - i * 0.1) for i in range(3)]
+    agent = _agent("test_parallel_tools")
+    agent.available_tools = ToolCollection(*tools)
+    agent.parallel_tool_calls = True
+    agent.tool_calls = _calls(
+        ("tool_0", '{"image": "img0"}'), ("tool_1", "{}"), ("tool_2", '{"image": "img2"}')
+    )
+
+    start = time.monotonic()
+    await agent.act()
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 0.5  # 串行执行需要0.6秒
+    tool_msgs = [m for m in agent.memory.messages if m.role == "tool"]
+    assert [m.tool_call_id for m in tool_msgs] == ["call_0", "call_1", "call_2"]
+    assert [m.base64_image for m in tool_msgs] == ["img0", None, "img2"]
+    assert tool_msgs[0].content.endswith("tool_0 done")
+
+
+@pytest.mark.asyncio
+async def test_parallel_tool_calls_respect_limits():
+    """全局并发上限和每个服务器的并发上限"""
+    server_tool = SlowTool(name="srv_query", server_id="srv", delay=0.05)
+    other_tool = SlowTool(name="other_query", delay=0.05)
+    agent = _agent("test_parallel_limits")
+    agent.available_tools = ToolCollection(server_tool, other_tool)
+    agent.parallel_tool_calls = True
+    agent.max_parallel_tool_calls = 3
+    agent.server_concurrency = {"srv": 1}
+    agent.tool_calls = _calls(*[("srv_query", "{}")] * 3, *[("other_query", "{}")] * 4)
+
+    await agent.act()
+
+    assert server_tool.peak == 1
+    assert other_tool.peak <= 3
+    assert len([m for m in agent.memory.messages if m.role == "tool"]) == 7
+
+
+class TerminatingAgent(ToolCallAgent):
+    """与MCPAgent一样在特殊工具执行后写入系统消息"""
+
+    async def _handle_special_tool(self, name, result, **kwargs):
+        await super()._handle_special_tool(name, result, **kwargs)
+        if self._is_special_tool(name):
+            self.memory.add_message(Message.system_message("交互已终止"))
+
+
+@pytest.mark.asyncio
+async def test_parallel_special_tool_is_handled_in_call_order():
+    """并行批次中的terminate先完成，其系统消息仍按调用顺序写入记忆"""
+    tools = [SlowTool(name="slow", delay=0.1), SlowTool(name="terminate", delay=0.0)]
+    agent = TerminatingAgent(llm=_make_llm("test_parallel_special"))
+    agent.available_tools = ToolCollection(*tools, SlowTool(name="after", delay=0.05))
+    agent.parallel_tool_calls = True
+    agent.tool_calls = _calls(("slow", "{}"), ("terminate", "{}"), ("after", "{}"))
+
+    await agent.act()
+
+    assert [(m.role, m.tool_call_id) for m in agent.memory.messages] == [
+        ("tool", "call_0"), ("system", None), ("tool", "call_1"), ("tool", "call_2")
+    ]
+    assert agent.state == AgentState.FINISHED
+
+
+class SlowMCPSession:
+    """按工具名配置延迟的假MCP会话，记录每次调用的开始和结束时间"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.started = {}
+        self.finished = {}
+        self.calls = []
+
+    async def call_tool(self, name, arguments):
+        self.calls.append((name, arguments))
+        self.started[name] = time.monotonic()
+        await asyncio.sleep(self.delays[name])
+        self.finished[name] = time.monotonic()
+        return SimpleNamespace(content=[TextContent(type="text", text=f"{name} ok")])
+
+
+class SlowStream:
+    """每个chunk之间间隔固定时间的流式响应，chunk用完后可以模拟连接中断"""
+
+    def __init__(self, chunks, interval: float, fail: bool = False):
+        self._chunks = iter(chunks)
+        self._interval = interval
+        self._fail = fail
+        self.finished_at = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(self._interval)
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self.finished_at = time.monotonic()
+            if self._fail:
+                raise httpx.ReadError("connection dropped")
+            raise StopAsyncIteration
+
+
+def _streamed_tool_calls(names, usage: bool = True):
+    """每个工具调用分两个chunk生成：名称和一半参数，然后是剩余参数"""
+    chunks = []
+    for index, name in enumerate(names):
+        chunks.append(
+            _chunk(tool_calls=[{"index": index, "id": f"call_{index}", "type": "function",
+                                "function": {"name": name, "arguments": '{"q": '}}])
+        )
+        chunks.append(
+            _chunk(tool_calls=[{"index": index, "function": {"arguments": f'"{index}"}}'}}])
+        )
+    if usage:
+        chunks.append(
+            _chunk(usage={"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20})
+        )
+    return chunks
+
+
+def _mcp_agent(config_name: str, delays, streams) -> ToolCallAgent:
+    """使用假流式LLM和慢速假MCP工具的智能体，streams依次作为每次请求的响应"""
+    llm = _make_llm(config_name, retry_min_wait=0, retry_max_wait=0)
+    create = mock.AsyncMock(side_effect=streams)
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    session = SlowMCPSession({f"remote_{name}": delay for name, delay in delays.items()})
+    clients = MCPClients()
+    for name in delays:
+        clients.add_tool(
+            MCPClientTool(
+                name=name, description=name, parameters={"type": "object"},
+                session=session, server_id=name, original_name=f"remote_{name}",
+            )
+        )
+
+    agent = ToolCallAgent(llm=llm, available_tools=clients)
+    agent.memory.add_message(Message.user_message("查询"))
+    # 始终以流式方式请求，使各模式的生成过程相同
+    agent.delta_queue = asyncio.Queue()
+    return agent
+
+
+async def _run_mcp_step(mode: str, delays, interval: float = 0.05):
+    """用流式假LLM和慢速假MCP工具执行一步，返回智能体、会话和流"""
+    stream = SlowStream(_streamed_tool_calls(list(delays)), interval)
+    agent = _mcp_agent(f"test_pipeline_{mode}", delays, [stream])
+    agent.parallel_tool_calls = mode != "sequential"
+    agent.pipeline_tool_calls = mode == "pipelined"
+
+    await agent.step()
+    session = agent.available_tools.get_tool(next(iter(delays))).session
+    return agent, session, stream
+
+
+@pytest.mark.asyncio
+async def test_pipelined_dispatch_starts_tools_during_generation():
+    """参数JSON完整后立即执行工具，结果仍按顺序写入记忆"""
+    agent, session, _ = await _run_mcp_step(
+        "pipelined", {"slow": 0.3, "fast_a": 0.01, "fast_b": 0.01}
+    )
+
+    tool_msgs = [m for m in agent.memory.messages if m.role == "tool"]
+    assert [m.tool_call_id for m in tool_msgs] == ["call_0", "call_1", "call_2"]
+    assert tool_msgs[0].content.endswith("remote_slow ok")
+    # 第一个工具在第二个调用生成完成前就已开始执行
+    assert session.started["remote_slow"] < session.started["remote_fast_a"]
+
+
+@pytest.mark.asyncio
+async def test_pipelined_vs_parallel_vs_sequential_overlap():
+    """流水线在生成期间启动工具；并行在生成结束后同时启动；串行逐个执行"""
+    delays = {"slow": 0.2, "fast_a": 0.05, "fast_b": 0.05}
+    names = [f"remote_{name}" for name in delays]
+
+    _, session, stream = await _run_mcp_step("pipelined", delays)
+    assert session.started[names[0]] < stream.finished_at
+
+    _, session, stream = await _run_mcp_step("parallel", delays)
+    assert all(session.started[name] >= stream.finished_at for name in names)
+    assert max(session.started.values()) < min(session.finished.values())
+
+    _, session, stream = await _run_mcp_step("sequential", delays)
+    for previous, name in zip(names, names[1:]):
+        assert session.started[name] >= session.finished[previous]
+
+
+@pytest.mark.asyncio
+async def test_pipelined_special_tool_is_not_started_early():
+    """特殊工具会修改智能体状态，要等助手消息写入记忆后才执行"""
+    delays = {"search": 0.01, "terminate": 0.01}
+    stream = SlowStream(_streamed_tool_calls(list(delays)), 0.05)
+    agent = _mcp_agent("test_pipeline_special", delays, [stream])
+    agent.pipeline_tool_calls = True
+
+    await agent.step()
+
+    session = agent.available_tools.get_tool("search").session
+    assert session.started["remote_search"] < stream.finished_at
+    assert session.started["remote_terminate"] >= stream.finished_at
+    roles = [m.role for m in agent.memory.messages]
+    assert roles == ["user", "assistant", "tool", "tool"]
+
+
+@pytest.mark.asyncio
+async def test_pipelined_stream_retry_discards_partial_calls():
+    """尚未启动工具时流中断可以重试，重试前的参数片段被丢弃"""
+    delays = {"search": 0.01}
+    broken = SlowStream(_streamed_tool_calls(list(delays), usage=False)[:1], 0.01, fail=True)
+    complete = SlowStream(_streamed_tool_calls(list(delays)), 0.01)
+    agent = _mcp_agent("test_pipeline_retry", delays, [broken, complete])
+    agent.pipeline_tool_calls = True
+
+    await agent.step()
+
+    session = agent.available_tools.get_tool("search").session
+    assert session.calls == [("remote_search", {"q": "0"})]
+    assert agent.tool_calls[0].function.arguments == '{"q": "0"}'
+
+
+@pytest.mark.asyncio
+async def test_pipelined_stream_is_not_retried_after_dispatch():
+    """工具已经启动后流中断不再重试，避免同一个工具执行两次"""
+    delays = {"search": 0.01}
+    broken = SlowStream(_streamed_tool_calls(list(delays), usage=False), 0.01, fail=True)
+    agent = _mcp_agent("test_pipeline_no_retry", delays, [broken, broken])
+    agent.pipeline_tool_calls = True
+
+    with pytest.raises(httpx.ReadError):
+        await agent.think()
+
+    assert agent.llm.client.chat.completions.create.await_count == 1
+    assert agent._dispatched == {}
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app.config import AdmissionSettings
+from app.exceptions import AdmissionRejected
+from app.utils.admission import AdmissionController, AdmissionMiddleware
+
+
+@pytest.mark.asyncio
+async def test_global_limit_queues_in_arrival_order():
+    controller = AdmissionController(AdmissionSettings(max_concurrent_runs=1))
+    order = []
+
+    async def run(name):
+        async with controller.slot("demo"):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(run(i) for i in range(4)))
+    assert order == [0, 1, 2, 3]
+    stats = controller.stats()
+    assert stats["peak_waiting"] == 3 and stats["running"] == 0 and stats["admitted"] == 4
+
+
+@pytest.mark.asyncio
+async def test_task_limit_does_not_block_other_tasks():
+    controller = AdmissionController(
+        AdmissionSettings(max_concurrent_runs=4, task_limits={"aml_report": 1})
+    )
+    await controller.acquire("aml_report")
+    waiting = asyncio.create_task(controller.acquire("aml_report"))
+    await asyncio.sleep(0)
+    assert controller.stats()["waiting"] == 1
+
+    # 其他任务不受aml_report的额度限制
+    await asyncio.wait_for(controller.acquire("code_analysis"), 0.1)
+    assert controller.stats()["running_by_task"] == {"aml_report": 1, "code_analysis": 1}
+
+    controller.release("aml_report", 1.0)
+    await asyncio.wait_for(waiting, 0.1)
+    assert controller.stats()["running_by_task"]["aml_report"] == 1
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_with_retry_after_from_run_durations():
+    controller = AdmissionController(AdmissionSettings(max_concurrent_runs=1, max_waiting=1))
+    await controller.acquire("demo")
+    controller.release("demo", 20.0)
+    await controller.acquire("demo")
+    waiting = asyncio.create_task(controller.acquire("demo"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("demo")
+    # 前面还有一个排队的请求，需要再等两轮
+    assert exc_info.value.retry_after == 40
+    assert controller.stats()["rejected"] == 1
+
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert controller.stats()["waiting"] == 0
+
+    # 后台任务不受排队上限限制
+    background = asyncio.create_task(controller.acquire("demo", reject=False))
+    await asyncio.sleep(0)
+    controller.release("demo")
+    await asyncio.wait_for(background, 0.1)
+
+
+@pytest.mark.asyncio
+async def test_queue_timeout_rejects_request():
+    controller = AdmissionController(
+        AdmissionSettings(max_concurrent_runs=1, queue_timeout=0.05)
+    )
+    await controller.acquire("demo")
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("demo")
+    stats = controller.stats()
+    assert stats["timeouts"] == 1 and stats["waiting"] == 0 and stats["running"] == 1
+
+
+def test_middleware_returns_429_with_retry_after():
+    controller = AdmissionController(
+        AdmissionSettings(max_concurrent_runs=1, max_waiting=0, default_retry_after=15)
+    )
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, controller=controller, prefixes=("/api/agent/",))
+
+    @app.post("/api/agent/{task_name}")
+    async def agent(task_name: str):
+        return {"task_name": task_name}
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True}
+
+    with TestClient(app) as client:
+        # 占满额度后请求被拒绝，其他路径不受影响
+        controller._admit("demo")
+        response = client.post("/api/agent/demo")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "15"
+        assert client.get("/health").status_code == 200
+
+        controller.release("demo")
+        assert client.post("/api/agent/demo").json() == {"task_name": "demo"}
+        assert controller.stats()["running"] == 0
+
+
+def test_middleware_records_only_successful_run_durations():
+    controller = AdmissionController(AdmissionSettings(max_concurrent_runs=1))
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, controller=controller, prefixes=("/api/agent/",))
+
+    @app.post("/api/agent/{task_name}")
+    async def agent(task_name: str):
+        if task_name == "missing":
+            raise HTTPException(status_code=404, detail="not found")
+        return {"task_name": task_name}
+
+    with TestClient(app) as client:
+        assert client.post("/api/agent/missing").status_code == 404
+        assert controller.stats()["mean_run_duration"] is None
+        assert client.post("/api/agent/demo").status_code == 200
+        assert controller.stats()["mean_run_duration"] is not None
+        assert controller.stats()["running"] == 0
+
+
+@pytest.mark.asyncio
+async def test_limit_to_caps_global_limit_at_pool_capacity():
+    controller = AdmissionController(AdmissionSettings(max_concurrent_runs=8, max_waiting=0))
+    controller.limit_to(4)
+    assert controller.stats()["max_concurrent_runs"] == 4
+    for _ in range(4):
+        await controller.acquire("demo")
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("demo")
+
+    # 不限制时同样受池容量约束，已经更小的上限保持不变
+    unlimited = AdmissionController(AdmissionSettings(max_concurrent_runs=0))
+    unlimited.limit_to(4)
+    assert unlimited.settings.max_concurrent_runs == 4
+    smaller = AdmissionController(AdmissionSettings(max_concurrent_runs=2))
+    smaller.limit_to(4)
+    assert smaller.settings.max_concurrent_runs == 2
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
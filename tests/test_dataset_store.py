@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+from app.config import DatasetSettings
+from app.exceptions import UploadTooLarge
+from app.utils.dataset_store import DatasetStore
+
+
+class FakeUpload:
+    """与UploadFile相同的异步分块读取接口"""
+
+    def __init__(self, data: bytes):
+        self._buffer = io.BytesIO(data)
+        self.reads = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        self.reads += 1
+        return self._buffer.read(size)
+
+
+def _zip_bytes(files) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return buffer.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_ingest_hashes_in_chunks_and_deduplicates(tmp_path):
+    store = DatasetStore(DatasetSettings(chunk_size=4), root=tmp_path)
+    data = b"transactions,amount\n1,100\n"
+
+    upload = FakeUpload(data)
+    first = await store.ingest(upload)
+    assert first.sha256 == hashlib.sha256(data).hexdigest()
+    assert first.path.read_bytes() == data and not first.deduplicated
+    assert upload.reads > len(data) // 4
+
+    second = await store.ingest(FakeUpload(data))
+    assert second.deduplicated and second.path == first.path
+    assert store.stats()["bytes_deduplicated"] == len(data)
+    assert list((tmp_path / "incoming").iterdir()) == []
+
+    # 运行目录中的文件名保持原样
+    destination = tmp_path / "dataset.csv"
+    store.copy_to(first.sha256, str(destination))
+    assert destination.read_bytes() == data
+
+    # 运行原地修改自己的副本不影响存储中的内容
+    with open(destination, "r+b") as f:
+        f.write(b"X")
+    assert first.path.read_bytes() == data
+    assert os.stat(destination).st_ino != os.stat(first.path).st_ino
+
+
+@pytest.mark.asyncio
+async def test_upload_over_limit_is_rejected_and_discarded(tmp_path):
+    store = DatasetStore(DatasetSettings(max_upload_size=10, chunk_size=4), root=tmp_path)
+    with pytest.raises(UploadTooLarge):
+        await store.ingest(FakeUpload(b"x" * 20))
+    with pytest.raises(UploadTooLarge):
+        await store.ingest(FakeUpload(b""), size_hint=20)
+    assert list((tmp_path / "incoming").iterdir()) == []
+    assert not (tmp_path / "blobs").exists()
+
+
+@pytest.mark.asyncio
+async def test_extraction_is_cached_per_hash_and_copied_per_run(tmp_path):
+    store = DatasetStore(root=tmp_path / "store")
+    data = _zip_bytes({"main.py": "print('hi')\n", "requirements.txt": ""})
+
+    first = await store.ingest(FakeUpload(data))
+    run_a = await store.extract_to(first.sha256, str(tmp_path / "run_a"))
+    second = await store.ingest(FakeUpload(data))
+    run_b = await store.extract_to(second.sha256, str(tmp_path / "run_b"))
+    assert store.stats()["extraction_misses"] == 1
+    assert store.stats()["extraction_hits"] == 1
+
+    # 运行修改自己的副本不影响缓存和其他运行
+    with open(os.path.join(run_a, "main.py"), "w") as f:
+        f.write("changed")
+    with open(os.path.join(run_b, "main.py")) as f:
+        assert f.read() == "print('hi')\n"
+    assert (store.extracted_path(first.sha256) / "main.py").read_text() == "print('hi')\n"
+    # 解压结束后不保留该哈希的锁
+    assert len(store._extract_locks) == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_extractions_share_one_lock(tmp_path):
+    store = DatasetStore(root=tmp_path)
+    stored = await store.ingest(FakeUpload(_zip_bytes({"main.py": "print('hi')\n"})))
+
+    targets = await asyncio.gather(*(store.extract(stored.sha256) for _ in range(3)))
+    assert len(set(targets)) == 1
+    assert store.stats()["extraction_misses"] == 1
+    assert len(store._extract_locks) == 0
+
+
+@pytest.mark.asyncio
+async def test_prune_removes_unused_datasets(tmp_path):
+    store = DatasetStore(root=tmp_path)
+    old = await store.ingest(FakeUpload(b"old"))
+    fresh = await store.ingest(FakeUpload(b"fresh"))
+    past = time.time() - 3600
+    os.utime(old.path, (past, past))
+
+    assert store.prune(time.time() - 60) == 1
+    assert not old.path.exists() and fresh.path.exists()
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.config import DownloadSettings
+from app.exceptions import DownloadError
+from app.utils.downloader import DatasetDownloader
+
+
+class DatasetServer(ThreadingHTTPServer):
+    """模拟COS的本地文件服务器，支持HEAD、Range、If-Range和ETag，可以注入中途断开"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), DatasetHandler)
+        self.files = {}
+        self.requests = []
+        self.truncate_next = 0  # 接下来的N个GET只发送一半内容就断开
+        self.allow_head = True
+        self.allow_ranges = True
+        self.after_head = None  # 下一个HEAD之后发布的新版本(path, data, etag)，模拟下载期间文件变化
+
+    def publish(self, path: str, data: bytes, etag: str) -> str:
+        self.files[path] = (data, etag)
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class DatasetHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status: int, length: int, etag: str, extra=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        if self.server.allow_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        for key, value in (extra or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def _error(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", self.path, None))
+        if not self.server.allow_head:
+            return self._error(405)
+        if self.path not in self.server.files:
+            return self._error(404)
+        data, etag = self.server.files[self.path]
+        self._headers(200, len(data), etag)
+        if self.server.after_head:
+            self.server.publish(*self.server.after_head)
+            self.server.after_head = None
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.server.requests.append(("GET", self.path, range_header))
+        if self.path not in self.server.files:
+            return self._error(404)
+        data, etag = self.server.files[self.path]
+        status, body, extra = 200, data, {}
+        if range_header and self.server.allow_ranges and self.headers.get("If-Range") in (None, etag):
+            start, end = range_header.split("=")[1].split("-")
+            start, end = int(start), int(end) if end else len(data) - 1
+            status, body = 206, data[start:end + 1]
+            extra["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        self._headers(status, len(body), etag, extra)
+        if self.server.truncate_next:
+            self.server.truncate_next -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = DatasetServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _downloader(tmp_path, **settings):
+    settings.setdefault("retry_wait", 0.01)
+    return DatasetDownloader(DownloadSettings(**settings), cache_dir=tmp_path / "cache")
+
+
+def _gets(server):
+    return [r for r in server.requests if r[0] == "GET"]
+
+
+@pytest.mark.asyncio
+async def test_large_file_uses_parallel_range_requests(server, tmp_path):
+    data = os.urandom(100_000)
+    url = server.publish("/datasets/aml.zip", data, '"v1"')
+    downloader = _downloader(tmp_path, parallel_threshold=10_000, max_parts=4)
+    try:
+        result = await downloader.download(url, str(tmp_path / "aml.zip"))
+    finally:
+        await downloader.close()
+
+    assert (tmp_path / "aml.zip").read_bytes() == data
+    assert result.parts == 4 and not result.from_cache
+    ranges = sorted(r[2] for r in _gets(server))
+    assert len(ranges) == 4 and all(r.startswith("bytes=") for r in ranges)
+
+
+@pytest.mark.asyncio
+async def test_cache_is_revalidated_with_etag(server, tmp_path):
+    url = server.publish("/datasets/aml.zip", b"version one", '"v1"')
+    downloader = _downloader(tmp_path)
+    try:
+        await downloader.download(url, str(tmp_path / "first.zip"))
+        result = await downloader.download(url, str(tmp_path / "second.zip"))
+        assert result.from_cache and len(_gets(server)) == 1
+        assert (tmp_path / "second.zip").read_bytes() == b"version one"
+
+        # ETag变化后重新下载
+        server.publish("/datasets/aml.zip", b"version two!", '"v2"')
+        result = await downloader.download(url, str(tmp_path / "third.zip"))
+        assert not result.from_cache and len(_gets(server)) == 2
+        assert (tmp_path / "third.zip").read_bytes() == b"version two!"
+        assert (tmp_path / "first.zip").read_bytes() == b"version one"
+    finally:
+        await downloader.close()
+    assert downloader.stats()["cache_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_placed_file_does_not_share_the_cache(server, tmp_path):
+    url = server.publish("/datasets/aml.zip", b"version one", '"v1"')
+    downloader = _downloader(tmp_path)
+    try:
+        await downloader.download(url, str(tmp_path / "first.zip"))
+        # 运行原地修改自己的文件，缓存和之后的运行不受影响
+        with open(tmp_path / "first.zip", "r+b") as f:
+            f.write(b"X")
+        result = await downloader.download(url, str(tmp_path / "second.zip"))
+    finally:
+        await downloader.close()
+    assert result.from_cache
+    assert (tmp_path / "second.zip").read_bytes() == b"version one"
+
+
+@pytest.mark.asyncio
+async def test_file_changed_between_head_and_get_restarts_download(server, tmp_path):
+    data = os.urandom(50_000)
+    url = server.publish("/datasets/aml.zip", b"old version", '"v1"')
+    server.after_head = ("/datasets/aml.zip", data, '"v2"')
+    downloader = _downloader(tmp_path, parallel_threshold=10_000, max_parts=4)
+    try:
+        result = await downloader.download(url, str(tmp_path / "aml.zip"))
+    finally:
+        await downloader.close()
+
+    # If-Range不匹配时服务器返回完整的新版本，下载从HEAD重新开始
+    assert (tmp_path / "aml.zip").read_bytes() == data
+    assert result.parts == 4 and not result.from_cache
+    assert downloader.stats()["restarts"] == 1
+    assert len(downloader._locks) == 0
+
+
+@pytest.mark.asyncio
+async def test_prune_removes_unused_cache_entries(server, tmp_path):
+    old_url = server.publish("/datasets/old.zip", b"old", '"v1"')
+    fresh_url = server.publish("/datasets/fresh.zip", b"fresh", '"v1"')
+    downloader = _downloader(tmp_path)
+    try:
+        await downloader.download(old_url, str(tmp_path / "old.zip"))
+        await downloader.download(fresh_url, str(tmp_path / "fresh.zip"))
+    finally:
+        await downloader.close()
+    past = time.time() - 3600
+    os.utime(downloader._entry_dir(old_url), (past, past))
+
+    assert downloader.prune(time.time() - 60) == 1
+    assert not downloader._entry_dir(old_url).exists()
+    assert downloader._entry_dir(fresh_url).is_dir()
+    assert downloader.stats()["pruned"] == 1
+
+
+@pytest.mark.asyncio
+async def test_interrupted_download_resumes_from_written_bytes(server, tmp_path):
+    data = os.urandom(50_000)
+    url = server.publish("/datasets/big.zip", data, '"v1"')
+    server.truncate_next = 1
+    downloader = _downloader(tmp_path)
+    try:
+        await downloader.download(url, str(tmp_path / "big.zip"))
+    finally:
+        await downloader.close()
+
+    assert (tmp_path / "big.zip").read_bytes() == data
+    first, second = _gets(server)
+    assert first[2] == "bytes=0-49999"
+    assert second[2] == "bytes=25000-49999"
+    assert downloader.stats()["resumed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_server_without_head_or_ranges_downloads_whole_file(server, tmp_path):
+    data = b"x" * 1000
+    url = server.publish("/datasets/plain.zip", data, '"v1"')
+    server.allow_head = False
+    server.allow_ranges = False
+    server.truncate_next = 1
+    downloader = _downloader(tmp_path)
+    try:
+        await downloader.download(url, str(tmp_path / "plain.zip"))
+        # 没有HEAD无法验证缓存，每次都重新下载
+        await downloader.download(url, str(tmp_path / "plain.zip"))
+    finally:
+        await downloader.close()
+    assert (tmp_path / "plain.zip").read_bytes() == data
+    assert [r[2] for r in _gets(server)] == [None, None, None]
+
+
+@pytest.mark.asyncio
+async def test_missing_file_is_not_retried(server, tmp_path):
+    downloader = _downloader(tmp_path)
+    url = server.publish("/datasets/exists.zip", b"data", '"v1"').replace("exists", "missing")
+    try:
+        with pytest.raises(DownloadError) as exc_info:
+            await downloader.download(url, str(tmp_path / "missing.zip"))
+    finally:
+        await downloader.close()
+    assert exc_info.value.status_code == 404
+    assert downloader.stats()["retries"] == 0
+
+    # 不支持HEAD时由GET返回的状态码判断
+    server.allow_head = False
+    downloader = _downloader(tmp_path)
+    try:
+        with pytest.raises(DownloadError):
+            await downloader.download(url, str(tmp_path / "missing.zip"))
+    finally:
+        await downloader.close()
+    assert downloader.stats()["retries"] == 0
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from app.config import JobSettings
+from app.exceptions import JobQueueFull
+from app.utils.jobs import Job, JobQueue
+
+
+def _task(steps: int, gate: asyncio.Event = None):
+    """产生steps个步骤事件和若干增量事件，最后返回结果"""
+
+    async def events():
+        for step in range(1, steps + 1):
+            yield {"step": step, "is_delta": True, "delta": "..."}
+            yield {"step": step, "result": f"step {step}"}
+            if gate is not None and step == 1:
+                await gate.wait()
+        yield {"is_last": True, "is_final_result": True, "final_results": {"answer": 42}}
+
+    return events
+
+
+@pytest.mark.asyncio
+async def test_job_runs_in_background_and_keeps_result():
+    queue = JobQueue(JobSettings(max_workers=1))
+    queue.start()
+    try:
+        job = queue.submit("demo", _task(3))
+        assert job.status == Job.QUEUED
+        events = [event async for _, event in job.events()]
+        assert job.status == Job.SUCCEEDED
+        assert job.result == {"answer": 42}
+        assert events[-1]["is_last"]
+        assert queue.get(job.id) is job
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_resubscribe_replays_after_last_event_id_then_tails():
+    queue = JobQueue(JobSettings(max_workers=1))
+    queue.start()
+    gate = asyncio.Event()
+    try:
+        job = queue.submit("demo", _task(3, gate))
+        # 第一次连接收到第一个步骤后断开
+        async for event_id, event in job.events():
+            if event_id is not None:
+                first_id = event_id
+                break
+        assert first_id == 1
+
+        gate.set()
+        replayed = [(event_id, event) async for event_id, event in job.events(first_id)]
+        ids = [event_id for event_id, _ in replayed if event_id is not None]
+        assert ids == [2, 3, 4]
+        assert replayed[-1][1]["final_results"] == {"answer": 42}
+
+        # 任务结束后仍可重放，增量事件不缓存
+        assert len([e async for e in job.events()]) == 4
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_drops_deltas_and_resumes_from_buffer():
+    """订阅者缓冲已满时丢弃增量事件，步骤事件读完缓冲后从缓存继续，不丢失也不重复"""
+    job = Job("demo", _task(0), queue_size=2)
+    events = job.events()
+    pending = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0)
+
+    # 订阅者没有读取期间发布大量事件
+    for step in range(1, 6):
+        job.publish({"step": step, "is_delta": True, "delta": "..."})
+        job.publish({"step": step, "result": f"step {step}"})
+    job.status = Job.SUCCEEDED
+    job._close()
+
+    received = [await pending] + [item async for item in events]
+    assert [event_id for event_id, _ in received if event_id is not None] == [1, 2, 3, 4, 5]
+    assert job.dropped_deltas > 0
+    assert not job._subscribers and not job._lagging
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_bounds_running_jobs_and_queue():
+    queue = JobQueue(JobSettings(max_workers=2, max_queued=2))
+    queue.start()
+    gate = asyncio.Event()
+    try:
+        jobs = [queue.submit("demo", _task(2, gate)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert queue.stats()["running"] == 2
+
+        jobs += [queue.submit("demo", _task(1)) for _ in range(2)]
+        with pytest.raises(JobQueueFull):
+            queue.submit("demo", _task(1))
+        assert queue.stats()["queued"] == 2 and queue.stats()["rejected"] == 1
+
+        gate.set()
+        for job in jobs:
+            [e async for e in job.events()]
+        assert all(job.status == Job.SUCCEEDED for job in jobs)
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_running_job():
+    queue = JobQueue(JobSettings(max_workers=1))
+    queue.start()
+    job = queue.submit("demo", _task(2, asyncio.Event()))
+    await asyncio.sleep(0.01)
+    await queue.stop()
+    assert job.status == Job.CANCELLED
+    events = [event async for _, event in job.events()]
+    assert events[-1]["is_last"] and events[-1]["error"]
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,516 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import pytest
+from openai import AuthenticationError, BadRequestError, RateLimitError
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from app.config import Config, LLMSettings
+from app.llm import LLM, LLMResponseCache, RateLimiter, RetryPolicy, TokenCounter
+from app.schema import Memory, Message
+
+
+class CountingTokenizer:
+    """按空白切分的假tokenizer，记录被编码的字符总量"""
+
+    def __init__(self):
+        self.encode_calls = 0
+        self.encoded_chars = 0
+
+    def encode(self, text):
+        self.encode_calls += 1
+        self.encoded_chars += len(text)
+        return text.split()
+
+
+def _simulate_agent_run(counter: TokenCounter, steps: int, output_size: int):
+    """模拟MCPAgent运行：每一步追加一次工具调用和一条大工具输出，并对整个历史计数"""
+    memory = Memory(max_messages=1000)
+    memory.add_message(Message.system_message("system prompt"))
+    memory.add_message(Message.user_message("请完成任务"))
+
+    per_step_chars = []
+    for step in range(steps):
+        memory.add_message(Message.assistant_message(f"第{step}步的思考"))
+        memory.add_message(
+            Message.tool_message(
+                content=f"step{step} " + "output " * output_size,
+                name="bash",
+                tool_call_id=f"call_{step}",
+            )
+        )
+
+        before = counter.tokenizer.encoded_chars
+        counter.count_message_tokens(memory.messages)
+        per_step_chars.append(counter.tokenizer.encoded_chars - before)
+
+    return per_step_chars
+
+
+def test_message_token_count_matches_uncached():
+    """缓存结果与逐条编码结果一致，dict与Message的计数相同"""
+    counter = TokenCounter(CountingTokenizer())
+    messages = [
+        Message.system_message("you are helpful"),
+        Message.user_message("hello world"),
+        Message(
+            role="assistant",
+            content="",
+            tool_calls=[{"id": "1", "function": {"name": "bash", "arguments": '{"a": 1}'}}],
+        ),
+        Message.tool_message("ok", name="bash", tool_call_id="1"),
+    ]
+
+    expected = counter.FORMAT_TOKENS + sum(
+        counter._encode_message_tokens(m.to_dict()) for m in messages
+    )
+
+    assert counter.count_message_tokens([m.to_dict() for m in messages]) == expected
+    assert counter.count_message_tokens(messages) == expected
+    # 第二次计数全部命中缓存
+    assert counter.count_message_tokens(messages) == expected
+    assert counter.cache_hits == len(messages)
+
+
+def test_modified_message_is_recounted():
+    """消息字段被赋值后不能使用旧的缓存结果"""
+    counter = TokenCounter(CountingTokenizer())
+    message = Message.system_message("a b c")
+    first = counter.count_message_tokens([message])
+
+    message.content = "a b c d e"
+    second = counter.count_message_tokens([message])
+
+    assert second == first + 2
+    assert counter.cache_misses == 2
+
+
+def test_image_tokens_follow_supports_images():
+    """与format_messages一致：支持图像时计入base64图像，否则忽略"""
+    counter = TokenCounter(CountingTokenizer())
+    message = Message.user_message("look", base64_image="aGVsbG8=")
+    without = counter.count_message_tokens([message], supports_images=False)
+    with_image = counter.count_message_tokens([message], supports_images=True)
+
+    assert with_image - without == counter.count_image({"image_url": {"url": "aGVsbG8="}})
+    assert without == counter.count_message_tokens(
+        LLM.format_messages([message], supports_images=False), supports_images=False
+    )
+    assert with_image == counter.count_message_tokens(
+        LLM.format_messages([message], supports_images=True)
+    )
+
+
+def test_benchmark_per_step_counting_cost_is_flat():
+    """基准测试：40步运行中每一步的编码量保持恒定，而非随历史线性增长"""
+    counter = TokenCounter(CountingTokenizer())
+    per_step_chars = _simulate_agent_run(counter, steps=40, output_size=2000)
+
+    # 第一步需要编码初始的system/user消息，之后每一步只编码新增的两条消息
+    steady = per_step_chars[1:]
+    assert max(steady) - min(steady) <= 16
+    assert per_step_chars[-1] < per_step_chars[0] * 2
+
+
+def _make_llm(config_name: str, **settings) -> LLM:
+    """创建不依赖网络下载tokenizer的LLM实例"""
+    llm_settings = LLMSettings(
+        model="test-model", base_url="http://127.0.0.1:1/v1", api_key="sk-test", **settings
+    )
+    LLM._instances.pop(config_name, None)
+    with mock.patch("app.llm.tiktoken.encoding_for_model", return_value=CountingTokenizer()):
+        return LLM(config_name=config_name, llm_config={"default": llm_settings})
+
+
+def _tool_call_message() -> ChatCompletionMessage:
+    return ChatCompletionMessage.model_validate(
+        {
+            "role": "assistant",
+            "content": "调用工具",
+            "tool_calls": [
+                {
+                    "id": "call_1",
+                    "type": "function",
+                    "function": {"name": "bash", "arguments": '{"command": "ls"}'},
+                }
+            ],
+        }
+    )
+
+
+def test_response_cache_lru_eviction(tmp_path):
+    """超过容量时淘汰最久未使用的条目"""
+    cache = LLMResponseCache(tmp_path, max_bytes=150)
+    value = {"content": "x" * 50}
+    cache.put("a", value)
+    cache.put("b", value)
+    assert cache.get("a") == value  # a变为最近使用
+    cache.put("c", value)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == value
+    assert cache.get("c") == value
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_response_cache_survives_restart(tmp_path):
+    """缓存条目在新的缓存实例中依然可用"""
+    LLMResponseCache(tmp_path, max_bytes=10_000).put("k", {"content": "v"})
+
+    assert LLMResponseCache(tmp_path, max_bytes=10_000).get("k") == {"content": "v"}
+
+
+@pytest.mark.asyncio
+async def test_ask_tool_replays_cached_tool_calls(tmp_path):
+    """缓存命中时跳过API调用，并精确还原ChatCompletionMessage"""
+    llm = _make_llm("test_cache", cache_enabled=True, cache_dir=str(tmp_path))
+    message = _tool_call_message()
+    response = SimpleNamespace(
+        choices=[SimpleNamespace(message=message)],
+        usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5),
+    )
+    create = mock.AsyncMock(return_value=response)
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    tools = [{"type": "function", "function": {"name": "bash", "parameters": {}}}]
+    messages = [Message.user_message("列出文件")]
+
+    first, first_usage = await llm.ask_tool(messages=messages, tools=tools)
+    second, second_usage = await llm.ask_tool(messages=messages, tools=tools)
+
+    assert create.await_count == 1
+    assert second == first
+    assert second.tool_calls[0].function.arguments == '{"command": "ls"}'
+    assert second_usage == first_usage
+    assert llm.cache_stats()["hits"] == 1
+
+    # 不同的温度视为不同的请求
+    await llm.ask_tool(messages=messages, tools=tools, temperature=0.5)
+    assert create.await_count == 2
+
+
+def _chunk(content=None, tool_calls=None, usage=None):
+    """构造流式响应的单个chunk"""
+    choices = []
+    if content is not None or tool_calls is not None:
+        choices.append(
+            {"index": 0, "delta": {"content": content, "tool_calls": tool_calls}}
+        )
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "chunk",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "test-model",
+            "choices": choices,
+            "usage": usage,
+        }
+    )
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+@pytest.mark.asyncio
+async def test_ask_tool_stream_assembles_tool_call_deltas():
+    """流式模式下增量组装工具调用，并转发内容和参数增量"""
+    llm = _make_llm("test_stream")
+    chunks = [
+        _chunk(content="我来"),
+        _chunk(content="看看"),
+        _chunk(
+            tool_calls=[
+                {"index": 0, "id": "call_1", "type": "function",
+                 "function": {"name": "bash", "arguments": '{"comm'}}
+            ]
+        ),
+        _chunk(tool_calls=[{"index": 0, "function": {"arguments": 'and": "ls"}'}}]),
+        _chunk(
+            tool_calls=[
+                {"index": 1, "id": "call_2", "type": "function",
+                 "function": {"name": "terminate", "arguments": "{}"}}
+            ]
+        ),
+        _chunk(usage={"prompt_tokens": 12, "completion_tokens": 7, "total_tokens": 19}),
+    ]
+    create = mock.AsyncMock(return_value=FakeStream(chunks))
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    stream = llm.ask_tool_stream(messages=[Message.user_message("列出文件")])
+    events = [event async for event in stream]
+    message, usage = await stream.result()
+
+    assert create.await_args.kwargs["stream"] is True
+    assert [e["text"] for e in events if e["type"] == "content"] == ["我来", "看看"]
+    assert "".join(e["arguments"] for e in events if e.get("index") == 0) == '{"command": "ls"}'
+    assert message.content == "我来看看"
+    assert [(c.id, c.function.name, c.function.arguments) for c in message.tool_calls] == [
+        ("call_1", "bash", '{"command": "ls"}'),
+        ("call_2", "terminate", "{}"),
+    ]
+    assert (usage.input_tokens, usage.output_tokens) == (12, 7)
+
+
+class BrokenStream(FakeStream):
+    """发送部分chunk后连接中断的流"""
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise httpx.ReadError("connection dropped")
+
+
+@pytest.mark.asyncio
+async def test_stream_retry_after_partial_output_emits_reset():
+    """流式请求中途失败后重试，消费方先收到reset事件再收到完整的新增量"""
+    llm = _make_llm("test_stream_reset", retry_min_wait=0, retry_max_wait=0)
+    create = mock.AsyncMock(
+        side_effect=[
+            BrokenStream([_chunk(content="半截")]),
+            FakeStream([_chunk(content="完整"), _chunk(content="回答")]),
+        ]
+    )
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    stream = llm.ask_tool_stream(messages=[Message.user_message("你好")])
+    events = [event async for event in stream]
+    message, _ = await stream.result()
+
+    assert [e.get("text", e["type"]) for e in events] == ["半截", "reset", "完整", "回答"]
+    assert message.content == "完整回答"
+
+
+@pytest.mark.asyncio
+async def test_stream_options_dropped_after_bad_request():
+    """端点以400拒绝stream_options时不带该参数重试，之后的请求也不再发送"""
+    llm = _make_llm("test_stream_options")
+    create = mock.AsyncMock(
+        side_effect=[
+            _status_error(BadRequestError, 400),
+            FakeStream([_chunk(content="ok")]),
+            FakeStream([_chunk(content="ok")]),
+        ]
+    )
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    for _ in range(2):
+        message, usage = await llm.ask_tool(messages=[Message.user_message("你好")], stream=True)
+        assert message.content == "ok" and usage.output_tokens > 0
+
+    sent = [call.kwargs.get("stream_options") for call in create.await_args_list]
+    assert sent == [{"include_usage": True}, None, None]
+    assert llm.stream_usage is False
+
+    quiet = _make_llm("test_stream_options_off", stream_usage=False)
+    create = mock.AsyncMock(return_value=FakeStream([_chunk(content="ok")]))
+    quiet.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    await quiet.ask_tool(messages=[Message.user_message("你好")], stream=True)
+    assert "stream_options" not in create.await_args.kwargs
+
+
+def test_stream_usage_is_read_from_config_file(tmp_path):
+    """基础[llm]表中的stream_usage对默认配置和覆盖配置都生效"""
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(
+        '[llm]\nmodel = "m"\nbase_url = "http://127.0.0.1:1/v1"\napi_key = "k"\n'
+        "stream_usage = false\n\n[llm.vision]\nmodel = \"v\"\n",
+        encoding="utf-8",
+    )
+    # 不经过单例，避免影响全局配置
+    loaded = object.__new__(Config)
+    with mock.patch.object(Config, "_get_config_path", return_value=config_path):
+        loaded._load_initial_config()
+
+    assert loaded.llm["default"].stream_usage is False
+    assert loaded.llm["vision"].stream_usage is False
+
+
+def test_llm_instances_share_http_client_per_base_url():
+    """相同base_url的LLM实例共用一个连接池，不同base_url使用各自的连接池"""
+    first = _make_llm("test_pool_a", http_max_connections=7)
+    second = _make_llm("test_pool_b", http_max_connections=7)
+    LLM._instances.pop("test_pool_c", None)
+    other_settings = LLMSettings(
+        model="test-model", base_url="http://127.0.0.2:1/v1", api_key="sk-other",
+        http_max_connections=7,
+    )
+    with mock.patch("app.llm.tiktoken.encoding_for_model", return_value=CountingTokenizer()):
+        other = LLM(config_name="test_pool_c", llm_config={"default": other_settings})
+
+    assert first.http_client is second.http_client
+    assert first.client is not second.client
+    assert other.http_client is not first.http_client
+    assert first.client._client is first.http_client
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_queues_requests_over_rpm():
+    """超过RPM预算的请求排队等待，而不是同时发出"""
+    limiter = RateLimiter(rpm_limit=600)  # 每0.1秒补充一个请求
+    limiter._available_requests = 2
+
+    start = time.monotonic()
+    await asyncio.gather(*(limiter.acquire(0) for _ in range(4)))
+    elapsed = time.monotonic() - start
+
+    assert elapsed >= 0.15
+    stats = limiter.utilization()
+    assert stats["total_requests"] == 4
+    assert stats["waiting"] == 0
+    assert stats["avg_wait_seconds"] > 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_settles_reserved_tokens():
+    """按估计值预留token，完成后按实际用量修正"""
+    limiter = RateLimiter(tpm_limit=1000)
+
+    reserved = await limiter.acquire(5000)
+    assert reserved == 1000  # 超过上限的请求按上限预留
+    limiter.settle(reserved, 200)
+
+    assert limiter.utilization()["tpm_utilization"] == pytest.approx(0.2, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_completions_go_through_rate_limiter():
+    """补全请求经过限速器，并在指标中体现"""
+    llm = _make_llm("test_rate_limit", rpm_limit=60, tpm_limit=10_000)
+    response = SimpleNamespace(
+        choices=[SimpleNamespace(message=_tool_call_message())],
+        usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15),
+    )
+    create = mock.AsyncMock(return_value=response)
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    await llm.ask_tool(messages=[Message.user_message("列出文件")])
+
+    stats = LLM.metrics()["test_rate_limit"]["rate_limit"]
+    assert stats["total_requests"] == 1
+    assert stats["tpm_utilization"] == pytest.approx(15 / 10_000, abs=1e-3)
+
+
+def _status_error(error_cls, status_code: int, headers=None):
+    """构造带响应头的OpenAI状态码错误"""
+    request = httpx.Request("POST", "http://127.0.0.1:1/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return error_cls("error", response=response, body=None)
+
+
+def _tool_response():
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=_tool_call_message())],
+        usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15),
+    )
+
+
+def test_retry_policy_classifies_errors():
+    """只有暂时性错误可以重试"""
+    assert RetryPolicy.is_retryable(_status_error(RateLimitError, 429))
+    assert not RetryPolicy.is_retryable(_status_error(AuthenticationError, 401))
+    assert not RetryPolicy.is_retryable(ValueError("无效的角色"))
+    assert RetryPolicy.retry_after(_status_error(RateLimitError, 429, {"retry-after": "3"})) == 3
+    assert RetryPolicy.retry_after(
+        _status_error(RateLimitError, 429, {"retry-after-ms": "250"})
+    ) == 0.25
+
+
+@pytest.mark.asyncio
+async def test_fatal_errors_are_not_retried():
+    """认证失败等致命错误不重试，直接抛出原始异常"""
+    llm = _make_llm("test_retry_fatal")
+    create = mock.AsyncMock(side_effect=_status_error(AuthenticationError, 401))
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    with pytest.raises(AuthenticationError):
+        await llm.ask_tool(messages=[Message.user_message("列出文件")])
+
+    assert create.await_count == 1
+    assert llm.retry_policy.stats()["fatal_errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_after_is_honored():
+    """429时按Retry-After等待后重试"""
+    llm = _make_llm("test_retry_after", retry_min_wait=5)
+    create = mock.AsyncMock(
+        side_effect=[
+            _status_error(RateLimitError, 429, {"retry-after-ms": "50"}),
+            _tool_response(),
+        ]
+    )
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    start = time.monotonic()
+    message, _ = await llm.ask_tool(messages=[Message.user_message("列出文件")])
+    elapsed = time.monotonic() - start
+
+    assert message.tool_calls[0].function.name == "bash"
+    # 使用服务端提示的50ms，而不是5秒的退避下限
+    assert 0.05 <= elapsed < 1
+    stats = llm.retry_policy.stats()
+    assert stats["retries"] == 1
+    assert stats["retries_by_reason"] == {"RateLimitError": 1}
+
+
+@pytest.mark.asyncio
+async def test_retries_stop_at_deadline():
+    """下一次等待会超出总时限时不再重试"""
+    llm = _make_llm("test_retry_deadline", retry_deadline=0.5)
+    create = mock.AsyncMock(
+        side_effect=_status_error(RateLimitError, 429, {"retry-after": "1"})
+    )
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    with pytest.raises(RateLimitError):
+        await llm.ask_tool(messages=[Message.user_message("列出文件")])
+
+    assert create.await_count == 1
+    assert llm.retry_policy.stats()["exhausted"] == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_request_is_hedged():
+    """耗时超过p95延迟的请求发出对冲请求，并采用先返回的结果"""
+    llm = _make_llm("test_hedge", hedge_enabled=True, hedge_min_samples=5)
+    for _ in range(5):
+        llm.retry_policy.record_latency(0.02)
+
+    calls = 0
+
+    async def create(**params):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(5)
+        return _tool_response()
+
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    start = time.monotonic()
+    await llm.ask_tool(messages=[Message.user_message("列出文件")])
+
+    assert time.monotonic() - start < 1
+    stats = llm.retry_policy.stats()
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", "-s", __file__])
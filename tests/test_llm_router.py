@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+
+from app.config import LLMEndpoint, LLMSettings
+from app.llm import LLM
+from app.schema import Message
+
+
+class MockOpenAIServer:
+    """在本地线程中运行的OpenAI兼容服务，可配置延迟和返回的状态码"""
+
+    def __init__(self, name: str, delay: float = 0.0, status: int = 200):
+        self.name = name
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server.requests += 1
+                time.sleep(server.delay)
+                if server.status == 200:
+                    body = {
+                        "id": "chatcmpl-1",
+                        "object": "chat.completion",
+                        "created": 0,
+                        "model": "test-model",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "finish_reason": "stop",
+                                "message": {"role": "assistant", "content": server.name},
+                            }
+                        ],
+                        "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+                    }
+                else:
+                    body = {"error": {"message": "unavailable", "type": "server_error"}}
+                payload = json.dumps(body).encode()
+                self.send_response(server.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/v1"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(*args, **kwargs):
+        server = MockOpenAIServer(*args, **kwargs)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.close()
+
+
+def _make_router_llm(config_name: str, endpoints, **settings) -> LLM:
+    """创建在多个本地端点间路由的LLM实例"""
+    llm_settings = LLMSettings(
+        model="test-model",
+        base_url=endpoints[0].base_url,
+        api_key="sk-test",
+        endpoints=[LLMEndpoint(base_url=e.base_url, api_key="sk-test") for e in endpoints],
+        **settings,
+    )
+    LLM._instances.pop(config_name, None)
+    with mock.patch("app.llm.tiktoken.get_encoding") as get_encoding, mock.patch(
+        "app.llm.tiktoken.encoding_for_model", side_effect=KeyError
+    ):
+        get_encoding.return_value.encode = lambda text: text.split()
+        return LLM(config_name=config_name, llm_config={"default": llm_settings})
+
+
+@pytest.mark.asyncio
+async def test_failover_within_single_call(servers):
+    """端点返回5xx时在同一次调用中转移到其他端点，无需等待重试"""
+    broken = servers("broken", status=503)
+    healthy = servers("healthy")
+    llm = _make_router_llm(
+        "test_router_failover", [broken, healthy], retry_max_attempts=1
+    )
+
+    # 固定首选第一个端点，使故障端点在被移出前每次都先被尝试
+    first_choice = mock.patch(
+        "app.llm.random.choices", side_effect=lambda population, weights: population[:1]
+    )
+    with first_choice:
+        for _ in range(6):
+            assert await llm.ask([Message.user_message("hi")], stream=False) == "healthy"
+
+    stats = {e["base_url"]: e for e in llm.router.stats()}
+    assert llm.retry_policy.stats()["retries"] == 0
+    # 连续失败3次后被移出路由，不再收到请求
+    assert broken.requests == 3
+    assert stats[broken.base_url]["healthy"] is False
+    assert stats[healthy.base_url]["requests"] == 6
+
+
+@pytest.mark.asyncio
+async def test_router_prefers_low_latency_endpoint(servers):
+    """按延迟EWMA分配请求，较快的端点承担大部分流量"""
+    slow = servers("slow", delay=0.3)
+    fast = servers("fast", delay=0.0)
+    llm = _make_router_llm("test_router_latency", [slow, fast])
+
+    answers = [await llm.ask([Message.user_message("hi")], stream=False) for _ in range(20)]
+
+    # 在尚无延迟样本的前几次请求之后，慢端点只会偶尔被探测
+    assert answers.count("fast") >= 13
+    assert llm.router.endpoints[1].latency < 0.3
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
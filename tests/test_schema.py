@@ -0,0 +1,82 @@
+import pytest
+
+from app.schema import ELIDED_TOOL_OUTPUT_PREFIX, Function, Memory, Message, ToolCall
+
+
+def count_tokens(messages):
+    """按空白切分估算token数"""
+    return sum(len(str(m.content or "").split()) + 4 for m in messages)
+
+
+def _tool_turn(call_id: str, output_size: int):
+    """一次工具调用及其输出"""
+    call = ToolCall(id=call_id, function=Function(name="bash", arguments="{}"))
+    return [
+        Message.from_tool_calls(content="", tool_calls=[call]),
+        Message.tool_message("out " * output_size, name="bash", tool_call_id=call_id),
+    ]
+
+
+def _memory(steps: int, output_size: int = 500) -> Memory:
+    memory = Memory()
+    memory.add_message(Message.system_message("system prompt"))
+    memory.add_message(Message.user_message("原始任务"))
+    for step in range(steps):
+        memory.add_messages(_tool_turn(f"call_{step}", output_size))
+    return memory
+
+
+def test_compact_is_noop_under_budget():
+    memory = _memory(steps=2)
+    before = memory.to_dict_list()
+
+    assert memory.compact(count_tokens, max_tokens=100_000) == 0
+    assert memory.to_dict_list() == before
+
+
+def test_compact_elides_old_tool_outputs_first():
+    """先省略较早的工具输出，保留system、任务和最近的消息"""
+    memory = _memory(steps=10)
+    before = count_tokens(memory.messages)
+
+    saved = memory.compact(count_tokens, max_tokens=2000, keep_recent=2)
+
+    assert saved > 0
+    assert count_tokens(memory.messages) == before - saved <= 2000
+    assert len(memory.messages) == 22  # 没有消息被删除
+    assert memory.messages[0].content == "system prompt"
+    assert memory.messages[1].content == "原始任务"
+    assert memory.messages[2].tool_calls  # 工具调用结构保持不变
+    assert memory.messages[3].content.startswith(ELIDED_TOOL_OUTPUT_PREFIX)
+    assert not memory.messages[-1].content.startswith(ELIDED_TOOL_OUTPUT_PREFIX)
+
+
+def test_compact_drops_whole_tool_call_pairs():
+    """省略后仍超出预算时成对删除最早的工具调用和结果"""
+    memory = _memory(steps=10, output_size=20)
+
+    memory.compact(count_tokens, max_tokens=120, keep_recent=2)
+
+    call_ids = {c.id for m in memory.messages for c in (m.tool_calls or [])}
+    result_ids = {m.tool_call_id for m in memory.messages if m.role == "tool"}
+    assert call_ids == result_ids
+    assert "call_0" not in call_ids and "call_9" in call_ids
+    assert [m.content for m in memory.messages[:2]] == ["system prompt", "原始任务"]
+
+
+def test_compact_keeps_unresolved_tool_calls():
+    """尚未返回结果的工具调用不会被删除"""
+    memory = _memory(steps=3, output_size=20)
+    pending = ToolCall(id="pending", function=Function(name="bash", arguments="{}"))
+    memory.messages.insert(2, Message.from_tool_calls(content="", tool_calls=[pending]))
+
+    memory.compact(count_tokens, max_tokens=10, keep_recent=0)
+
+    assert any(
+        c.id == "pending" for m in memory.messages for c in (m.tool_calls or [])
+    )
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,57 @@
+import os
+import time
+
+import pytest
+
+from app.config import WorkspaceSettings
+from app.utils.workspace import RunWorkspace, WorkspaceJanitor
+
+
+def test_concurrent_runs_get_separate_directories(tmp_path):
+    first = RunWorkspace.create("code_analysis", runs_root=tmp_path)
+    second = RunWorkspace.create("code_analysis", runs_root=tmp_path)
+    assert first.root != second.root
+    assert first.temp_dir.is_dir() and second.temp_dir.is_dir()
+
+    # 同名输出文件互不覆盖
+    with open(first.path("temp", "function.json"), "w") as f:
+        f.write("first")
+    with open(second.path("temp", "function.json"), "w") as f:
+        f.write("second")
+    first.release()
+    assert not first.root.exists()
+    with open(second.path("temp", "function.json")) as f:
+        assert f.read() == "second"
+    second.release()
+
+
+def test_release_keep_leaves_directory_for_janitor(tmp_path):
+    run = RunWorkspace.create("aml_report", runs_root=tmp_path)
+    run.release(keep=True)
+    assert run.root.is_dir()
+
+
+@pytest.mark.asyncio
+async def test_janitor_removes_only_expired_inactive_runs(tmp_path):
+    settings = WorkspaceSettings(run_ttl=60, janitor_interval=0)
+    expired = RunWorkspace.create("expired", runs_root=tmp_path)
+    expired.release(keep=True)
+    active = RunWorkspace.create("active", runs_root=tmp_path)
+    fresh = RunWorkspace.create("fresh", runs_root=tmp_path)
+    fresh.release(keep=True)
+
+    old = time.time() - 120
+    for run in (expired, active):
+        os.utime(run.root, (old, old))
+
+    janitor = WorkspaceJanitor(settings, runs_root=tmp_path)
+    assert await janitor.sweep() == 1
+    assert not expired.root.exists()
+    assert active.root.is_dir() and fresh.root.is_dir()
+    assert janitor.stats()["removed"] == 1
+    active.release()
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
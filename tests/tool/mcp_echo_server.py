@@ -0,0 +1,44 @@
+"""测试用的最小MCP服务器，通过stdio运行"""
+import asyncio
+import os
+
+from mcp.server.fastmcp import Context, FastMCP
+
+server = FastMCP("echo")
+
+
+@server.tool()
+def echo(text: str) -> str:
+    """原样返回输入文本"""
+    return text
+
+
+@server.tool()
+def pid() -> str:
+    """返回服务器进程ID"""
+    return str(os.getpid())
+
+
+@server.tool()
+async def add_tool(name: str, ctx: Context) -> str:
+    """注册一个新工具并发送tools/list_changed通知"""
+    server.add_tool(lambda: name, name=name, description=f"dynamic {name}")
+    await ctx.session.send_tool_list_changed()
+    return "added"
+
+
+@server.tool()
+async def sleep(seconds: float) -> str:
+    """等待指定秒数后返回"""
+    await asyncio.sleep(seconds)
+    return "done"
+
+
+@server.tool()
+def crash() -> str:
+    """立即退出服务器进程"""
+    os._exit(1)
+
+
+if __name__ == "__main__":
+    server.run(transport="stdio")
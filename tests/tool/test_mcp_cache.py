@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+from mcp.types import Tool
+
+from app.tool.mcp import MCPClients
+from app.tool.mcp_cache import LazySession, ToolSchemaCache, server_version
+from app.tool.mcp_pool import MCPSessionPool, server_key
+
+ECHO_SERVER = [str(Path(__file__).with_name("mcp_echo_server.py"))]
+ECHO_KEY = server_key("stdio", command=sys.executable, args=ECHO_SERVER)
+
+
+@pytest_asyncio.fixture
+async def pool():
+    pool = MCPSessionPool.shared()
+    yield pool
+    await pool.close()
+
+
+def _clients(tmp_path) -> MCPClients:
+    return MCPClients(
+        use_session_pool=True,
+        pool_stdio=True,
+        lazy_connect=True,
+        schema_cache=ToolSchemaCache(tmp_path),
+    )
+
+
+@pytest.mark.asyncio
+async def test_cached_server_connects_on_first_tool_call(pool, tmp_path):
+    """缓存命中时不进行握手，首次调用工具时才连接"""
+    first = _clients(tmp_path)
+    await first.connect_stdio(sys.executable, ECHO_SERVER, server_id="warm")
+    await first.disconnect("warm")
+    assert pool.stats()["misses"] == 1
+    await pool.close()
+
+    clients = _clients(tmp_path)
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id="lazy")
+
+    session = clients.sessions["lazy"]
+    assert isinstance(session, LazySession) and not session.connected
+    assert {"lazy_echo", "lazy_pid", "lazy_crash"} <= set(clients.tool_map)
+    assert pool.stats()["servers"] == 0  # 尚未启动服务器进程
+
+    result = await clients.execute(name="lazy_echo", tool_input={"text": "hi"})
+    assert result.output == "hi"
+    assert session.connected and pool.stats()["servers"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_cache_is_refreshed_after_connect(pool, tmp_path):
+    cache = ToolSchemaCache(tmp_path)
+    cache.store(ECHO_KEY, [Tool(name="echo", description="old", inputSchema={"type": "object"})])
+
+    clients = MCPClients(
+        use_session_pool=True, pool_stdio=True, lazy_connect=True, schema_cache=cache
+    )
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id="srv")
+    assert set(clients.tool_map) == {"srv_echo"}
+
+    await clients.execute(name="srv_echo", tool_input={"text": "hi"})
+    await clients.sessions["srv"]._refresh_task
+
+    assert {t.name for t in cache.load(ECHO_KEY)} == {"echo", "pid", "add_tool", "sleep", "crash"}
+    live = await clients.sessions["srv"].list_tools()
+    assert len(live.tools) == 5
+
+
+def test_cache_key_changes_with_server_code(tmp_path):
+    script = tmp_path / "server.py"
+    script.write_text("# v1\n")
+    key = server_key("stdio", command=sys.executable, args=[str(script)])
+    before = server_version(key)
+
+    script.write_text("# version 2\n")
+
+    assert server_version(key) != before
+
+
+def test_stdio_version_is_reused_within_ttl(tmp_path):
+    """ttl内不重新扫描代码目录"""
+    script = tmp_path / "server.py"
+    script.write_text("# v1\n")
+    key = server_key("stdio", command=sys.executable, args=[str(script)])
+    first = server_version(key, ttl=60)
+
+    script.write_text("# version 2\n")
+
+    assert server_version(key, ttl=60) == first
+    assert server_version(key) != first
+
+
+def test_unversioned_server_cache_expires(tmp_path):
+    """sse服务器无法从本地判断版本，缓存按max_age过期，实时列表一致时重新计时"""
+    cache = ToolSchemaCache(tmp_path, max_age=60)
+    key = server_key("sse", server_url="http://example/sse")
+    tools = [Tool(name="search", inputSchema={"type": "object"})]
+    assert cache.store(key, tools)
+    assert [t.name for t in cache.load(key)] == ["search"]
+
+    path = next(tmp_path.glob("*.json"))
+    past = time.time() - 120
+    os.utime(path, (past, past))
+    assert cache.load(key) is None
+    assert cache.stats()["expired"] == 1
+
+    # 连接后实时工具列表未变化，不重写内容但重新开始计算有效期
+    assert not cache.store(key, tools)
+    assert cache.load(key) is not None
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
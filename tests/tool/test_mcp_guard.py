@@ -0,0 +1,122 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app.exceptions import MCPServerUnavailable
+from app.tool.mcp import MCPClients
+from app.tool.mcp_guard import CircuitBreaker, MCPCallGuards, ServerGuard, resolve_timeout
+from app.tool.mcp_lifecycle import MCPLifecycleManager
+
+ECHO_SERVER = [str(Path(__file__).with_name("mcp_echo_server.py"))]
+
+
+async def _fail():
+    raise ConnectionError("down")
+
+
+async def _ok():
+    return "ok"
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_recovers_after_probe():
+    guard = ServerGuard(("sse", "http://x"), failure_threshold=2, reset_timeout=0.1)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await guard.call(_fail, timeout=1)
+    assert guard.breaker.state == CircuitBreaker.OPEN
+
+    # 熔断期间直接失败，不调用服务器
+    called = []
+    with pytest.raises(MCPServerUnavailable):
+        await guard.call(lambda: called.append(1), timeout=1)
+    assert not called and guard.rejected == 1
+
+    await asyncio.sleep(0.15)
+    assert guard.breaker.state == CircuitBreaker.HALF_OPEN
+    assert await guard.call(_ok, timeout=1) == "ok"
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+    assert guard.stats()["breaker_opens"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_probe_reopens_breaker():
+    guard = ServerGuard(("sse", "http://x"), failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(ConnectionError):
+        await guard.call(_fail, timeout=1)
+    await asyncio.sleep(0.1)
+
+    with pytest.raises(ConnectionError):
+        await guard.call(_fail, timeout=1)
+    assert guard.breaker.state == CircuitBreaker.OPEN
+    assert guard.breaker.opens == 2
+
+
+@pytest.mark.asyncio
+async def test_bulkhead_limits_concurrency_per_server():
+    guard = ServerGuard(("sse", "http://x"), max_concurrency=2)
+    active, peak = 0, 0
+
+    async def work():
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.05)
+        active -= 1
+
+    await asyncio.gather(*(guard.call(work, timeout=5) for _ in range(6)))
+    assert peak == 2
+
+    # 额度被占满且超时前没有释放时直接失败，不计为服务器故障
+    blocker = asyncio.Event()
+    held = [asyncio.create_task(guard.call(blocker.wait, timeout=5)) for _ in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(MCPServerUnavailable):
+        await guard.call(_ok, timeout=0.05)
+    blocker.set()
+    await asyncio.gather(*held)
+    assert guard.breaker.consecutive_failures == 0
+
+
+def test_resolve_timeout_precedence():
+    settings = SimpleNamespace(
+        call_timeout=120.0,
+        server_timeouts={"remote": 300.0, "http://x/sse": 60.0},
+        tool_timeouts={"bash": 600.0, "remote_slow": 900.0},
+    )
+    assert resolve_timeout("remote", "slow", settings=settings) == 900.0
+    assert resolve_timeout("remote", "bash", settings=settings) == 600.0
+    assert resolve_timeout("remote", "echo", settings=settings) == 300.0
+    assert resolve_timeout("sse_1", "echo", "http://x/sse", settings=settings) == 60.0
+    assert resolve_timeout("local", "echo", settings=settings) == 120.0
+
+
+@pytest.mark.asyncio
+async def test_hung_tool_times_out_and_trips_breaker():
+    """挂起的服务器在超时后返回错误，连续超时后其他调用快速失败并提示服务器不可用"""
+    clients = MCPClients(use_session_pool=False, lazy_connect=False)
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id="srv")
+    guard = clients.guards["srv"]
+    guard.breaker.failure_threshold = 2
+    clients.tool_map["srv_sleep"].timeout = 0.2
+
+    try:
+        for _ in range(2):
+            result = await clients.execute(name="srv_sleep", tool_input={"seconds": 5})
+            assert "超时" in result.error
+
+        result = await clients.execute(name="srv_echo", tool_input={"text": "hi"})
+        assert "暂时不可用" in result.error
+        assert MCPCallGuards.shared().stats()["open_breakers"] == 1
+        assert guard.stats()["timeouts"] == 2
+    finally:
+        await clients.disconnect()
+        await MCPLifecycleManager.shared().shutdown()
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
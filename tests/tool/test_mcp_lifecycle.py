@@ -0,0 +1,94 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+from app.tool.mcp import MCPClients
+from app.tool.mcp_lifecycle import MCPLifecycleManager
+from app.tool.mcp_pool import MCPSessionPool, NotifyingClientSession, server_key
+
+ECHO_SERVER = [str(Path(__file__).with_name("mcp_echo_server.py"))]
+# 忽略SIGTERM且不读取stdin的进程，只能被kill结束
+STUBBORN_SERVER = [
+    "-c",
+    "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(60)",
+]
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest_asyncio.fixture
+async def lifecycle():
+    manager = MCPLifecycleManager.shared()
+    manager.shutdown_timeout = 1.0
+    yield manager
+    await MCPSessionPool.shared().close()
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_disconnect_reaps_server_process(lifecycle):
+    """断开独占连接时等待服务器进程退出并回收，计数回到零"""
+    clients = MCPClients(use_session_pool=False, lazy_connect=False)
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id="srv")
+    pid = int((await clients.execute(name="srv_pid", tool_input={})).output)
+
+    report = lifecycle.leak_report()
+    assert report["sessions"]["live"] == 1
+    assert [p["pid"] for p in report["live_processes"]] == [pid]
+
+    # 在另一个任务中断开，连接仍在持有它的任务中关闭
+    await asyncio.create_task(clients.disconnect())
+
+    report = lifecycle.leak_report()
+    assert report["sessions"]["live"] == 0 and report["processes"]["live"] == 0
+    assert report["processes"]["reaped"] == report["processes"]["started"] == 1
+    assert report["processes"]["killed"] == 0
+    assert not _alive(pid)
+    assert not clients.connections
+
+
+@pytest.mark.asyncio
+async def test_stubborn_process_is_killed_within_deadline(lifecycle):
+    key = server_key("stdio", command=sys.executable, args=STUBBORN_SERVER)
+    connection = await lifecycle.open(key, NotifyingClientSession, label="stubborn")
+    pid = lifecycle.leak_report()["live_processes"][0]["pid"]
+
+    started = asyncio.get_running_loop().time()
+    await connection.close()
+
+    assert asyncio.get_running_loop().time() - started < 3 * lifecycle.shutdown_timeout
+    report = lifecycle.leak_report()
+    assert report["processes"]["live"] == 0 and report["processes"]["killed"] == 1
+    assert report["sessions"]["live"] == 0
+    assert not _alive(pid)
+
+
+@pytest.mark.asyncio
+async def test_pooled_sessions_are_tracked(lifecycle):
+    clients = MCPClients(use_session_pool=True, pool_stdio=True, lazy_connect=False)
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id="srv")
+    assert lifecycle.leak_report()["sessions"]["live"] == 1
+
+    await clients.disconnect()
+    # 共享会话在归还后仍保持，直到会话池关闭
+    assert lifecycle.leak_report()["processes"]["live"] == 1
+    await MCPSessionPool.shared().close()
+
+    report = lifecycle.leak_report()
+    assert report["sessions"] == {"live": 0, "opened": 1, "closed": 1}
+    assert report["processes"]["live"] == 0
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+from app.tool.mcp import MCPClients
+from app.tool.mcp_pool import MCPSessionPool
+
+ECHO_SERVER = [str(Path(__file__).with_name("mcp_echo_server.py"))]
+
+
+@pytest_asyncio.fixture
+async def pool():
+    pool = MCPSessionPool.shared()
+    pool.reconnect_min_wait = 0.05
+    yield pool
+    await pool.close()
+
+
+async def _connect(server_id: str) -> MCPClients:
+    clients = MCPClients(use_session_pool=True, pool_stdio=True, lazy_connect=False)
+    await clients.connect_stdio(sys.executable, ECHO_SERVER, server_id=server_id)
+    return clients
+
+
+@pytest.mark.asyncio
+async def test_agents_share_one_server_process(pool):
+    """相同配置的服务器只启动一次，各自的工具前缀互不影响"""
+    first, second = await _connect("a"), await _connect("b")
+
+    assert "a_echo" in first.tool_map and "b_echo" in second.tool_map
+    assert "b_echo" not in first.tool_map
+    pids = await asyncio.gather(
+        first.execute(name="a_pid", tool_input={}),
+        second.execute(name="b_pid", tool_input={}),
+    )
+    assert pids[0].output == pids[1].output
+
+    # 并发调用共享同一连接
+    results = await asyncio.gather(
+        *(first.execute(name="a_echo", tool_input={"text": f"n{i}"}) for i in range(5)),
+        *(second.execute(name="b_echo", tool_input={"text": "x"}) for _ in range(5)),
+    )
+    assert [r.output for r in results[:5]] == ["n0", "n1", "n2", "n3", "n4"]
+
+    stats = pool.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1
+    assert stats["hit_rate"] == 0.5
+    assert stats["references"] == 2
+
+    await first.disconnect("a")
+    assert pool.stats()["references"] == 1
+    assert (await second.execute(name="b_echo", tool_input={"text": "ok"})).output == "ok"
+
+
+@pytest.mark.asyncio
+async def test_session_reconnects_after_server_exit(pool):
+    clients = await _connect("srv")
+    before = (await clients.execute(name="srv_pid", tool_input={})).output
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(clients.sessions["srv"].call_tool("crash", {}), 1.0)
+
+    after = await clients.execute(name="srv_pid", tool_input={})
+    assert after.error is None
+    assert after.output != before
+    assert pool.stats()["reconnects"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stdio_servers_are_not_shared_by_default(pool):
+    """stdio服务器保存shell等状态，默认每个MCPClients单独启动进程"""
+    first = MCPClients(use_session_pool=True, pool_stdio=False, lazy_connect=False)
+    second = MCPClients(use_session_pool=True, pool_stdio=False, lazy_connect=False)
+    try:
+        await first.connect_stdio(sys.executable, ECHO_SERVER, server_id="a")
+        await second.connect_stdio(sys.executable, ECHO_SERVER, server_id="b")
+        pids = await asyncio.gather(
+            first.execute(name="a_pid", tool_input={}),
+            second.execute(name="b_pid", tool_input={}),
+        )
+        assert pids[0].output != pids[1].output
+        assert pool.stats()["servers"] == 0
+    finally:
+        await first.disconnect()
+        await second.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_bash_calls_on_shared_server_do_not_interleave(pool):
+    """共享内置服务器时，并发的bash命令按顺序执行，各自得到自己的输出"""
+    clients = [
+        MCPClients(use_session_pool=True, pool_stdio=True, lazy_connect=False) for _ in range(2)
+    ]
+    for index, client in enumerate(clients):
+        await client.connect_stdio(sys.executable, ["-m", "app.mcp.server"], server_id=f"s{index}")
+    assert pool.stats()["servers"] == 1
+
+    results = await asyncio.gather(
+        clients[0].execute(name="s0_bash", tool_input={"command": "sleep 0.5; echo first"}),
+        clients[1].execute(name="s1_bash", tool_input={"command": "echo second"}),
+    )
+    outputs = [json.loads(result.output)["output"] for result in results]
+    assert outputs == ["first", "second"]
@@ -0,0 +1,66 @@
+import pytest
+
+from app.tool import CreateChatCompletion, Terminate, ToolCollection
+from app.tool.mcp import MCPClients, MCPClientTool
+
+
+def test_to_params_is_cached_until_tool_set_changes():
+    """工具集未变化时复用同一份参数列表"""
+    tools = ToolCollection(Terminate())
+    first = tools.to_params()
+
+    assert tools.to_params() is first
+
+    tools.add_tool(CreateChatCompletion())
+    second = tools.to_params()
+
+    assert second is not first
+    assert [p["function"]["name"] for p in second] == ["terminate", "create_chat_completion"]
+    assert tools.params_version == 1
+
+
+def test_params_tokens_counted_once_per_version():
+    """工具描述的token数量每个版本只计算一次"""
+    calls = []
+
+    def count_tokens(text):
+        calls.append(text)
+        return len(text)
+
+    tools = ToolCollection(Terminate(), CreateChatCompletion())
+    cost = tools.count_params_tokens(count_tokens)
+
+    assert cost == sum(len(str(p)) for p in tools.to_params())
+    assert tools.count_params_tokens(count_tokens) == cost
+    assert len(calls) == 2
+
+    tools.invalidate_params()
+    tools.count_params_tokens(count_tokens)
+    assert len(calls) == 4
+
+
+@pytest.mark.asyncio
+async def test_mcp_disconnect_invalidates_params():
+    """断开MCP服务器后移除其工具并使参数缓存失效"""
+    clients = MCPClients()
+    tool = MCPClientTool(
+        name="srv_echo",
+        description="[srv] echo",
+        parameters={"type": "object", "properties": {}},
+        server_id="srv",
+        original_name="echo",
+    )
+    clients.add_tool(tool)
+    clients.sessions["srv"] = object()
+    version = clients.params_version
+    assert len(clients.to_params()) == 1
+
+    await clients.disconnect("srv")
+
+    assert clients.params_version > version
+    assert clients.to_params() == []
+
+
+# 在文件的最后，添加直接运行测试的代码
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])